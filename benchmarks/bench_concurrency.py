@@ -0,0 +1,89 @@
+"""
+Benchmark đọc vùng genomic song song: pyfaidx (1 handle dùng chung, khóa quanh seek+read)
+vs fasta_reader.IndexedFasta (pread theo offset .fai, không khóa).
+
+Chạy:  python benchmarks/bench_concurrency.py --fasta data/R570/R570.fasta --reads 20000
+Không truyền --fasta thì tự sinh 1 genome ngẫu nhiên ~100 Mb trong thư mục tạm.
+Lưu ý: để đo đúng I/O thật, nên xóa page cache (echo 3 > /proc/sys/vm/drop_caches) trước mỗi lượt.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pyfaidx import Fasta
+
+from fasta_reader import IndexedFasta, ensure_indexes
+
+
+def make_genome(path, n_chroms=10, chrom_len=10_000_000):
+    rnd = random.Random(0)
+    to_acgt = bytes(b"ACGT"[i % 4] for i in range(256))
+    with open(path, "wb") as out:
+        for c in range(n_chroms):
+            out.write(f">Chr{c + 1} synthetic\n".encode())
+            seq = rnd.randbytes(chrom_len).translate(to_acgt)
+            out.write(b"\n".join(seq[i:i + 60] for i in range(0, chrom_len, 60)) + b"\n")
+
+
+def make_regions(index, n, size):
+    rnd = random.Random(1)
+    names = [name for name, rec in index.items() if rec.length > size]
+    regions = []
+    for _ in range(n):
+        name = rnd.choice(names)
+        start = rnd.randrange(0, index[name].length - size)
+        regions.append((name, start, start + size))
+    return regions
+
+
+def run(reader, regions, threads):
+    def fetch(region):
+        name, start, end = region
+        return len(str(reader[name][start:end]))
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        total = sum(pool.map(fetch, regions, chunksize=64))
+    elapsed = time.perf_counter() - t0
+    return len(regions) / elapsed, total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark đọc FASTA song song theo số thread")
+    parser.add_argument("--fasta", help="File FASTA (mặc định: tự sinh)")
+    parser.add_argument("--reads", type=int, default=20000)
+    parser.add_argument("--size", type=int, default=2000, help="Độ dài mỗi vùng (bp)")
+    parser.add_argument("--threads", default="1,2,4,8,16")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        fasta_path = args.fasta
+        if not fasta_path:
+            fasta_path = os.path.join(tmp, "bench.fasta")
+            print("🧪 Sinh genome ngẫu nhiên...")
+            make_genome(fasta_path)
+        ensure_indexes(fasta_path)
+
+        readers = {
+            "pyfaidx": Fasta(fasta_path, key_function=lambda x: x.split()[0]),
+            "pread": IndexedFasta(fasta_path),
+        }
+        regions = make_regions(readers["pread"].index, args.reads, args.size)
+
+        print(f"{'threads':>8} " + " ".join(f"{label:>14}" for label in readers))
+        for threads in [int(t) for t in args.threads.split(",")]:
+            row = [run(reader, regions, threads)[0] for reader in readers.values()]
+            print(f"{threads:>8} " + " ".join(f"{rps:>10.0f} r/s" for rps in row))
+
+        for reader in readers.values():
+            reader.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Benchmark tầng Database: engine mặc định (cũ) vs engine production (WAL + mmap + pool + statement cache).
+
+Chạy:  python benchmarks/bench_db.py --genes 200000 --threads 40 --seconds 10
+Mỗi "request" = 1 lần tra gen theo (genome_id, gene_id) + 1 lần tìm theo vùng,
+giống /genome/sequence và /genome/search. Có 1 thread ghi giả lập import_data.py chạy song song.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import threading
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy.orm import sessionmaker
+
+import database
+import queries
+from models import Base, Gene, Genome
+
+GENOME_ID = "BENCH"
+N_CHROMS = 10
+
+
+def seed(url, n_genes):
+    # Seed bằng engine mặc định: file DB giữ journal_mode cũ cho lượt đo "default"
+    eng = database.make_engine(url, tuned=False)
+    Base.metadata.create_all(bind=eng)
+    Session = sessionmaker(bind=eng)
+    s = Session()
+    s.add(Genome(id=GENOME_ID, name="bench", fasta_path=""))
+    batch = []
+    for i in range(n_genes):
+        start = (i // N_CHROMS) * 3000 + 1
+        batch.append(Gene(gene_id=f"G{i:07d}", genome_id=GENOME_ID, chromosome=f"Chr{i % N_CHROMS}",
+                          start=start, end=start + 2000, strand="+", description=f"gene {i}"))
+        if len(batch) >= 5000:
+            s.bulk_save_objects(batch)
+            batch = []
+    s.bulk_save_objects(batch)
+    s.commit()
+    s.close()
+    eng.dispose()
+
+
+def writer_loop(SessionFactory, stop):
+    """Giả lập import: ghi liên tục từng lô 5000 dòng vào 1 genome khác."""
+    i = 0
+    while not stop.is_set():
+        s = SessionFactory()
+        try:
+            s.bulk_save_objects([
+                Gene(gene_id=f"W{i}_{j}", genome_id="WRITER", chromosome="Chr0", start=j, end=j + 10, strand="+")
+                for j in range(5000)
+            ])
+            s.commit()
+        finally:
+            s.close()
+        i += 1
+
+
+def run(url, tuned, n_genes, n_threads, seconds, with_writer):
+    eng = database.make_engine(url, tuned=tuned)
+    SessionFactory = sessionmaker(autocommit=False, autoflush=False, bind=eng)
+    stop = threading.Event()
+    counts = [0] * n_threads
+    errors = [0] * n_threads
+
+    def reader(idx):
+        rnd = random.Random(idx)
+        while not stop.is_set():
+            s = SessionFactory()
+            try:
+                i = rnd.randrange(n_genes)
+                queries.get_gene(s, GENOME_ID, f"G{i:07d}")
+                pos = rnd.randrange(1, (n_genes // N_CHROMS) * 3000)
+                queries.search_genes(s, GENOME_ID, chrom=f"Chr{i % N_CHROMS}", start=pos, end=pos + 10000)
+                counts[idx] += 1
+            except Exception:
+                errors[idx] += 1
+            finally:
+                s.close()
+
+    threads = [threading.Thread(target=reader, args=(i,)) for i in range(n_threads)]
+    if with_writer:
+        threads.append(threading.Thread(target=writer_loop, args=(SessionFactory, stop)))
+    for t in threads:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    eng.dispose()
+    return sum(counts) / seconds, sum(errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark database.py (req/s trước và sau tuning)")
+    parser.add_argument("--genes", type=int, default=200000)
+    parser.add_argument("--threads", type=int, default=database.DB_POOL_SIZE)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--no-writer", action="store_true", help="Không chạy thread ghi song song")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        url = f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+        print(f"🧪 Seeding {args.genes} gen...")
+        seed(url, args.genes)
+
+        for label, tuned in (("default", False), ("production", True)):
+            rps, errs = run(url, tuned, args.genes, args.threads, args.seconds, not args.no_writer)
+            print(f"{label:>12}: {rps:10.1f} req/s  (lỗi: {errs})")
+
+
+if __name__ == "__main__":
+    main()
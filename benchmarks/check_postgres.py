@@ -0,0 +1,132 @@
+"""
+Kiểm tra backend PostgreSQL trên 1 server thật (instance dùng xong bỏ, VD docker postgres:16):
+import_data.py (COPY + extension pg_trgm/btree_gist + index GiST/trigram) rồi /genome/search
+(vùng + từ khóa, phân trang keyset) so với kết quả tính trực tiếp từ file GFF.
+
+Chạy:  DATABASE_URL=postgresql+psycopg2://postgres@localhost:5432/sugarcane python benchmarks/check_postgres.py
+Dữ liệu giả (GFF/FASTA ngẫu nhiên) được sinh trong thư mục tạm, nạp vào bộ gen PGCHECK rồi xóa khi xong.
+"""
+import os
+import sys
+import random
+import argparse
+import tempfile
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi.testclient import TestClient
+
+import database
+from models import Gene, Genome, Transcript
+
+GENOME_ID = "PGCHECK"
+CHROMS = {"Chr1": 2_000_000, "Chr2": 1_500_000}
+
+
+def make_dataset(tmp, n_genes):
+    """FASTA + GFF3 ngẫu nhiên. Trả về (gff, fasta, genes) với genes = [(gene_id, chrom, start, end, note)]."""
+    rnd = random.Random(0)
+    fasta = os.path.join(tmp, "check.fa")
+    with open(fasta, "w") as out:
+        for chrom, length in CHROMS.items():
+            seq = "".join(rnd.choice("ACGT") for _ in range(length))
+            out.write(f">{chrom}\n" + "\n".join(seq[i:i + 60] for i in range(0, length, 60)) + "\n")
+
+    gff = os.path.join(tmp, "check.gff3")
+    genes = []
+    per_chrom = n_genes // len(CHROMS)
+    with open(gff, "w") as out:
+        out.write("##gff-version 3\n")
+        for chrom, length in CHROMS.items():
+            for k in range(min(per_chrom, (length - 300) // 25)):
+                i = len(genes) + 1
+                start, end = 1 + k * 25, 301 + k * 25
+                # Backslash trong mô tả: kiểm tra escape của COPY
+                note = "disease resistance protein" if i % 1000 == 0 else \
+                    "sucrose synthase\\like" if i == 5 else f"hypothetical protein {i}"
+                gene_id = f"PG{i:06d}"
+                out.write(f"{chrom}\tcheck\tgene\t{start}\t{end}\t.\t{'+-'[i % 2]}\t.\tID={gene_id};Note={note}\n")
+                if i <= 50:
+                    out.write(f"{chrom}\tcheck\tmRNA\t{start}\t{end}\t.\t+\t.\tID={gene_id}.t1;Parent={gene_id}\n")
+                    out.write(f"{chrom}\tcheck\texon\t{start}\t{end}\t.\t+\t.\tParent={gene_id}.t1\n")
+                    out.write(f"{chrom}\tcheck\tCDS\t{start + 10}\t{end - 10}\t.\t+\t0\tParent={gene_id}.t1\n")
+                genes.append((gene_id, chrom, start, end, note))
+    return gff, fasta, genes
+
+
+def all_pages(client, params):
+    """Gom mọi trang của /genome/search theo next_cursor."""
+    ids, cursor = [], None
+    while True:
+        r = client.get("/genome/search", params={**params, **({"cursor": cursor} if cursor else {})})
+        assert r.status_code == 200, r.text
+        body = r.json()
+        ids += [d["gene_id"] for d in body["data"]]
+        cursor = body.get("next_cursor")
+        if not cursor:
+            return ids
+
+
+def check(label, got, expected):
+    ok = sorted(got) == sorted(expected) and len(set(got)) == len(got)
+    print(f"{'✅' if ok else '❌'} {label}: {len(got)} / {len(expected)}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Kiểm tra import + /genome/search trên PostgreSQL thật")
+    parser.add_argument("--genes", type=int, default=120000, help="> 50000 để COPY chạy nhiều lô")
+    parser.add_argument("--keep", action="store_true", help="Giữ lại dữ liệu PGCHECK sau khi kiểm tra")
+    args = parser.parse_args()
+
+    if not database.is_postgres():
+        sys.exit("❌ Cần DATABASE_URL=postgresql+psycopg2://...")
+
+    import import_data
+    import main as app_main
+
+    ok = True
+    with tempfile.TemporaryDirectory() as tmp:
+        gff, fasta, genes = make_dataset(tmp, args.genes)
+        # Nạp 2 lần: lần 2 đi qua nhánh xóa + nạp lại trong cùng transaction
+        for _ in range(2):
+            import_data.run_import(GENOME_ID, gff, fasta)
+
+        with database.engine.connect() as conn:
+            extensions = {r[0] for r in conn.exec_driver_sql("SELECT extname FROM pg_extension")}
+            indexes = {r[0] for r in conn.exec_driver_sql("SELECT indexname FROM pg_indexes WHERE tablename = 'genes'")}
+            count = conn.exec_driver_sql("SELECT COUNT(*) FROM genes WHERE genome_id = %s", (GENOME_ID,)).scalar()
+            desc = conn.exec_driver_sql("SELECT description FROM genes WHERE gene_id = 'PG000005'").scalar()
+            plan = "\n".join(r[0] for r in conn.exec_driver_sql(
+                "EXPLAIN SELECT id FROM genes WHERE genome_id = %s AND chromosome = 'Chr2' "
+                "AND int4range(start, \"end\", '[]') && int4range(100000, 103000, '[]')", (GENOME_ID,)))
+        ok &= check("extension pg_trgm/btree_gist", extensions & {"pg_trgm", "btree_gist"}, ["pg_trgm", "btree_gist"])
+        ok &= check("index GiST/trigram", indexes & {"idx_gene_range", "idx_gene_id_trgm", "idx_gene_desc_trgm"},
+                    ["idx_gene_range", "idx_gene_id_trgm", "idx_gene_desc_trgm"])
+        ok &= check("số gen sau khi nạp lại", [count], [len(genes)])
+        ok &= check("escape COPY", [desc], ["sucrose synthase\\like"])
+        ok &= check("truy vấn vùng dùng idx_gene_range", ["idx_gene_range" in plan], [True])
+
+        with TestClient(app_main.app) as client:
+            got = all_pages(client, {"genome": GENOME_ID, "chrom": "Chr2", "start": 100000, "end": 103000,
+                                     "limit": 37})
+            ok &= check("/genome/search theo vùng", got,
+                        [g[0] for g in genes if g[1] == "Chr2" and g[2] <= 103000 and g[3] >= 100000])
+            got = all_pages(client, {"genome": GENOME_ID, "q": "resistance", "limit": 25})
+            ok &= check("/genome/search theo mô tả", got, [g[0] for g in genes if "resistance" in g[4]])
+            got = all_pages(client, {"genome": GENOME_ID, "q": "PG00012", "limit": 4})
+            ok &= check("/genome/search theo gene_id", got, [g[0] for g in genes if "PG00012" in g[0]])
+
+    if not args.keep:
+        s = database.SessionLocal()
+        s.query(Transcript).filter(Transcript.genome_id == GENOME_ID).delete()
+        s.query(Gene).filter(Gene.genome_id == GENOME_ID).delete()
+        s.query(Genome).filter(Genome.id == GENOME_ID).delete()
+        s.commit()
+        s.close()
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
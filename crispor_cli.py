@@ -0,0 +1,245 @@
+"""
+Chạy CRISPOR offline (không cần API server) cho file FASTA hoặc BED, song song trên nhiều process.
+Dùng cho các màn sàng lọc lớn trên node cluster.
+
+    python crispor_cli.py --genome R570 --bed targets.bed --out guides.tsv --workers 16
+    python crispor_cli.py --genome R570 --fasta alleles.fa --out guides.tsv --top-k 10
+
+Kết quả ghi dần ra TSV (cột giống job thư viện); các đích đã xong được ghi vào <out>.done.
+Chạy lại cùng lệnh sau khi bị ngắt -> bỏ qua các đích đã xong, dòng dở dang của đích chưa xong bị xóa.
+--check-primers: process cha gom cặp mồi của tối đa --primer-batch đích rồi quét bộ gen 1 lượt cho cả lô
+(process con không quét bộ gen).
+"""
+import os
+import sys
+import csv
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+sys.path.append(os.getcwd())
+
+import crispor_engine
+import offtarget_shards
+import primer_specificity
+from library_design import LibraryTarget, OUTPUT_COLUMNS, parse_bed, result_rows
+from fasta_reader import IndexedFasta, BgzfFasta, is_bgzf
+from genome_store import PackedGenome
+from kmer_index import KmerTables, kmer_dir
+
+
+def read_fasta_targets(path: str):
+    """FASTA nhiều record -> list (LibraryTarget, sequence). Tên = phần ID trước dấu cách."""
+    targets = []
+    name, chunks = None, []
+
+    def flush():
+        if name is not None:
+            seq = "".join(chunks).upper()
+            targets.append((LibraryTarget(name, None, 1, len(seq), None, None, 0), seq))
+
+    with open(path) as fh:
+        for line in fh:
+            line = line.strip()
+            if line.startswith(">"):
+                flush()
+                name, chunks = line[1:].split()[0], []
+            elif line:
+                chunks.append(line)
+    flush()
+    return targets
+
+
+def open_reader(fasta_path, store_dir, genome_id):
+    """Kho mmap nếu còn mới, không thì đọc FASTA trực tiếp (None nếu không có FASTA)."""
+    if store_dir and PackedGenome.is_fresh(store_dir, genome_id, fasta_path):
+        return PackedGenome(os.path.join(store_dir, genome_id))
+    if fasta_path and os.path.exists(fasta_path):
+        return BgzfFasta(fasta_path) if is_bgzf(fasta_path) else IndexedFasta(fasta_path)
+    return None
+
+
+# --- Process con ---
+_worker = {}
+
+
+def _init_worker(fasta_path, store_dir, genome_id, index_path, options):
+    """Mỗi process mở bộ gen / bảng k-mer 1 lần. Song song theo đích nên Primer3 chạy tuần tự trong process."""
+    crispor_engine.PRIMER_WORKERS = 1
+    reader = open_reader(fasta_path, store_dir, genome_id)
+
+    kmers = None
+    if store_dir and KmerTables.is_fresh(store_dir, genome_id, fasta_path):
+        kmers = KmerTables(kmer_dir(store_dir, genome_id))
+
+    _worker.update(reader=reader, kmers=kmers, index_path=index_path, options=options,
+                   offtarget_cache=crispor_engine.bind_offtarget_cache(genome_id, fasta_path),
+                   shards=offtarget_shards.load_shards(fasta_path))
+
+
+def _run_chunk(chunk):
+    """
+    chunk: list (LibraryTarget, sequence hoặc None).
+    Trả về list (đích, kết quả run_crispor_analysis, True nếu Bowtie2 không tìm được off-target).
+    Kiểm tra mồi trên bộ gen không chạy ở đây: process cha làm theo lô cho nhiều đích.
+    """
+    reader, options = _worker["reader"], _worker["options"]
+    out = []
+    for target, seq in chunk:
+        if seq is None:
+            if reader is None or target.chrom not in reader:
+                out.append((target, None, False))
+                continue
+            seq = reader.fetch(target.chrom, target.start - 1, target.end)
+        failed = set()
+        results = crispor_engine.run_crispor_analysis(
+            seq, _worker["index_path"], top_k=options["top_k"], min_gc=options["min_gc"],
+            max_gc=options["max_gc"], min_efficiency=options["min_efficiency"],
+            kmer_tables=_worker["kmers"], max_copies=options["max_copies"],
+            offtarget_cache=_worker["offtarget_cache"], shards=_worker["shards"], failed=failed
+        )
+        out.append((target, results, bool(failed)))
+    return out
+
+
+# --- Output có thể chạy tiếp ---
+def load_done(out_path: str):
+    """Đọc danh sách đích đã xong; xóa các dòng dở dang (đích chưa có trong .done) khỏi file kết quả."""
+    done_path = out_path + ".done"
+    done = set()
+    if os.path.exists(done_path):
+        with open(done_path) as fh:
+            done = {line.rstrip("\n") for line in fh if line.strip()}
+
+    if os.path.exists(out_path):
+        tmp_path = out_path + ".tmp"
+        with open(out_path, newline="") as src, open(tmp_path, "w", newline="") as dst:
+            reader = csv.reader(src, delimiter="\t")
+            writer = csv.writer(dst, delimiter="\t")
+            writer.writerow(next(reader, OUTPUT_COLUMNS))
+            for row in reader:
+                if row and row[0] in done:
+                    writer.writerow(row)
+        os.replace(tmp_path, out_path)
+    return done
+
+
+def run(args):
+    import database
+    from models import Genome
+
+    db = database.SessionLocal()
+    try:
+        genome = db.query(Genome).filter(Genome.id == args.genome).first()
+    finally:
+        db.close()
+    if not genome:
+        sys.exit(f"❌ Bộ gen '{args.genome}' chưa có trong Database (chạy import_data.py trước).")
+
+    if args.fasta:
+        targets = read_fasta_targets(args.fasta)
+    else:
+        with open(args.bed) as fh:
+            targets = [(t, None) for t in parse_bed(fh.read())]
+
+    names = [t.name for t, _ in targets]
+    if len(set(names)) != len(names):
+        sys.exit("❌ Tên đích bị trùng - cần tên duy nhất để chạy tiếp được.")
+
+    if args.resume and not os.path.exists(args.out) and os.path.exists(args.out + ".done"):
+        # Mất file kết quả -> danh sách đã xong không còn đúng, chạy lại mọi đích
+        print(f"⚠️ Không thấy {args.out}: bỏ {args.out}.done cũ, chạy lại từ đầu.")
+        os.remove(args.out + ".done")
+    done = load_done(args.out) if args.resume else set()
+    pending = [item for item in targets if item[0].name not in done]
+    print(f"🎯 {len(targets)} đích, {len(done)} đã xong, còn {len(pending)}.")
+    if not pending:
+        return
+
+    options = {
+        "top_k": args.top_k, "min_gc": args.min_gc, "max_gc": args.max_gc,
+        "min_efficiency": args.min_efficiency, "max_copies": args.max_copies,
+    }
+    init_args = (genome.fasta_path, args.store, genome.id, crispor_engine.bowtie_index_path(genome.fasta_path),
+                 options)
+    chunks = [pending[i:i + args.chunk_size] for i in range(0, len(pending), args.chunk_size)]
+
+    primer_reader = open_reader(genome.fasta_path, args.store, genome.id) if args.check_primers else None
+    if args.check_primers and primer_reader is None:
+        sys.exit(f"❌ Không đọc được FASTA của bộ gen '{genome.id}' để kiểm tra mồi.")
+
+    new_file = not os.path.exists(args.out) or not args.resume
+    with open(args.out, "w" if new_file else "a", newline="") as out_fh, \
+            open(args.out + ".done", "w" if new_file else "a") as done_fh, \
+            ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker, initargs=init_args) as pool:
+        writer = csv.writer(out_fh, delimiter="\t")
+        if new_file:
+            writer.writerow(OUTPUT_COLUMNS)
+
+        finished = 0
+        failed_targets = []
+        buffered = []  # (đích, kết quả) chờ kiểm tra mồi
+
+        def flush():
+            nonlocal finished
+            ready = [results for _, results in buffered if results]
+            if primer_reader is not None and ready:
+                # 1 lượt quét bộ gen cho mọi cặp mồi của cả lô
+                primer_specificity.rerank_many(ready, primer_reader)
+            for target, results in buffered:
+                if results is None:
+                    print(f"⚠️ Không đọc được vùng của đích {target.name}")
+                else:
+                    writer.writerows([[row[c] for c in OUTPUT_COLUMNS] for row in result_rows(target, results)])
+            # Kết quả phải xuống đĩa trước khi đánh dấu xong
+            out_fh.flush()
+            os.fsync(out_fh.fileno())
+            for target, _ in buffered:
+                done_fh.write(target.name + "\n")
+            done_fh.flush()
+            finished += len(buffered)
+            buffered.clear()
+            print(f"   -> {finished}/{len(pending)} đích")
+
+        for future in as_completed([pool.submit(_run_chunk, chunk) for chunk in chunks]):
+            for target, results, offtarget_failed in future.result():
+                if offtarget_failed:
+                    # Không ghi, không đánh dấu xong: specificity sẽ sai (0 off-target) -> lần chạy tiếp làm lại
+                    failed_targets.append(target.name)
+                else:
+                    buffered.append((target, results))
+            if buffered and (primer_reader is None or len(buffered) >= args.primer_batch):
+                flush()
+        if buffered:
+            flush()
+
+    if primer_reader is not None:
+        primer_reader.close()
+    if failed_targets:
+        sys.exit(f"❌ {len(failed_targets)} đích không tìm được off-target (Bowtie2 lỗi / thiếu index), "
+                 f"VD: {', '.join(failed_targets[:5])}. Sửa lỗi rồi chạy lại cùng lệnh để làm tiếp.")
+    print(f"✅ Xong: {args.out}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chạy CRISPOR offline cho nhiều đích (FASTA/BED)")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--fasta", help="FASTA các trình tự đích (mỗi record 1 đích)")
+    source.add_argument("--bed", help="BED các vùng đích trên bộ gen đã đăng ký")
+    parser.add_argument("--genome", required=True, help="ID bộ gen đã import (VD: R570)")
+    parser.add_argument("--out", required=True, help="File TSV kết quả")
+    parser.add_argument("--store", default=os.getenv("GENOME_STORE_DIR"),
+                        help="Kho genome/k-mer đã dựng (mặc định: GENOME_STORE_DIR)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--chunk-size", type=int, default=10, help="Số đích mỗi tác vụ gửi cho process con")
+    parser.add_argument("--top-k", type=int, default=crispor_engine.CRISPOR_TOP_K)
+    parser.add_argument("--min-gc", type=float, default=crispor_engine.CRISPOR_MIN_GC)
+    parser.add_argument("--max-gc", type=float, default=crispor_engine.CRISPOR_MAX_GC)
+    parser.add_argument("--min-efficiency", type=float, default=crispor_engine.CRISPOR_MIN_EFFICIENCY)
+    parser.add_argument("--max-copies", type=int, default=crispor_engine.CRISPOR_MAX_COPIES)
+    parser.add_argument("--check-primers", action="store_true", help="Dự đoán amplicon off-target của cặp mồi")
+    parser.add_argument("--primer-batch", type=int, default=500,
+                        help="Số đích gom lại cho mỗi lượt quét bộ gen khi --check-primers")
+    parser.add_argument("--no-resume", dest="resume", action="store_false",
+                        help="Ghi đè kết quả cũ thay vì chạy tiếp")
+
+    run(parser.parse_args())
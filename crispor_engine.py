@@ -1,8 +1,19 @@
+import os
 import re
 import math
+import heapq
+import threading
 import subprocess
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
 import primer3
 
+from sequtils import complement
+import primer_specificity
+import pam_scanner
+
 # --- 1. DỮ LIỆU TRỌNG SỐ DOENCH (Từ file doenchScore.py bạn gửi) ---
 # Format: (Vị trí, Nucleotide, Trọng số)
 # Vị trí tính từ 1 (theo bài báo), nhưng Python index từ 0 nên ta sẽ xử lý trong hàm.
@@ -56,6 +67,17 @@ def get_cfd_weight(rna_base, dna_base, position_1_based):
     # Nếu không tìm thấy (hoặc là N), trả về mặc định 1.0 (Nguy hiểm nhất)
     return 1.0
 
+
+def cfd_position(pos, guide_len, enzyme=None):
+    """
+    Vị trí 1-based trên spacer (5'->3') -> vị trí trong bảng CFD (1..20, 20 = sát PAM) theo khoảng cách tới PAM.
+    PAM đầu 3' (Cas9): base cuối spacer sát PAM; PAM đầu 5' (Cas12a): base đầu spacer sát PAM.
+    Spacer dài hơn 20nt: phần xa PAM quá 20nt cho giá trị < 1 -> ngoài bảng (trọng số 1.0, vùng xa chịu sai).
+    """
+    if enzyme is not None and enzyme.pam_side == "5":
+        return 21 - pos
+    return pos - (guide_len - 20)
+
 # Ma trận CFD (Simplified): Vị trí tính từ 1 (xa PAM) đến 20 (sát PAM)
 # Chuẩn Doench: Mismatch ở vị trí 20 (sát PAM) thì phạt NHẸ (score cao).
 # Mismatch ở vị trí 1-10 (xa PAM) thì phạt NẶNG (score thấp).
@@ -69,37 +91,323 @@ CFD_WEIGHTS = {
     16: 0.05, 17: 0.02, 18: 0.01, 19: 0.0, 20: 0.0 # Sát PAM -> Không cắt -> An toàn
 }
 
-class CrisporEngine:
-    def __init__(self, genome_index_path):
-        self.genome_index = genome_index_path
+# --- ĐIỂM HIỆU QUẢ THEO ENZYME (pam_scanner.Enzyme.scorers) ---
+# Tên mô hình -> hàm (engine, list ngữ cảnh Enzyme.context) -> list điểm 0-100, chạy theo lô.
+# Doench 2014 có sẵn trong engine; Najm 2018 (SaCas9) và DeepCpf1 (Cas12a) lấy từ crisporEffScores
+# và cần gói tùy chọn (azimuth + bin/najm2018, DeepCpf1) -> thiếu thì bỏ qua, điểm hiệu quả = None.
+def _score_najm(engine, contexts):
+    import crisporEffScores
+    return crisporEffScores.calcNajmScore(contexts)
 
-    def find_candidates(self, sequence):
-        """Bước 1: Tìm PAM (Giữ nguyên)"""
-        candidates = []
-        seq_upper = sequence.upper()
-        # Tìm NGG
-        for match in re.finditer(r'(?=([ATGC]GG))', seq_upper):
-            pam_start = match.start()
-            guide_start = pam_start - 20
 
-            # Lấy ngữ cảnh 30bp (4bp trước + 20bp guide + 3bp PAM + 3bp sau)
-            # Đây là format bắt buộc của thuật toán Doench
-            context_start = guide_start - 4
-            context_end = pam_start + 6
+def _score_deepcpf1(engine, contexts):
+    import crisporEffScores
+    return crisporEffScores.calcDeepCpf1Scores(contexts)[0]
 
-            if context_start < 0 or context_end > len(seq_upper):
+
+EFFICIENCY_MODELS = {
+    "doench": lambda engine, contexts: [engine.calculate_efficiency_score(c) for c in contexts],
+    "najm": _score_najm,
+    "seqDeepCpf1": _score_deepcpf1,
+}
+_unavailable_models = set()
+
+
+def score_efficiency(engine, enzyme, contexts):
+    """
+    Điểm hiệu quả cho cả lô ngữ cảnh của 1 enzyme: mô hình đầu tiên trong enzyme.scorers chạy được.
+    Trả về (tên mô hình, list điểm) hoặc (None, None) nếu enzyme không có mô hình nào dùng được.
+    """
+    for name in enzyme.scorers:
+        model = EFFICIENCY_MODELS.get(name)
+        if model is None or name in _unavailable_models:
+            continue
+        try:
+            return name, model(engine, contexts)
+        except (ImportError, OSError) as e:
+            _unavailable_models.add(name)
+            print(f"⚠️ Mô hình hiệu quả '{name}' ({enzyme.name}) không dùng được: {e}")
+    return None, None
+
+
+# --- PIPELINE NHIỀU TẦNG (lọc rẻ -> off-target -> Primer3) ---
+CRISPOR_TOP_K = int(os.getenv("CRISPOR_TOP_K", "20"))            # Số guide trả về (chỉ chúng mới chạy Primer3)
+CRISPOR_POOL_FACTOR = int(os.getenv("CRISPOR_POOL_FACTOR", "5"))  # Số guide chạy off-target = top_k * hệ số
+CRISPOR_MIN_GC = float(os.getenv("CRISPOR_MIN_GC", "20"))
+CRISPOR_MAX_GC = float(os.getenv("CRISPOR_MAX_GC", "80"))
+CRISPOR_MIN_EFFICIENCY = float(os.getenv("CRISPOR_MIN_EFFICIENCY", "0"))
+# Có bảng k-mer: loại guide xuất hiện (20nt + NGG) nhiều hơn số bản này trong bộ gen
+CRISPOR_MAX_COPIES = int(os.getenv("CRISPOR_MAX_COPIES", "1"))
+# Tham số tìm off-target của Bowtie2 (cũng là 1 phần khóa cache off-target)
+OFFTARGET_PARAMS = ("-k", "20", "-N", "1", "-L", "20")
+# Số shard chạy đồng thời (mỗi shard là 1 process Bowtie2 riêng)
+OFFTARGET_SHARD_WORKERS = int(os.getenv("OFFTARGET_SHARD_WORKERS", str(os.cpu_count() or 1)))
+# Giữ N off-target nguy hiểm nhất (CFD cao nhất) mỗi guide sau khi gộp kết quả các shard
+OFFTARGET_TOP_N = int(os.getenv("OFFTARGET_TOP_N", "20"))
+# Số guide mỗi lần gọi Bowtie2 ở chế độ theo lô (giới hạn bởi độ dài dòng lệnh)
+OFFTARGET_BATCH_SIZE = int(os.getenv("OFFTARGET_BATCH_SIZE", "1000"))
+# Số hit trả về cho mỗi (guide, bộ gen) ở chế độ quét bảo tồn
+CONSERVATION_MAX_HITS = int(os.getenv("CONSERVATION_MAX_HITS", "10"))
+
+# --- PRIMER3 ---
+# 1 bộ tham số dùng chung cho mọi lần thiết kế (không dựng lại dict mỗi guide)
+PRIMER_SETTINGS = {
+    'PRIMER_OPT_SIZE': 20,
+    'PRIMER_PRODUCT_SIZE_RANGE': [[150, 300]],
+    'PRIMER_MIN_TM': 57.0,
+    'PRIMER_MAX_TM': 63.0
+}
+PRIMER_SETTINGS_KEY = repr(sorted(PRIMER_SETTINGS.items()))
+# Template cục bộ quanh target: amplicon tối đa 300bp nên ±350bp là đủ, không cần cả gen
+PRIMER_WINDOW_FLANK = int(os.getenv("PRIMER_WINDOW_FLANK", "350"))
+# Các guide có vùng target nằm gọn trong đoạn này dùng chung 1 amplicon (1 lần gọi Primer3)
+PRIMER_GROUP_SPAN = int(os.getenv("PRIMER_GROUP_SPAN", "100"))
+PRIMER_WORKERS = int(os.getenv("PRIMER_WORKERS", str(min(4, os.cpu_count() or 1))))
+PRIMER_CACHE_SIZE = int(os.getenv("PRIMER_CACHE_SIZE", "20000"))
+
+_primer_design = getattr(primer3.bindings, "design_primers", None) or primer3.bindings.designPrimers
+_primer_cache = OrderedDict()  # (window, target_start, target_len, settings) -> kết quả
+_primer_lock = threading.Lock()
+_primer_pool = None
+
+
+def _design_window(window, target_start, target_len):
+    """Chạy Primer3 trên 1 template cục bộ (hàm top-level để gửi sang process pool)."""
+    try:
+        res = _primer_design(
+            {
+                'SEQUENCE_ID': 'crispr',
+                'SEQUENCE_TEMPLATE': window,
+                'SEQUENCE_TARGET': [target_start, target_len]
+            },
+            PRIMER_SETTINGS
+        )
+        return {
+            "left": res.get('PRIMER_LEFT_0_SEQUENCE', 'N/A'),
+            "right": res.get('PRIMER_RIGHT_0_SEQUENCE', 'N/A'),
+            "product_size": res.get('PRIMER_PAIR_0_PRODUCT_SIZE', 0)
+        }
+    except Exception:
+        return {"left": "N/A", "right": "N/A", "error": "Primer Error"}
+
+
+def _get_primer_pool():
+    """
+    Process pool Primer3. Dùng 'spawn' chứ không fork: pool có thể được tạo từ server nhiều thread,
+    fork lúc thread khác đang giữ lock -> process con treo.
+    """
+    global _primer_pool
+    with _primer_lock:
+        if _primer_pool is None:
+            _primer_pool = ProcessPoolExecutor(max_workers=PRIMER_WORKERS,
+                                               mp_context=multiprocessing.get_context("spawn"))
+        return _primer_pool
+
+
+def start_primer_pool():
+    """Tạo pool lúc khởi động server (lifespan) thay vì ở request đầu tiên."""
+    if PRIMER_WORKERS > 1:
+        _get_primer_pool()
+
+
+def shutdown_primer_pool():
+    global _primer_pool
+    with _primer_lock:
+        pool, _primer_pool = _primer_pool, None
+    if pool is not None:
+        pool.shutdown(cancel_futures=True)
+
+
+def group_primer_targets(target_starts, span=PRIMER_GROUP_SPAN):
+    """
+    Gom các target (vùng [start-5, start+25) như trước) gần nhau thành cụm dùng chung amplicon.
+    Trả về list (cụm_start, cụm_end, [chỉ số guide]).
+    """
+    groups = []
+    for i in sorted(range(len(target_starts)), key=lambda k: target_starts[k]):
+        t_start = target_starts[i] - 5
+        t_end = t_start + 30
+        if groups and t_end - groups[-1][0] <= span:
+            groups[-1][1] = max(groups[-1][1], t_end)
+            groups[-1][2].append(i)
+        else:
+            groups.append([t_start, t_end, [i]])
+    return groups
+
+
+def design_primers_batch(full_sequence, target_starts, workers=None):
+    """
+    Thiết kế mồi cho nhiều guide 1 lượt: mỗi cụm target -> 1 template cục bộ ±PRIMER_WINDOW_FLANK,
+    kết quả memo theo (template, target, tham số); các thiết kế chưa có cache chạy song song
+    trên process pool. Trả về list kết quả theo đúng thứ tự target_starts.
+    """
+    workers = PRIMER_WORKERS if workers is None else workers
+    results = [None] * len(target_starts)
+    jobs = {}  # key -> [chỉ số guide]
+    seq_len = len(full_sequence)
+
+    for g_start, g_end, members in group_primer_targets(target_starts):
+        g_start, g_end = max(0, g_start), min(seq_len, g_end)
+        w_start = max(0, g_start - PRIMER_WINDOW_FLANK)
+        w_end = min(seq_len, g_end + PRIMER_WINDOW_FLANK)
+        key = (full_sequence[w_start:w_end], g_start - w_start, g_end - g_start, PRIMER_SETTINGS_KEY)
+        jobs.setdefault(key, []).extend(members)
+
+    pending = []
+    with _primer_lock:
+        for key, members in jobs.items():
+            cached = _primer_cache.get(key)
+            if cached is None:
+                pending.append(key)
                 continue
+            _primer_cache.move_to_end(key)
+            for i in members:
+                results[i] = dict(cached)
+
+    if pending:
+        args = [(k[0], k[1], k[2]) for k in pending]
+        if workers > 1 and len(pending) > 1:
+            designed = list(_get_primer_pool().map(_design_window, *zip(*args)))
+        else:
+            designed = [_design_window(*a) for a in args]
+
+        with _primer_lock:
+            for key, res in zip(pending, designed):
+                # Lỗi Primer3 có thể chỉ là tạm thời -> không memo, lần sau chạy lại
+                if "error" not in res:
+                    _primer_cache[key] = res
+                    if len(_primer_cache) > PRIMER_CACHE_SIZE:
+                        _primer_cache.popitem(last=False)
+                for i in jobs[key]:
+                    results[i] = dict(res)
+    return results
+
+
+# Đệm 2 bên mỗi vùng quét: đủ chứa guide + ngữ cảnh 30bp của guide cắt sát mép vùng
+SCAN_PADDING = 30
+
+
+def bowtie_local_prefix(fasta_path):
+    """Tiền tố file index Bowtie2 trên máy chạy app (VD: D:/.../R570_index -> R570_index.1.bt2 ...)."""
+    abs_fasta_path = os.path.abspath(fasta_path)
+    return abs_fasta_path.replace(".fasta", "_index")  # Quy ước tên index
+
+
+def to_wsl_path(path):
+    """Đường dẫn Windows -> đường dẫn WSL cho Bowtie2 (đường dẫn Linux giữ nguyên)."""
+    wsl_path = path.replace("\\", "/")
+    if wsl_path.lower().startswith("d:"):
+        wsl_path = "/mnt/d" + wsl_path[2:]
+    elif wsl_path.lower().startswith("c:"):
+        wsl_path = "/mnt/c" + wsl_path[2:]
+    return wsl_path
+
+
+def bowtie_index_path(fasta_path):
+    """Đường dẫn index Bowtie2 (kiểu WSL) suy từ đường dẫn FASTA của bộ gen."""
+    # Xử lý đường dẫn Windows -> WSL cho Bowtie2
+    return to_wsl_path(bowtie_local_prefix(fasta_path))
+
+
+def bind_offtarget_cache(genome_id, fasta_path):
+    """
+    Cache off-target (offtarget_cache.py) cho bộ gen, gắn với chữ ký index + OFFTARGET_PARAMS
+    (+ mốc dựng các index shard nếu có: kết quả tìm theo shard khác với index nguyên khối).
+    """
+    import offtarget_cache
+    import offtarget_shards
+    # cfd:pam: top-N cắt theo CFD đánh vị trí theo khoảng cách tới PAM của enzyme
+    params = " ".join(OFFTARGET_PARAMS) + f" top{OFFTARGET_TOP_N} cfd:pam"
+    manifest = offtarget_shards.load_manifest(fasta_path)
+    if manifest:
+        params += f" shards:{manifest['built']}"
+    return offtarget_cache.get_cache().bind(genome_id, bowtie_local_prefix(fasta_path), params)
+
+
+def merge_regions(regions):
+    """Gộp các khoảng [start, end) chồng lấn / liền kề."""
+    merged = []
+    for start, end in sorted(regions):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [(s, e) for s, e in merged]
+
+
+def cds_target_regions(cds_intervals, strand, window_start, first_exons=None, cds_percent=None):
+    """
+    Đổi tọa độ CDS (1-based, đóng) của gen -> vùng quét [start, end) 0-based trên cửa sổ trình tự
+    bắt đầu tại window_start (1-based).
+    first_exons: chỉ N đoạn CDS đầu tiên; cds_percent: chỉ N% đầu của CDS (theo chiều đọc của gen).
+    """
+    ordered = sorted(cds_intervals, reverse=(strand == '-'))
+    if first_exons:
+        ordered = ordered[:first_exons]
+
+    if cds_percent is not None:
+        budget = sum(e - s + 1 for s, e in ordered) * cds_percent / 100.0
+        trimmed = []
+        for s, e in ordered:
+            if budget <= 0:
+                break
+            take = min(e - s + 1, int(round(budget)))
+            if take > 0:
+                trimmed.append((s, s + take - 1) if strand != '-' else (e - take + 1, e))
+            budget -= take
+        ordered = trimmed
+
+    return [(s - window_start, e - window_start + 1) for s, e in ordered]
 
-            context_seq = seq_upper[context_start:context_end]
-            guide_seq = seq_upper[guide_start:pam_start]
 
-            candidates.append({
-                "guide_seq": guide_seq,
-                "pam": match.group(1),
-                "start": guide_start,
-                "end": pam_start + 3,
-                "context_30bp": context_seq
-            })
+class CrisporEngine:
+    def __init__(self, genome_index_path, offtarget_cache=None, shards=None):
+        self.genome_index = genome_index_path
+        # offtarget_cache.BoundOffTargetCache (tùy chọn): tra trước khi gọi Bowtie2
+        self.offtarget_cache = offtarget_cache
+        # Các index con theo nhóm NST (offtarget_shards.py): tìm song song rồi gộp top-N theo CFD
+        self.shards = shards or None
+
+    def find_candidates(self, sequence, regions=None, variants=None, enzymes=None):
+        """
+        Bước 1: Tìm PAM trên CẢ HAI mạch (mặc định SpCas9 NGG).
+        Mạch - được quét trên trình tự bổ sung ngược; start/end luôn là tọa độ trên mạch +.
+        enzymes: tuple Enzyme (pam_scanner.parse_enzymes) - mọi PAM được tìm trong cùng 1 lượt quét.
+
+        regions: [(start, end), ...] 0-based trên `sequence` (VD: các exon mã hóa).
+        Chỉ quét các cửa sổ quanh những vùng này và giữ guide có vị trí cắt nằm trong vùng
+        -> khối lượng công việc tỉ lệ với độ dài vùng quét, không phải cả gen.
+        variants: VariantWindow (variant_index.py) của đoạn trình tự -> mỗi guide có thêm 'variants'
+        (số SNP/indel trên spacer + PAM), tra 1 lần cho cả lô.
+        """
+        seq_upper = sequence.upper()
+        if regions is None:
+            candidates = self._scan_window(seq_upper, 0, enzymes)
+        else:
+            candidates = []
+            for r_start, r_end in merge_regions(regions):
+                w_start = max(0, r_start - SCAN_PADDING)
+                w_end = min(len(seq_upper), r_end + SCAN_PADDING)
+                for cand in self._scan_window(seq_upper[w_start:w_end], w_start, enzymes):
+                    if r_start <= cand['cut_site'] < r_end:
+                        candidates.append(cand)
+
+        if variants is not None and candidates:
+            counts = variants.count([c['start'] for c in candidates], [c['end'] for c in candidates])
+            for cand, n in zip(candidates, counts.tolist()):
+                cand['variants'] = n
+        return candidates
+
+    def _scan_window(self, window, offset, enzymes=None):
+        """Quét 1 đoạn trình tự (đã upper), tọa độ trả về cộng thêm offset."""
+        candidates = pam_scanner.scan_sites(window, enzymes)
+        for cand in candidates:
+            cand['start'] += offset
+            cand['end'] += offset
+            cand['cut_site'] += offset
+            if cand['enzyme'] == 'spcas9':
+                # Ngữ cảnh 30bp (4bp trước + 20bp guide + 3bp PAM + 3bp sau) - format bắt buộc của Doench
+                cand['context_30bp'] = cand.pop('context')
         return candidates
 
     def calculate_efficiency_score(self, context_30bp):
@@ -213,6 +521,7 @@ class CrisporEngine:
             # Cấu trúc SAM: [0]QNAME [1]FLAG [2]RNAME(Chrom) [3]POS ... [11+]TAGS
             chrom = parts[2]
             pos = parts[3]
+            strand = '-' if int(parts[1]) & 16 else '+'
 
             # Tìm các thẻ quan trọng trong phần Tags (từ cột 11 trở đi)
             # NM:i:x -> Số lượng mismatches (lỗi sai)
@@ -230,13 +539,97 @@ class CrisporEngine:
                 "seq": original_seq,  # Thực tế gRNA vẫn là nó
                 "chrom": chrom,
                 "position": pos,
+                "strand": strand,
                 "mismatches": mismatches,
                 "md": md_str  # Lưu cái này để sau này tính CFD chính xác
             })
 
         return off_targets
 
-    def calculate_specificity_score(self, guide_seq, off_targets):
+    def search_off_targets_batch(self, guides, batch_size=OFFTARGET_BATCH_SIZE, failed=None, enzymes=None):
+        """
+        Tìm off-target cho nhiều guide: tra cache theo lô trước, guide chưa có mới đi Bowtie2
+        theo lô (mỗi lần tối đa batch_size guide, truyền bằng -c dạng danh sách phân tách dấu phẩy).
+        Trả về {guide_seq: [off-target]}. Guide không tìm được (Bowtie2 lỗi / thiếu index) vẫn là []
+        như trước; truyền failed (set) để biết những guide đó.
+        enzymes: {guide_seq: Enzyme} (xem guide_enzymes) để tính CFD đúng phía PAM; thiếu -> SpCas9.
+        """
+        guides = list(dict.fromkeys(guides))
+        found = {g: [] for g in guides}
+        misses = guides
+        if self.offtarget_cache is not None and guides:
+            cached = self.offtarget_cache.get_many(guides)
+            found.update(cached)
+            misses = [g for g in guides if g not in cached]
+
+        for i in range(0, len(misses), batch_size):
+            aligned = self._align_sharded(misses[i:i + batch_size], enzymes)
+            if aligned is None:
+                # Bowtie2 không chạy được: không cache kết quả rỗng
+                if failed is not None:
+                    failed.update(misses[i:])
+                break
+            found.update(aligned)
+            if self.offtarget_cache is not None:
+                self.offtarget_cache.put_many(aligned)
+        return found
+
+    def _align_sharded(self, chunk, enzymes=None):
+        """
+        Căn chỉnh 1 lô trên mọi shard song song (mỗi shard 1 process Bowtie2), gộp hit theo guide
+        và giữ top OFFTARGET_TOP_N theo CFD toàn cục -> không phụ thuộc thứ tự tìm của -k.
+        Không có shard -> index nguyên khối như cũ.
+        """
+        indexes = self.shards or [self.genome_index]
+        if len(indexes) == 1:
+            per_shard = [self._align_batch(chunk, indexes[0])]
+        else:
+            with ThreadPoolExecutor(max_workers=min(len(indexes), OFFTARGET_SHARD_WORKERS)) as pool:
+                per_shard = list(pool.map(lambda index: self._align_batch(chunk, index), indexes))
+        if any(part is None for part in per_shard):
+            return None
+
+        merged = {}
+        for guide in chunk:
+            hits = [ot for part in per_shard for ot in part.get(guide, [])]
+            enzyme = enzymes.get(guide) if enzymes else None
+            for ot in hits:
+                ot['cfd'] = self.calculate_cfd(guide, ot, enzyme)
+            hits.sort(key=lambda ot: -ot['cfd'])
+            merged[guide] = hits[:OFFTARGET_TOP_N]
+        return merged
+
+    def _align_batch(self, chunk, index=None):
+        """1 lần gọi Bowtie2 cho cả lô. Bowtie2 đặt tên read theo thứ tự (0, 1, ...) -> ghép lại đúng guide."""
+        cmd = [
+            "wsl", "bowtie2",
+            "-x", index or self.genome_index,
+            "-c", ",".join(chunk),
+            *OFFTARGET_PARAMS,
+            "--no-unal", "--no-hd"
+        ]
+        try:
+            process = subprocess.run(cmd, capture_output=True, text=True)
+        except FileNotFoundError:
+            print("❌ Lỗi: Không tìm thấy lệnh 'wsl'. Bạn có đang chạy trên Windows không?")
+            return None
+        except Exception as e:
+            print(f"❌ Lỗi hệ thống: {str(e)}")
+            return None
+        if process.returncode != 0:
+            print(f"⚠️ Lỗi Bowtie2: {process.stderr}")
+            return None
+
+        by_read = {}
+        for line in process.stdout.splitlines():
+            name = line.split('\t', 1)[0]
+            by_read.setdefault(name, []).append(line)
+        return {
+            guide: self._parse_sam_output("\n".join(by_read[str(idx)]), guide) if str(idx) in by_read else []
+            for idx, guide in enumerate(chunk)
+        }
+
+    def calculate_specificity_score(self, guide_seq, off_targets, enzyme=None):
         """
         Tính điểm CFD chuẩn theo Doench 2016.
         Score = 100 / (1 + Tổng xác suất cắt của các off-target)
@@ -246,23 +639,8 @@ class CrisporEngine:
         for ot in off_targets:
             if ot['mismatches'] == 0: continue  # Bỏ qua chính nó (On-target)
 
-            # 1. Lấy chi tiết các lỗi sai: Vị trí nào? RNA là gì? DNA là gì?
-            md_str = ot.get('md', '')
-            errors = self._get_mismatch_details(md_str, guide_seq)
-
-            # 2. Tính xác suất cắt (Cutting Probability) của Off-target này
-            # Theo Doench 2016: Nếu có nhiều lỗi, nhân các xác suất lại với nhau
-            # [cite: 955, 956]
-            current_ot_prob = 1.0
-
-            for pos, rna, dna in errors:
-                # Gọi hàm get_cfd_weight ta đã viết ở bài trước
-                # Hàm này sẽ tra bảng CFD_SCORES['rA:dG'][pos]
-                weight = get_cfd_weight(rna, dna, pos)
-                current_ot_prob *= weight
-
             # Cộng dồn vào tổng nguy cơ
-            aggregate_cfd_score += current_ot_prob
+            aggregate_cfd_score += ot['cfd'] if 'cfd' in ot else self.calculate_cfd(guide_seq, ot, enzyme)
 
         # 3. Công thức chuẩn hóa về thang 100 [cite: 593]
         # aggregate_cfd_score càng cao -> Score càng thấp (Càng nguy hiểm)
@@ -270,56 +648,54 @@ class CrisporEngine:
 
         return round(specificity, 2)
 
-    def _get_mismatch_positions(self, md_str):
+    def calculate_cfd(self, guide_seq, ot, enzyme=None):
+        """
+        Xác suất cắt (CFD) của 1 off-target: tích trọng số các vị trí sai (1.0 = khớp hoàn toàn).
+        enzyme (pam_scanner.Enzyme, mặc định SpCas9): vị trí sai được tra bảng theo khoảng cách tới PAM (cfd_position).
+        """
+        # 1. Lấy chi tiết các lỗi sai: Vị trí nào? RNA là gì? DNA là gì?
+        errors = self._get_mismatch_details(ot.get('md', ''), guide_seq, ot.get('strand', '+'))
+
+        # 2. Theo Doench 2016: Nếu có nhiều lỗi, nhân các xác suất lại với nhau
+        # [cite: 955, 956]
+        current_ot_prob = 1.0
+        n = len(guide_seq)
+        for pos, rna, dna in errors:
+            # Hàm này sẽ tra bảng CFD_SCORES['rA:dG'][pos]
+            current_ot_prob *= get_cfd_weight(rna, dna, cfd_position(pos, n, enzyme))
+        return current_ot_prob
+
+    def _get_mismatch_details(self, md_str, guide_seq, strand='+'):
         """
-        Dịch chuỗi MD của Bowtie2 (VD: '10A5C3') ra danh sách vị trí lỗi.
-        MD:Z:10A5C3 nghĩa là: 10 đúng -> 1 sai (A) -> 5 đúng -> 1 sai (C) -> 3 đúng.
-        Vị trí lỗi (0-based) sẽ là: 10, 16.
+        Chuỗi MD -> [(vị trí 1-based trên guide, base RNA, base DNA)] để tra bảng CFD.
+        MD luôn đọc theo mạch + của tham chiếu: hit mạch - thì vị trí bị đảo và base tham chiếu
+        đã là base mạch đích (không cần lấy bổ sung).
         """
         if not md_str: return []
 
-        positions = []
+        details = []
         current_pos = 0
-
-        # Dùng Regex để tách số và chữ
-        # (\d+) là số lượng match, ([A-Z]|\^[A-Z]+) là mismatch hoặc deletion
-        import re
-        tokens = re.findall(r'(\d+)|([A-Z]|\^[A-Z]+)', md_str)
-
-        for match_len, mismatch_char in tokens:
+        n = len(guide_seq)
+        for match_len, mismatch_char in re.findall(r'(\d+)|([A-Z]|\^[A-Z]+)', md_str):
             if match_len:
                 current_pos += int(match_len)
-            elif mismatch_char:
-                # Đây là một vị trí lỗi
-                positions.append(current_pos + 1)  # Lưu 1-based index (1-20)
-                current_pos += 1  # Nhảy qua ký tự lỗi
-
-        return positions
-
+            elif mismatch_char.startswith('^'):
+                continue  # Deletion trên read: không có base đối diện trong guide
+            else:
+                if strand == '-':
+                    pos = n - current_pos
+                    dna = mismatch_char
+                else:
+                    pos = current_pos + 1
+                    dna = complement(mismatch_char)
+                if 1 <= pos <= n:
+                    details.append((pos, guide_seq[pos - 1], dna))
+                current_pos += 1
+        return details
 
     def design_primers(self, sequence_template, target_start):
-        """Bước 5: Primer3 (Giữ nguyên)"""
-        try:
-            res = primer3.bindings.designPrimers(
-                {
-                    'SEQUENCE_ID': 'crispr',
-                    'SEQUENCE_TEMPLATE': sequence_template,
-                    'SEQUENCE_TARGET': [target_start - 5, 30]
-                },
-                {
-                    'PRIMER_OPT_SIZE': 20,
-                    'PRIMER_PRODUCT_SIZE_RANGE': [[150, 300]],
-                    'PRIMER_MIN_TM': 57.0,
-                    'PRIMER_MAX_TM': 63.0
-                }
-            )
-            return {
-                "left": res.get('PRIMER_LEFT_0_SEQUENCE', 'N/A'),
-                "right": res.get('PRIMER_RIGHT_0_SEQUENCE', 'N/A'),
-                "product_size": res.get('PRIMER_PAIR_0_PRODUCT_SIZE', 0)
-            }
-        except:
-            return {"left": "N/A", "right": "N/A", "error": "Primer Error"}
+        """Bước 5: Primer3 trên template cục bộ quanh target (xem design_primers_batch)"""
+        return design_primers_batch(sequence_template, [target_start], workers=1)[0]
 
     def calculate_gc_content(self, sequence):
         """Tính phần trăm G và C trong chuỗi"""
@@ -329,40 +705,306 @@ class CrisporEngine:
         return round((g_count + c_count) / len(sequence) * 100, 2)
 
 
-def run_crispor_analysis(full_sequence, genome_index_path):
+def passes_basic_filters(guide_seq, gc_val, min_gc=CRISPOR_MIN_GC, max_gc=CRISPOR_MAX_GC):
+    """Tầng 0 (gần như miễn phí): loại guide có N, TTTT (tín hiệu kết thúc Pol III) hoặc GC ngoài ngưỡng."""
+    if 'N' in guide_seq or 'TTTT' in guide_seq:
+        return False
+    return min_gc <= gc_val <= max_gc
+
+
+def run_crispor_analysis(full_sequence, genome_index_path, regions=None, top_k=CRISPOR_TOP_K,
+                         min_gc=CRISPOR_MIN_GC, max_gc=CRISPOR_MAX_GC,
+                         min_efficiency=CRISPOR_MIN_EFFICIENCY, pool_factor=CRISPOR_POOL_FACTOR,
+                         genome_reader=None, kmer_tables=None, max_copies=CRISPOR_MAX_COPIES,
+                         offtarget_cache=None, shards=None, variants=None, drop_variants=False,
+                         enzymes=None, stats=None, failed=None):
+    """
+    Pipeline nhiều tầng, chi phí tỉ lệ với top_k chứ không với số vị trí PAM:
+      1. Lọc rẻ (N, poly-T, GC, số bản sao qua bảng k-mer nếu có) + điểm Doench -> heap giới hạn top_k * pool_factor guide hiệu quả nhất
+      2. Off-target (Bowtie2) + CFD chỉ cho các guide trong heap
+      3. Primer3 chỉ cho top_k guide cuối cùng
+      4. (genome_reader) Kiểm tra amplicon off-target của mọi cặp mồi trong 1 lượt quét bộ gen, xếp lại
+    offtarget_cache: BoundOffTargetCache (offtarget_cache.py) - guide đã căn chỉnh không gọi lại Bowtie2.
+    shards: index Bowtie2 con theo nhóm NST (offtarget_shards.load_shards) - tìm off-target song song.
+    variants: VariantWindow của full_sequence - guide được gắn số biến thể; drop_variants=True thì loại luôn.
+    enzymes: tuple Enzyme (pam_scanner.parse_enzymes), mặc định SpCas9 - quét mọi PAM trong 1 lượt.
+    stats: dict (tùy chọn) nhận số lượng ở mỗi tầng.
+    failed: set (tùy chọn) nhận các guide không tìm được off-target (Bowtie2 lỗi / thiếu index);
+    các guide đó có specificity_cfd = None thay vì 100.
+    """
 
     # Khởi tạo Engine với đường dẫn động được truyền vào
-    engine = CrisporEngine(genome_index_path=genome_index_path)
-
-    candidates = engine.find_candidates(full_sequence)
-    results = []
+    engine = CrisporEngine(genome_index_path=genome_index_path, offtarget_cache=offtarget_cache, shards=shards)
 
+    candidates = engine.find_candidates(full_sequence, regions=regions, variants=variants, enzymes=enzymes)
+    total = len(candidates)
+    variant_overlap = sum(1 for c in candidates if c.get('variants'))
+    if drop_variants:
+        candidates = [c for c in candidates if not c.get('variants')]
     for cand in candidates:
-        eff = engine.calculate_efficiency_score(cand['context_30bp'])
-
-        # Bowtie2 sẽ dùng genome_index_path để tìm đúng bộ gen cần so sánh
-        ot = engine.search_off_targets(cand['guide_seq'])
-
-        spec = engine.calculate_specificity_score(cand['guide_seq'], ot)
-        prim = engine.design_primers(full_sequence, cand['start'])
-
+        cand['template'] = 0
+
+    results = _tiered_pipeline(
+        engine, candidates, [full_sequence], top_k=top_k, min_gc=min_gc, max_gc=max_gc,
+        min_efficiency=min_efficiency, pool_factor=pool_factor, genome_reader=genome_reader,
+        kmer_tables=kmer_tables, max_copies=max_copies, stats=stats, failed=failed
+    )
+    if stats is not None and variants is not None:
+        stats.update({"candidates": total, "variant_overlap": variant_overlap})
+    return results
+
+
+def run_multi_target_analysis(targets, genome_index_path, require_all=False, top_k=CRISPOR_TOP_K,
+                              min_gc=CRISPOR_MIN_GC, max_gc=CRISPOR_MAX_GC,
+                              min_efficiency=CRISPOR_MIN_EFFICIENCY, pool_factor=CRISPOR_POOL_FACTOR,
+                              genome_reader=None, kmer_tables=None, max_copies=CRISPOR_MAX_COPIES,
+                              offtarget_cache=None, shards=None, drop_variants=False, enzymes=None,
+                              stats=None, failed=None):
+    """
+    Chế độ đa đích cho họ gen / các alen homeolog.
+    targets: list (tên, trình tự, regions[, VariantWindow]). Guide giống hệt nhau giữa các đích được gộp lại ->
+    mỗi guide duy nhất chỉ được chấm điểm, tìm off-target và thiết kế mồi 1 lần.
+    Kết quả có thêm 'targets' (các đích guide cắt được), 'hits' (vị trí trên từng đích), 'covers_all'.
+    require_all=True: chỉ giữ guide cắt được mọi đích.
+    Với bảng k-mer, mỗi vị trí trên các đích được tính là bản sao hợp lệ (không bị loại vì đa bản sao).
+    Với index biến thể, mỗi vị trí có thêm 'variants'; drop_variants=True: vị trí nằm trên SNP/indel
+    không tính là cắt được đích đó.
+    """
+    engine = CrisporEngine(genome_index_path=genome_index_path, offtarget_cache=offtarget_cache, shards=shards)
+
+    unique = {}
+    total = variant_overlap = 0
+    for t_idx, (name, sequence, regions, *window) in enumerate(targets):
+        for cand in engine.find_candidates(sequence, regions=regions, variants=window[0] if window else None,
+                                           enzymes=enzymes):
+            total += 1
+            if cand.get('variants'):
+                variant_overlap += 1
+                if drop_variants:
+                    continue
+            hit = {"target": name, "strand": cand['strand'], "location": f"{cand['start']}-{cand['end']}"}
+            if 'variants' in cand:
+                hit['variants'] = cand['variants']
+            key = (cand['enzyme'], cand['guide_seq'])  # Cùng spacer nhưng khác enzyme là guide khác
+            entry = unique.get(key)
+            if entry is None:
+                # Lần xuất hiện đầu tiên làm đại diện (ngữ cảnh Doench + template thiết kế mồi)
+                cand['template'] = t_idx
+                cand['hits'] = [hit]
+                cand['targets'] = {name: None}
+                unique[key] = cand
+            else:
+                entry['hits'].append(hit)
+                entry['targets'][name] = None
+                if 'variants' in cand:
+                    entry['variants'] = max(entry.get('variants', 0), cand['variants'])
+
+    candidates = list(unique.values())
+    n_targets = len({t[0] for t in targets})  # c['targets'] theo tên: đích trùng tên chỉ tính 1 lần
+    if require_all:
+        candidates = [c for c in candidates if len(c['targets']) == n_targets]
+
+    results = _tiered_pipeline(
+        engine, candidates, [t[1] for t in targets], top_k=top_k, min_gc=min_gc, max_gc=max_gc,
+        min_efficiency=min_efficiency, pool_factor=pool_factor, genome_reader=genome_reader,
+        kmer_tables=kmer_tables, max_copies=max_copies, stats=stats, failed=failed
+    )
+    for r in results:
+        r['covers_all'] = len(r['targets']) == n_targets
+
+    if stats is not None:
+        stats.update({"candidates": total, "unique_guides": len(unique)})
+        if any(len(t) > 3 and t[3] is not None for t in targets):
+            stats["variant_overlap"] = variant_overlap
+    return results
+
+
+def _tiered_pipeline(engine, candidates, templates, top_k, min_gc, max_gc, min_efficiency, pool_factor,
+                     genome_reader, kmer_tables, max_copies, stats, failed=None):
+    """Các tầng chung của run_crispor_analysis / run_multi_target_analysis (xem docstring ở trên)."""
+    pool, counts = prefilter_candidates(engine, candidates, top_k, min_gc, max_gc, min_efficiency,
+                                        pool_factor, kmer_tables, max_copies)
+
+    # Tầng 2: off-target chỉ cho guide còn lại trong heap (1 lượt tra cache + Bowtie2 theo lô)
+    # Bowtie2 sẽ dùng genome_index_path để tìm đúng bộ gen cần so sánh
+    if failed is None:
+        failed = set()
+    off_targets = engine.search_off_targets_batch([item[2]['guide_seq'] for item in pool],
+                                                  failed=failed, enzymes=guide_enzymes(pool))
+
+    results = finalize_guides(engine, pool, off_targets, templates, top_k, genome_reader, failed)
+
+    if stats is not None:
+        stats.update({
+            "candidates": len(candidates),
+            **counts,
+            "off_target_searched": len(pool),
+            "returned": len(results),
+        })
+    return results
+
+
+def prefilter_candidates(engine, candidates, top_k, min_gc=CRISPOR_MIN_GC, max_gc=CRISPOR_MAX_GC,
+                         min_efficiency=CRISPOR_MIN_EFFICIENCY, pool_factor=CRISPOR_POOL_FACTOR,
+                         kmer_tables=None, max_copies=CRISPOR_MAX_COPIES):
+    """
+    Tầng 1 (chỉ CPU, không gọi công cụ ngoài): lọc rẻ + điểm hiệu quả theo mô hình của enzyme
+    (score_efficiency, chấm theo lô) -> heap min theo hiệu quả, kích thước cố định top_k * pool_factor
+    -> O(n log pool). Mỗi enzyme 1 heap riêng (điểm không so được giữa các enzyme).
+    Enzyme không có mô hình chạy được: không lọc theo hiệu quả, xếp như điểm 0 (cand['efficiency_model'] = None).
+    Trả về (pool [(eff, -i, cand, gc)], {passed_filters, multi_copy}).
+    """
+    pool_size = max(top_k, top_k * pool_factor)
+    by_enzyme = {}  # enzyme -> [(i, cand, gc)] đã qua lọc rẻ
+    passed = multi_copy = 0
+    for i, cand in enumerate(candidates):
         gc_val = engine.calculate_gc_content(cand['guide_seq'])
+        if not passes_basic_filters(cand['guide_seq'], gc_val, min_gc, max_gc):
+            continue
+        if kmer_tables is not None and 'context_30bp' in cand:
+            # Tra bảng k-mer (binary search) thay vì Bowtie2: guide nhiều bản sao bị loại ngay
+            # (bảng chỉ chứa 20nt + NGG -> chỉ áp dụng cho SpCas9)
+            cand['genome_copies'] = kmer_tables.occurrences(cand['guide_seq'])
+            # Chế độ đa đích: mỗi vị trí trên các đích là 1 bản sao hợp lệ
+            allowed = max_copies + max(0, len(cand.get('hits', ())) - 1)
+            if cand['genome_copies'] > allowed:
+                multi_copy += 1
+                continue
+            cand['seed_hits'] = kmer_tables.seed_hits(cand['guide_seq'])
+        by_enzyme.setdefault(cand.get('enzyme', 'spcas9'), []).append((i, cand, gc_val))
+
+    pool = []
+    for name, items in by_enzyme.items():
+        model, effs = score_efficiency(engine, pam_scanner.get_enzyme(name),
+                                       [c.get('context_30bp') or c['context'] for _, c, _ in items])
+        heap = []
+        for k, (i, cand, gc_val) in enumerate(items):
+            cand['efficiency_model'] = model
+            eff = 0
+            if model is not None:
+                eff = effs[k]
+                if eff < min_efficiency:
+                    continue
+            passed += 1
+            item = (eff, -i, cand, gc_val)  # -i: hòa điểm thì giữ guide xuất hiện trước
+            if len(heap) < pool_size:
+                heapq.heappush(heap, item)
+            elif item > heap[0]:
+                heapq.heapreplace(heap, item)
+        pool.extend(heap)
+    return pool, {"passed_filters": passed, "multi_copy": multi_copy}
+
+
+def guide_enzymes(pool):
+    """{guide_seq: Enzyme} của các guide trong heap (truyền cho search_off_targets_batch)."""
+    return {item[2]['guide_seq']: pam_scanner.get_enzyme(item[2].get('enzyme', 'spcas9')) for item in pool}
+
+
+def finalize_guides(engine, pool, off_targets, templates, top_k, genome_reader=None, failed=None):
+    """
+    Tầng 2-4: CFD từ off-target đã tìm (off_targets: guide_seq -> list), chọn top_k (cho mỗi enzyme),
+    Primer3 theo lô (mỗi template 1 lô), kiểm tra mồi trên bộ gen nếu có genome_reader.
+    failed: guide không tìm được off-target -> specificity_cfd / off_targets_count = None (không phải 100 / 0).
+    """
+    failed = failed or set()
+    scored = []
+    for eff, neg_i, cand, gc_val in pool:
+        ot = off_targets.get(cand['guide_seq'], [])
+        enzyme = pam_scanner.get_enzyme(cand.get('enzyme', 'spcas9'))
+        for hit in ot:
+            if 'cfd' not in hit:  # Hit từ cache chưa có CFD
+                hit['cfd'] = engine.calculate_cfd(cand['guide_seq'], hit, enzyme)
+        spec = engine.calculate_specificity_score(cand['guide_seq'], ot, enzyme)
+        scored.append((spec, eff, neg_i, cand, gc_val, ot))
+
+    # Tầng 3: Primer3 chỉ cho top_k cuối cùng (của từng enzyme, giữ thứ tự enzyme như lúc quét)
+    by_enzyme = {}
+    for item in scored:
+        by_enzyme.setdefault(item[3].get('enzyme'), []).append(item)
+    top = [item for group in by_enzyme.values()
+           for item in heapq.nlargest(top_k, group, key=lambda x: (x[0], x[1], x[2]))]
+    primers = [None] * len(top)
+    by_template = {}
+    for pos, item in enumerate(top):
+        by_template.setdefault(item[3]['template'], []).append(pos)
+    for t_idx, positions in by_template.items():
+        designed = design_primers_batch(templates[t_idx], [top[pos][3]['start'] for pos in positions])
+        for pos, prim in zip(positions, designed):
+            primers[pos] = prim
+
+    results = []
+    for (spec, eff, _, cand, gc_val, ot), prim in zip(top, primers):
 
         results.append({
             "sequence": cand['guide_seq'],
+            "enzyme": cand.get('enzyme', 'spcas9'),
             "pam": cand['pam'],
+            "strand": cand['strand'],
             "location": f"{cand['start']}-{cand['end']}",
             "gc_content": gc_val,
             "scores": {
-                "efficiency_doench": eff,
-                "specificity_cfd": spec
+                "efficiency_doench": eff if cand.get('efficiency_model') == "doench" else None,
+                # Điểm của mô hình hiệu quả đã dùng cho enzyme này (None: chưa có mô hình chạy được)
+                "efficiency": eff if cand.get('efficiency_model') else None,
+                "efficiency_model": cand.get('efficiency_model'),
+                "specificity_cfd": None if cand['guide_seq'] in failed else spec
             },
-            "off_targets_count": len(ot),
+            "off_targets_count": None if cand['guide_seq'] in failed else len(ot),
+            # Từng hit (gene_annotation.annotate_guides gắn thêm gen / loại vùng / khoảng cách)
+            "off_targets": [
+                {"chrom": h['chrom'], "position": int(h['position']), "strand": h.get('strand', '+'),
+                 "mismatches": h['mismatches'], "cfd": round(h['cfd'], 4)}
+                for h in ot
+            ],
             "primers": prim
         })
-
-    results.sort(key=lambda x: (
-        -x['scores']['specificity_cfd'],
-        -x['scores']['efficiency_doench']
-    ))
-    return results
\ No newline at end of file
+        if 'genome_copies' in cand:
+            results[-1]["genome_copies"] = cand['genome_copies']
+            results[-1]["seed_hits"] = cand['seed_hits']
+        if 'variants' in cand:
+            results[-1]["variants"] = cand['variants']
+        if 'hits' in cand:
+            results[-1]["targets"] = list(cand['targets'])
+            results[-1]["hits"] = cand['hits']
+
+    if genome_reader is not None and results:
+        primer_specificity.rerank_by_primer_specificity(results, genome_reader)
+    return results
+
+
+def summarize_conservation(engine, guides, kmer_tables=None, max_hits=CONSERVATION_MAX_HITS):
+    """
+    Tóm tắt 1 bộ gen cho cả tập guide (1 lượt tra cache + Bowtie2 theo lô): số vị trí khớp hoàn toàn,
+    số off-target, điểm CFD và các hit nguy hiểm nhất (khớp hoàn toàn trước, rồi theo CFD).
+    Trả về {guide: summary}; guide không quét được -> {"status": "error", ...} (KHÔNG phải 0 vị trí khớp).
+    """
+    failed = set()
+    found = engine.search_off_targets_batch(list(guides), failed=failed)
+    summaries = {}
+    for guide in guides:
+        if guide in failed:
+            summaries[guide] = {"status": "error", "error": "Không tìm được off-target (Bowtie2 lỗi hoặc thiếu index)"}
+            continue
+        hits = found.get(guide, [])
+        for hit in hits:
+            if 'cfd' not in hit:
+                hit['cfd'] = engine.calculate_cfd(guide, hit)
+        exact = sum(1 for hit in hits if hit['mismatches'] == 0)
+        ranked = sorted(hits, key=lambda h: (h['mismatches'] != 0, -h['cfd']))[:max_hits]
+        summary = {
+            "status": "ok",
+            "exact_matches": exact,
+            "off_targets_count": len(hits) - exact,
+            "specificity_cfd": engine.calculate_specificity_score(guide, hits),
+            "hits": [
+                {"chrom": h['chrom'], "position": int(h['position']), "strand": h.get('strand', '+'),
+                 "mismatches": h['mismatches'], "cfd": round(h['cfd'], 4)}
+                for h in ranked
+            ],
+        }
+        if kmer_tables is not None:
+            # Bảng k-mer tính cả PAM NGG (Bowtie2 chỉ căn 20nt)
+            summary["genome_copies"] = kmer_tables.occurrences(guide)
+            summary["seed_hits"] = kmer_tables.seed_hits(guide)
+        summaries[guide] = summary
+    return summaries
@@ -1,5 +1,7 @@
 import re
 
+from pam_scanner import MAX_PAM_LEN, get_matcher, pam_regex
+
 
 def calculate_gc_content(sequence):
     """Tính tỷ lệ % G và C trong chuỗi"""
@@ -16,18 +18,18 @@ def find_crispr_targets(sequence: str, pam: str = "NGG", spacer_len: int = 20):
     Output: Danh sách các gRNA candidates
     """
     sequence = sequence.upper()
+    pam = pam.upper()
     targets = []
 
-    # 1. Xây dựng Regex cho PAM
-    # NGG -> [ATGC]GG
-    pam_regex = pam.replace("N", "[ATGC]")
-
-    # Tìm tất cả vị trí xuất hiện PAM (lookahead để tìm chồng lấn)
-    # (?=(...)) giúp tìm overlap matches
-    for match in re.finditer(f"(?=({pam_regex}))", sequence):
-        pam_start = match.start()
+    # 1. Tìm PAM (mã IUPAC: NGG, NNGRRT...) bằng bảng tra của pam_scanner (matcher được cache theo PAM)
+    if len(pam) <= MAX_PAM_LEN:
+        pam_starts = get_matcher([pam]).matches(sequence)[pam].tolist()
+    else:
+        # PAM dài hơn bảng tra: regex lookahead (?=...) để tìm cả các PAM chồng lấn
+        pam_starts = [m.start() for m in re.finditer(f"(?={pam_regex(pam)})", sequence)]
+    for pam_start in pam_starts:
         pam_end = pam_start + len(pam)
-        pam_seq = match.group(1)  # Lấy chuỗi PAM thực tế (vd: AGG, TGG)
+        pam_seq = sequence[pam_start:pam_end]  # Lấy chuỗi PAM thực tế (vd: AGG, TGG)
 
         # 2. Lấy Spacer (20bp trước PAM)
         spacer_start = pam_start - spacer_len
@@ -0,0 +1,357 @@
+import os
+import gzip
+import zlib
+import struct
+import bisect
+import threading
+from collections import OrderedDict, namedtuple
+
+# Dòng của file .fai (chuẩn samtools faidx):
+# NAME  LENGTH  OFFSET(byte bắt đầu trình tự)  LINEBASES  LINEWIDTH(byte, gồm \n)
+FaiRecord = namedtuple("FaiRecord", ["length", "offset", "line_bases", "line_bytes"])
+
+# Kích thước cache block BGZF đã giải nén (mỗi file)
+BGZF_CACHE_MB = int(os.getenv("GENOME_BGZF_CACHE_MB", "64"))
+
+BGZF_MAGIC = b"\x1f\x8b\x08\x04"
+
+
+# pread = đọc theo vị trí, không dùng chung con trỏ file -> nhiều thread đọc song song 1 fd.
+# Windows không có pread -> mỗi thread dùng 1 file handle riêng.
+HAS_PREAD = hasattr(os, "pread")
+
+
+def is_bgzf(path: str) -> bool:
+    """File có phải BGZF (bgzip) không: gzip header có subfield 'BC'."""
+    with open(path, "rb") as fh:
+        head = fh.read(18)
+    return len(head) == 18 and head[:4] == BGZF_MAGIC and head[12:14] == b"BC"
+
+
+def is_gzip(path: str) -> bool:
+    with open(path, "rb") as fh:
+        return fh.read(2) == b"\x1f\x8b"
+
+
+def read_fai(fai_path: str):
+    records = OrderedDict()
+    with open(fai_path) as fh:
+        for line in fh:
+            parts = line.rstrip("\n").split("\t")
+            if len(parts) < 5:
+                continue
+            records[parts[0]] = FaiRecord(int(parts[1]), int(parts[2]), int(parts[3]), int(parts[4]))
+    return records
+
+
+def build_fai(fasta_path: str, fai_path: str = None):
+    """
+    Quét FASTA (thường hoặc BGZF) và ghi .fai. Offset luôn tính trên dữ liệu ĐÃ giải nén.
+    Kiểm tra luôn định dạng: tên trùng, độ dài dòng không đồng nhất -> ValueError.
+    """
+    fai_path = fai_path or fasta_path + ".fai"
+    opener = gzip.open if is_gzip(fasta_path) else open
+    records = OrderedDict()
+
+    name = None
+    length = seq_offset = 0
+    line_bases = line_bytes = None
+    short_line_seen = False
+
+    def finish():
+        if name is not None:
+            records[name] = FaiRecord(length, seq_offset, line_bases or 0, line_bytes or 0)
+
+    offset = 0
+    with opener(fasta_path, "rb") as fh:
+        for line in fh:
+            n = len(line)
+            if line.startswith(b">"):
+                finish()
+                name = line[1:].split()[0].decode() if line[1:].strip() else ""
+                if not name or name in records:
+                    raise ValueError(f"{fasta_path}: header rỗng hoặc trùng tên '{name}'")
+                length = 0
+                seq_offset = offset + n
+                line_bases = line_bytes = None
+                short_line_seen = False
+            elif name is not None:
+                bases = len(line.rstrip(b"\r\n"))
+                if line_bases is None:
+                    line_bases, line_bytes = bases, n
+                elif bases:
+                    if short_line_seen or bases > line_bases:
+                        raise ValueError(f"{fasta_path}: độ dài dòng không đồng nhất trong '{name}'")
+                    if bases < line_bases:
+                        short_line_seen = True
+                elif line_bases:
+                    short_line_seen = True
+                length += bases
+            offset += n
+    finish()
+
+    if not records:
+        raise ValueError(f"{fasta_path}: không có bản ghi FASTA nào")
+
+    tmp_path = fai_path + ".tmp"
+    with open(tmp_path, "w") as out:
+        for rec_name, rec in records.items():
+            out.write(f"{rec_name}\t{rec.length}\t{rec.offset}\t{rec.line_bases}\t{rec.line_bytes}\n")
+    os.replace(tmp_path, fai_path)
+    return records
+
+
+def scan_bgzf_blocks(bgzf_path: str):
+    """
+    Duyệt header các block BGZF -> list (offset nén, offset giải nén) của từng block.
+    Chỉ đọc header + 4 byte ISIZE cuối block, không giải nén.
+    """
+    blocks = []
+    c_off = u_off = 0
+    with open(bgzf_path, "rb") as fh:
+        while True:
+            fh.seek(c_off)
+            head = fh.read(12)
+            if not head:
+                break
+            if len(head) < 12 or head[:4] != BGZF_MAGIC:
+                raise ValueError(f"{bgzf_path}: block BGZF hỏng tại offset {c_off}")
+            xlen = struct.unpack("<H", head[10:12])[0]
+            extra = fh.read(xlen)
+
+            bsize = None
+            pos = 0
+            while pos + 4 <= len(extra):
+                si1, si2, slen = extra[pos], extra[pos + 1], struct.unpack("<H", extra[pos + 2:pos + 4])[0]
+                if si1 == 66 and si2 == 67:  # 'B', 'C'
+                    bsize = struct.unpack("<H", extra[pos + 4:pos + 6])[0]
+                pos += 4 + slen
+            if bsize is None:
+                raise ValueError(f"{bgzf_path}: thiếu subfield BC (không phải bgzip?)")
+
+            fh.seek(c_off + bsize + 1 - 4)
+            isize = struct.unpack("<I", fh.read(4))[0]
+            if isize:
+                blocks.append((c_off, u_off))
+            c_off += bsize + 1
+            u_off += isize
+    return blocks
+
+
+def build_gzi(bgzf_path: str, gzi_path: str = None):
+    """Ghi file .gzi (chuẩn bgzip -r): số block rồi các cặp uint64 (nén, giải nén), bỏ block đầu."""
+    gzi_path = gzi_path or bgzf_path + ".gzi"
+    blocks = [b for b in scan_bgzf_blocks(bgzf_path) if b != (0, 0)]
+    tmp_path = gzi_path + ".tmp"
+    with open(tmp_path, "wb") as out:
+        out.write(struct.pack("<Q", len(blocks)))
+        for c_off, u_off in blocks:
+            out.write(struct.pack("<QQ", c_off, u_off))
+    os.replace(tmp_path, gzi_path)
+    return blocks
+
+
+def read_gzi(gzi_path: str):
+    with open(gzi_path, "rb") as fh:
+        count = struct.unpack("<Q", fh.read(8))[0]
+        data = fh.read(16 * count)
+    pairs = [struct.unpack_from("<QQ", data, i * 16) for i in range(count)]
+    return [(0, 0)] + pairs
+
+
+def _is_fresh(index_path: str, source_path: str) -> bool:
+    return os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(source_path)
+
+
+def ensure_indexes(fasta_path: str, force: bool = False):
+    """
+    Kiểm tra + dựng trước toàn bộ index cần cho truy cập ngẫu nhiên (.fai, và .gzi nếu BGZF).
+    Gọi lúc import để server khởi động không phải quét genome nhiều GB.
+    Trả về list các file index đã dựng mới.
+    """
+    if not os.path.exists(fasta_path):
+        raise FileNotFoundError(fasta_path)
+
+    built = []
+    compressed = is_gzip(fasta_path)
+    if compressed and not is_bgzf(fasta_path):
+        raise ValueError(
+            f"{fasta_path}: file gzip thường không truy cập ngẫu nhiên được. "
+            f"Hãy nén lại bằng bgzip: gunzip -c file.fa.gz | bgzip > file.bgz.fa.gz"
+        )
+
+    if compressed and (force or not _is_fresh(fasta_path + ".gzi", fasta_path)):
+        build_gzi(fasta_path)
+        built.append(fasta_path + ".gzi")
+
+    if force or not _is_fresh(fasta_path + ".fai", fasta_path):
+        build_fai(fasta_path)
+        built.append(fasta_path + ".fai")
+
+    return built
+
+
+def fai_byte_range(rec: FaiRecord, start: int, end: int):
+    """Đổi tọa độ base [start, end) (0-based) -> khoảng byte [b0, b1) trong file (gồm cả \\n)."""
+    b0 = rec.offset + (start // rec.line_bases) * rec.line_bytes + start % rec.line_bases
+    last = end - 1
+    b1 = rec.offset + (last // rec.line_bases) * rec.line_bytes + last % rec.line_bases + 1
+    return b0, b1
+
+
+def _clamp(rec: FaiRecord, start: int, end: int):
+    start = max(0, start)
+    end = min(rec.length, end)
+    return start, end
+
+
+class SequenceRecord:
+    """Giống FastaRecord của pyfaidx: record[a:b] -> str, str(record) -> toàn bộ trình tự."""
+
+    def __init__(self, reader, name):
+        self._reader = reader
+        self.name = name
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start = 0 if key.start is None else key.start
+            end = len(self) if key.stop is None else key.stop
+            return self._reader.fetch(self.name, start, end)
+        return self._reader.fetch(self.name, key, key + 1)
+
+    def __len__(self):
+        return self._reader.index[self.name].length
+
+    def __str__(self):
+        return self._reader.fetch(self.name, 0, len(self))
+
+
+class IndexedFasta:
+    """
+    FASTA thường, truy cập ngẫu nhiên qua .fai. API giống pyfaidx.Fasta (fasta[chrom][a:b]).
+
+    Khác pyfaidx (1 handle + lock quanh seek/read), mọi thread đọc song song:
+    đọc theo offset tuyệt đối bằng os.pread trên 1 fd dùng chung, hoặc handle riêng mỗi thread.
+    """
+
+    def __init__(self, path: str):
+        ensure_indexes(path)
+        self.filename = path
+        self.index = read_fai(path + ".fai")
+        self._fd = os.open(path, os.O_RDONLY | getattr(os, "O_BINARY", 0)) if HAS_PREAD else None
+        self._local = threading.local()
+        self._thread_handles = []
+        self._handles_lock = threading.Lock()
+
+    # --- API giống pyfaidx.Fasta ---
+    def keys(self):
+        return self.index.keys()
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __getitem__(self, name):
+        if name not in self.index:
+            raise KeyError(name)
+        return SequenceRecord(self, name)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        with self._handles_lock:
+            for fh in self._thread_handles:
+                fh.close()
+            self._thread_handles = []
+        self._local = threading.local()
+
+    # --- Đọc dữ liệu ---
+    def _pread(self, size: int, offset: int) -> bytes:
+        if HAS_PREAD:
+            return os.pread(self._fd, size, offset)
+
+        fh = getattr(self._local, "fh", None)
+        if fh is None:
+            fh = open(self.filename, "rb")
+            self._local.fh = fh
+            with self._handles_lock:
+                self._thread_handles.append(fh)
+        fh.seek(offset)
+        return fh.read(size)
+
+    def _read_bytes(self, b0: int, b1: int) -> bytes:
+        return self._pread(b1 - b0, b0)
+
+    def fetch(self, name: str, start: int, end: int) -> str:
+        """Trình tự [start, end) 0-based của 1 record."""
+        rec = self.index[name]
+        start, end = _clamp(rec, start, end)
+        if start >= end:
+            return ""
+        b0, b1 = fai_byte_range(rec, start, end)
+        raw = self._read_bytes(b0, b1)
+        return raw.replace(b"\n", b"").replace(b"\r", b"").decode("ascii")
+
+
+class BgzfFasta(IndexedFasta):
+    """
+    FASTA nén bgzip, truy cập ngẫu nhiên qua .fai + .gzi.
+    Các block đã giải nén được giữ trong cache LRU (theo MB) -> đọc vùng nóng gần như FASTA thường.
+    Thread-safe: đọc block theo vị trí (pread), cache có khóa riêng.
+    """
+
+    def __init__(self, path: str, cache_mb: int = BGZF_CACHE_MB):
+        super().__init__(path)
+        blocks = read_gzi(path + ".gzi")
+        self._c_offsets = [c for c, _ in blocks]
+        self._u_offsets = [u for _, u in blocks]
+        self._file_size = os.path.getsize(path)
+
+        self._cache = OrderedDict()
+        self._cache_bytes = 0
+        self._cache_limit = cache_mb * 1024 * 1024
+        self._cache_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def close(self):
+        super().close()
+        with self._cache_lock:
+            self._cache.clear()
+            self._cache_bytes = 0
+
+    # --- Đọc dữ liệu ---
+    def _block(self, i: int) -> bytes:
+        with self._cache_lock:
+            data = self._cache.get(i)
+            if data is not None:
+                self._cache.move_to_end(i)
+                self.hits += 1
+                return data
+            self.misses += 1
+
+        c_start = self._c_offsets[i]
+        c_end = self._c_offsets[i + 1] if i + 1 < len(self._c_offsets) else self._file_size
+        raw = self._pread(c_end - c_start, c_start)
+        data = zlib.decompressobj(31).decompress(raw)  # 31 = gzip wrapper, dừng ở cuối block
+
+        with self._cache_lock:
+            if i not in self._cache:
+                self._cache[i] = data
+                self._cache_bytes += len(data)
+                while self._cache_bytes > self._cache_limit and len(self._cache) > 1:
+                    _, old = self._cache.popitem(last=False)
+                    self._cache_bytes -= len(old)
+        return data
+
+    def _read_bytes(self, u0: int, u1: int) -> bytes:
+        """Khoảng byte [u0, u1) trên dữ liệu đã giải nén."""
+        parts = []
+        i = bisect.bisect_right(self._u_offsets, u0) - 1
+        while u0 < u1 and i < len(self._u_offsets):
+            block = self._block(i)
+            block_start = self._u_offsets[i]
+            parts.append(block[u0 - block_start:u1 - block_start])
+            u0 = block_start + len(block)
+            i += 1
+        return b"".join(parts)
@@ -0,0 +1,152 @@
+"""
+Chú thích hàng loạt các vị trí off-target theo danh mục gen: gen chồng lấn, loại vùng
+(CDS / UTR / exon / intron / intergenic) và khoảng cách tới gen gần nhất.
+
+Index khoảng theo từng NST dựng 1 lần từ DB (mảng NumPy sắp theo start + max(end) cộng dồn),
+giữ trong bộ nhớ theo bộ gen. Cả lô hit của 1 NST được tra bằng 1 lần searchsorted trên
+vị trí đã sắp xếp -> vài nghìn hit chỉ tốn vài ms, không có truy vấn DB nào cho từng hit.
+"""
+import os
+import threading
+from bisect import bisect_right
+from collections import OrderedDict
+
+import numpy as np
+
+import queries
+from models import unpack_intervals
+
+# Số bộ gen giữ index khoảng trong bộ nhớ (LRU)
+GENE_INDEX_CACHE = int(os.getenv("GENE_INDEX_CACHE", "4"))
+
+
+def _overlaps(intervals, start, end):
+    """intervals: [(s, e), ...] đã sắp, không chồng lấn nhau, đóng 2 đầu."""
+    i = bisect_right(intervals, (end, float("inf"))) - 1
+    return i >= 0 and intervals[i][1] >= start
+
+
+class _ChromIndex:
+    def __init__(self, genes):
+        # genes: list (gene_id, start, end, exons, cds) đã sắp theo start
+        self.ids = [g[0] for g in genes]
+        self.models = [(g[3], g[4]) for g in genes]
+        self.starts = np.array([g[1] for g in genes], dtype=np.int64)
+        self.ends = np.array([g[2] for g in genes], dtype=np.int64)
+        # max(end) của các gen [0..i] và chỉ số gen đạt max -> gen phía trước gần nhất / có chồng lấn không
+        self.max_end = np.maximum.accumulate(self.ends)
+        running = np.arange(len(genes))
+        running[1:][self.ends[1:] < self.max_end[:-1]] = -1
+        self.max_idx = np.maximum.accumulate(running)
+
+
+class GeneIntervalIndex:
+    """Index khoảng của cả bộ gen: {NST: _ChromIndex}."""
+
+    def __init__(self, rows):
+        """rows: (gene_id, chromosome, start, end, exons_blob, cds_blob) sắp theo (chromosome, start)."""
+        by_chrom = {}
+        for gene_id, chrom, start, end, exons, cds in rows:
+            by_chrom.setdefault(chrom, []).append(
+                (gene_id, start, end, unpack_intervals(exons), unpack_intervals(cds))
+            )
+        self.chroms = {chrom: _ChromIndex(genes) for chrom, genes in by_chrom.items()}
+        self.genes = sum(len(c.ids) for c in self.chroms.values())
+
+    @staticmethod
+    def _feature(model, start, end):
+        exons, cds = model
+        if not exons and not cds:
+            return "gene"  # Gen không có cấu trúc transcript trong GFF
+        if cds and _overlaps(cds, start, end):
+            return "CDS"
+        if _overlaps(exons, start, end):
+            return "UTR" if cds else "exon"
+        return "intron"
+
+    def annotate(self, hits, length=20):
+        """
+        Gắn gene / feature / nearest_gene / distance vào từng hit (dict có chrom, position 1-based).
+        Hit chiếm [position, position + length - 1]. distance = 0 nếu chồng lấn gen.
+        """
+        by_chrom = {}
+        for hit in hits:
+            by_chrom.setdefault(hit['chrom'], []).append(hit)
+
+        for chrom, group in by_chrom.items():
+            index = self.chroms.get(chrom)
+            if index is None:
+                for hit in group:
+                    hit.update(gene=None, feature="intergenic", nearest_gene=None, distance=None)
+                continue
+
+            group.sort(key=lambda h: int(h['position']))
+            hs = np.fromiter((int(h['position']) for h in group), dtype=np.int64, count=len(group))
+            he = hs + (length - 1)
+            # Gen cuối cùng có start <= cuối hit (1 lần searchsorted cho cả lô đã sắp)
+            last = np.searchsorted(index.starts, he, side="right") - 1
+            n = len(index.ids)
+
+            for hit, s, e, k in zip(group, hs.tolist(), he.tolist(), last.tolist()):
+                if k >= 0 and index.max_end[k] >= s:
+                    # Có gen chồng lấn: lùi lại tới khi max(end) cộng dồn < start của hit
+                    j = k
+                    while j >= 0 and index.max_end[j] >= s:
+                        if index.ends[j] >= s:
+                            break
+                        j -= 1
+                    hit.update(gene=index.ids[j], feature=self._feature(index.models[j], s, e),
+                               nearest_gene=index.ids[j], distance=0)
+                    continue
+
+                best, dist = None, None
+                if k >= 0:
+                    best, dist = index.ids[index.max_idx[k]], s - int(index.max_end[k])
+                if k + 1 < n:
+                    down = int(index.starts[k + 1]) - e
+                    if dist is None or down < dist:
+                        best, dist = index.ids[k + 1], down
+                hit.update(gene=None, feature="intergenic", nearest_gene=best, distance=dist)
+        return hits
+
+
+_indexes = OrderedDict()  # genome_id -> (stamp, GeneIntervalIndex)
+_indexes_lock = threading.Lock()
+_build_locks = {}
+
+
+def get_gene_index(db, genome_id: str):
+    """Index khoảng của bộ gen (dựng lần đầu, dựng lại khi danh mục gen trong DB thay đổi)."""
+    stamp = queries.gene_catalog_stamp(db, genome_id)
+    with _indexes_lock:
+        cached = _indexes.get(genome_id)
+        if cached and cached[0] == stamp:
+            _indexes.move_to_end(genome_id)
+            return cached[1]
+        build_lock = _build_locks.setdefault(genome_id, threading.Lock())
+
+    with build_lock:
+        with _indexes_lock:
+            cached = _indexes.get(genome_id)
+            if cached and cached[0] == stamp:
+                return cached[1]
+        index = GeneIntervalIndex(queries.iter_gene_models(db, genome_id))
+        print(f"🗺️ [{genome_id}] Index khoảng gen: {index.genes} gen / {len(index.chroms)} NST")
+        with _indexes_lock:
+            _indexes[genome_id] = (stamp, index)
+            while len(_indexes) > GENE_INDEX_CACHE:
+                _indexes.popitem(last=False)
+        return index
+
+
+def annotate_guides(db, genome_id: str, results):
+    """Chú thích off_targets của mọi guide trong kết quả CRISPOR bằng 1 lượt tra theo lô."""
+    by_length = {}  # Độ dài spacer khác nhau giữa các enzyme
+    for r in results:
+        by_length.setdefault(len(r['sequence']), []).extend(r.get('off_targets', ()))
+    if not any(by_length.values()):
+        return results
+    index = get_gene_index(db, genome_id)
+    for length, hits in by_length.items():
+        index.annotate(hits, length=length)
+    return results
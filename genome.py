@@ -1,32 +1,329 @@
-from pyfaidx import Fasta
+from fasta_reader import IndexedFasta, BgzfFasta, is_bgzf
+from genome_store import PackedGenome
+from kmer_index import KmerTables, kmer_dir
+from variant_index import VariantIndex, variant_dir
+from sequtils import oriented, translate
+from collections import OrderedDict
+from contextlib import contextmanager
 import os
 import re
+import threading
+
+
+# Số bộ gen được mở đồng thời (FASTA + .fai). 0 = không giới hạn
+GENOME_MAX_LOADED = int(os.getenv("GENOME_MAX_LOADED", "4"))
+# Cache vùng genomic "nóng" dùng chung cho mọi endpoint (MB, 0 = tắt)
+GENOME_CACHE_MB = int(os.getenv("GENOME_CACHE_MB", "256"))
+# Kích thước block (số base). Mọi vùng đọc được căn theo block này.
+GENOME_CACHE_BLOCK = int(os.getenv("GENOME_CACHE_BLOCK", "16384"))
+# Số transcript giữ CDS/protein đã ghép sẵn
+GENOME_SPLICE_CACHE = int(os.getenv("GENOME_SPLICE_CACHE", "20000"))
+
+
+class SequenceBlockCache:
+    """
+    Cache LRU kích thước cố định cho trình tự genomic đã giải mã, căn theo block.
+    Key = (genome_id, chrom, số thứ tự block). Các request chồng lấn nhau
+    (genomic + flank của cùng 1 gen, cửa sổ ±100bp của CRISPOR...) dùng chung block.
+    """
+
+    def __init__(self, capacity_mb: int = GENOME_CACHE_MB, block_size: int = GENOME_CACHE_BLOCK):
+        self.capacity = capacity_mb * 1024 * 1024
+        self.block_size = block_size
+        self._blocks = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _get(self, key):
+        with self._lock:
+            block = self._blocks.get(key)
+            if block is None:
+                self.misses += 1
+                return None
+            self._blocks.move_to_end(key)
+            self.hits += 1
+            return block
+
+    def _put(self, key, block):
+        if not self.capacity:
+            return
+        with self._lock:
+            if key in self._blocks:
+                return
+            self._blocks[key] = block
+            self._size += len(block)
+            while self._size > self.capacity and self._blocks:
+                _, old = self._blocks.popitem(last=False)
+                self._size -= len(old)
+
+    def fetch(self, genome_id, chrom, start, end, chrom_len, read_func):
+        """
+        Trình tự [start, end) 0-based. read_func(s, e) đọc thật từ file khi block chưa có trong cache;
+        các block thiếu liền nhau được đọc gộp 1 lần.
+        """
+        start, end = max(0, start), min(end, chrom_len)
+        if start >= end:
+            return ""
+
+        bs = self.block_size
+        first, last = start // bs, (end - 1) // bs
+        blocks = {}
+        missing = []
+        for b in range(first, last + 1):
+            block = self._get((genome_id, chrom, b))
+            if block is None:
+                missing.append(b)
+            else:
+                blocks[b] = block
+
+        # Gộp các block thiếu liên tiếp thành 1 lần đọc
+        run_start = None
+        for i, b in enumerate(missing):
+            if run_start is None:
+                run_start = b
+            if i + 1 == len(missing) or missing[i + 1] != b + 1:
+                raw = read_func(run_start * bs, min((b + 1) * bs, chrom_len))
+                for rb in range(run_start, b + 1):
+                    block = raw[(rb - run_start) * bs:(rb - run_start + 1) * bs]
+                    blocks[rb] = block
+                    self._put((genome_id, chrom, rb), block)
+                run_start = None
+
+        joined = "".join(blocks[b] for b in range(first, last + 1))
+        offset = first * bs
+        return joined[start - offset:end - offset]
+
+    def clear(self):
+        with self._lock:
+            self._blocks.clear()
+            self._size = 0
+
+    def discard(self, genome_id):
+        """Bỏ mọi block của 1 bộ gen (file FASTA đã bị thay)."""
+        with self._lock:
+            for key in [k for k in self._blocks if k[0] == genome_id]:
+                self._size -= len(self._blocks.pop(key))
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "capacity_mb": self.capacity // (1024 * 1024),
+                "used_mb": round(self._size / (1024 * 1024), 2),
+                "blocks": len(self._blocks),
+                "block_size": self.block_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            }
 
 
 class GenomeManager:
-    def __init__(self):
-        self.datasets = {}
+    def __init__(self, max_loaded: int = GENOME_MAX_LOADED):
+        # genome_id -> đường dẫn file (đăng ký lúc startup, KHÔNG mở file)
+        self.registry = {}
+        # genome_id -> {'genomic': Fasta, 'cds': Fasta, 'protein': Fasta}, thứ tự LRU (cuối = mới dùng)
+        self.datasets = OrderedDict()
+        self.max_loaded = max_loaded
+
+        self._lock = threading.Lock()  # Bảo vệ registry / datasets / _in_use
+        self._load_locks = {}  # genome_id -> Lock: chỉ 1 thread được mở file của 1 bộ gen
+        self._in_use = {}  # genome_id -> số request đang đọc (không được đóng khi > 0)
+
+        # Cache vùng genomic dùng chung cho mọi bộ gen / endpoint
+        self.region_cache = SequenceBlockCache()
+        # Kho genome mmap dùng chung giữa các worker (genome_store.py), None = đọc FASTA trực tiếp
+        self.store_dir = None
+        # (genome_id, transcript_id, cấu trúc CDS, dấu FASTA) -> (cds, protein) đã ghép từ genomic, LRU
+        self._spliced = OrderedDict()
+        self._spliced_lock = threading.Lock()
+        # genome_id -> dấu (kích thước, mtime) các file lúc mở: file bị thay -> mở lại, bỏ cache cũ
+        self._stamps = {}
+
+    def attach_store(self, store_dir: str):
+        """Dùng kho đã dựng sẵn cho phần genomic (bộ gen nào có kho còn mới)."""
+        self.store_dir = store_dir
+
+    def register_genome(self, genome_id: str, fasta_path: str, cds_path: str = None, protein_path: str = None):
+        """
+        Đăng ký bộ gen (rẻ, không đọc file). File chỉ được mở khi có request đầu tiên.
+        """
+        with self._lock:
+            self.registry[genome_id] = {
+                'genomic': fasta_path,
+                'cds': cds_path,
+                'protein': protein_path,
+            }
+            self._load_locks.setdefault(genome_id, threading.Lock())
 
     def load_genome(self, genome_id: str, fasta_path: str, cds_path: str = None, protein_path: str = None):
+        """
+        Đăng ký + mở ngay (giữ tương thích với cách dùng cũ).
+        """
+        self.register_genome(genome_id, fasta_path, cds_path, protein_path)
+        self._ensure_loaded(genome_id)
+
+    def warm(self, genome_id: str):
+        """Mở trước 1 bộ gen đã đăng ký (preload lúc startup)."""
+        return self._ensure_loaded(genome_id) is not None
+
+    def _open_dataset(self, genome_id: str):
         """
         Load genome với bộ lọc header (chỉ lấy phần ID trước dấu cách).
         """
-        self.datasets[genome_id] = {}
+        paths = self.registry[genome_id]
+        dataset = {}
+
+        labels = {'genomic': 'Genomic', 'cds': 'CDS', 'protein': 'Protein'}
 
-        # Hàm làm sạch header: ">ID description..." -> "ID"
-        clean_key_func = lambda x: x.split()[0].strip()
+        # Kho mmap dùng chung (mở tức thì, không tốn thêm RSS cho mỗi worker)
+        if self.store_dir and paths['genomic'] and PackedGenome.is_fresh(self.store_dir, genome_id, paths['genomic']):
+            dataset['genomic'] = PackedGenome(os.path.join(self.store_dir, genome_id))
+            print(f"✅ [{genome_id}] Attached Genomic (shared store)")
+            labels.pop('genomic')
 
-        if os.path.exists(fasta_path):
-            self.datasets[genome_id]['genomic'] = Fasta(fasta_path, key_function=clean_key_func)
-            print(f"✅ [{genome_id}] Loaded Genomic")
+        # Bảng k-mer (kmer_index.py build) -> kiểm tra guide trùng lặp không cần Bowtie2
+        if self.store_dir and paths['genomic'] and KmerTables.is_fresh(self.store_dir, genome_id, paths['genomic']):
+            dataset['kmers'] = KmerTables(kmer_dir(self.store_dir, genome_id))
+            print(f"✅ [{genome_id}] Attached k-mer tables")
 
-        if cds_path and os.path.exists(cds_path):
-            self.datasets[genome_id]['cds'] = Fasta(cds_path, key_function=clean_key_func)
-            print(f"✅ [{genome_id}] Loaded CDS")
+        # Index biến thể (import_data.py --vcf) -> đánh dấu / loại guide nằm trên SNP/indel
+        if paths['genomic'] and VariantIndex.is_fresh(paths['genomic']):
+            dataset['variants'] = VariantIndex(variant_dir(paths['genomic']))
+            print(f"✅ [{genome_id}] Attached variant index")
 
-        if protein_path and os.path.exists(protein_path):
-            self.datasets[genome_id]['protein'] = Fasta(protein_path, key_function=clean_key_func)
-            print(f"✅ [{genome_id}] Loaded Protein")
+        for kind, label in labels.items():
+            path = paths[kind]
+            if path and os.path.exists(path):
+                dataset[kind] = self._open_fasta(path)
+                print(f"✅ [{genome_id}] Loaded {label}")
+
+        return dataset
+
+    @staticmethod
+    def _open_fasta(path: str):
+        """
+        FASTA nén bgzip -> BgzfFasta (fai + gzi + cache block), FASTA thường -> IndexedFasta.
+        Cả hai đọc bằng pread nên nhiều request cùng 1 bộ gen chạy song song thật sự.
+        Tên record = phần ID trước dấu cách của header (">ID description..." -> "ID").
+        """
+        if is_bgzf(path):
+            return BgzfFasta(path)
+        return IndexedFasta(path)
+
+    def _source_stamp(self, genome_id: str):
+        """(kích thước, mtime) của các file FASTA đã đăng ký - 1 lần stat mỗi file, đủ rẻ cho mỗi request."""
+        stamp = []
+        for path in self.registry[genome_id].values():
+            try:
+                st = os.stat(path) if path else None
+            except OSError:
+                st = None
+            stamp.append((st.st_size, st.st_mtime_ns) if st else None)
+        return tuple(stamp)
+
+    def _ensure_loaded(self, genome_id: str):
+        """
+        Mở bộ gen nếu chưa mở. Nhiều request đồng thời -> chỉ 1 lần load (double-checked lock).
+        FASTA bị thay (kích thước/mtime đổi) -> bỏ dataset cũ + block/CDS đã cache của bộ gen, mở lại.
+        """
+        with self._lock:
+            if genome_id in self.registry and genome_id in self.datasets \
+                    and self._stamps.get(genome_id) != self._source_stamp(genome_id):
+                # Không close(): request khác có thể đang đọc; file tự đóng khi hết tham chiếu
+                self.datasets.pop(genome_id)
+                self.region_cache.discard(genome_id)
+                with self._spliced_lock:
+                    for key in [k for k in self._spliced if k[0] == genome_id]:
+                        del self._spliced[key]
+                print(f"♻️ [{genome_id}] File FASTA đã thay đổi -> mở lại")
+            if genome_id in self.datasets:
+                self.datasets.move_to_end(genome_id)
+                return self.datasets[genome_id]
+            if genome_id not in self.registry:
+                return None
+            load_lock = self._load_locks[genome_id]
+
+        with load_lock:
+            with self._lock:
+                if genome_id in self.datasets:
+                    self.datasets.move_to_end(genome_id)
+                    return self.datasets[genome_id]
+
+            stamp = self._source_stamp(genome_id)
+            dataset = self._open_dataset(genome_id)
+
+            with self._lock:
+                self.datasets[genome_id] = dataset
+                self._stamps[genome_id] = stamp
+                self._evict_cold()
+            return dataset
+
+    def _evict_cold(self):
+        """Đóng các bộ gen ít dùng nhất khi vượt ngân sách (gọi khi đang giữ self._lock)."""
+        if not self.max_loaded:
+            return
+        for cold_id in list(self.datasets.keys()):
+            if len(self.datasets) <= self.max_loaded:
+                break
+            if self._in_use.get(cold_id, 0) > 0:
+                continue  # Đang có request đọc -> để lần sau
+            self._close_dataset(cold_id, self.datasets.pop(cold_id))
+
+    @staticmethod
+    def _close_dataset(genome_id, dataset):
+        for fasta_obj in dataset.values():
+            try:
+                fasta_obj.close()
+            except Exception:
+                pass
+        print(f"💤 [{genome_id}] Unloaded")
+
+    @contextmanager
+    def _use(self, genome_id: str):
+        """Mượn dataset trong lúc đọc: bộ gen đang dùng sẽ không bị LRU đóng."""
+        with self._lock:
+            self._in_use[genome_id] = self._in_use.get(genome_id, 0) + 1
+        try:
+            yield self._ensure_loaded(genome_id)
+        finally:
+            with self._lock:
+                self._in_use[genome_id] -= 1
+                self._evict_cold()
+
+    @contextmanager
+    def borrow(self, genome_id: str):
+        """
+        Mượn dataset của bộ gen ({'genomic': reader, 'kmers': KmerTables, ...}) cho các bước
+        quét cả bộ gen. Bộ gen chưa đăng ký -> dict rỗng.
+        """
+        if genome_id not in self.registry:
+            yield {}
+            return
+        with self._use(genome_id) as dataset:
+            yield dataset or {}
+
+    def status(self):
+        """Trạng thái cho endpoint readiness."""
+        with self._lock:
+            return {
+                "registered": list(self.registry.keys()),
+                "warm": list(self.datasets.keys()),
+                "max_loaded": self.max_loaded,
+                "shared_store": self.store_dir,
+                "region_cache": self.region_cache.stats(),
+            }
+
+    def close_all(self):
+        with self._lock:
+            while self.datasets:
+                genome_id, dataset = self.datasets.popitem(last=False)
+                self._close_dataset(genome_id, dataset)
+        self.region_cache.clear()
+        with self._spliced_lock:
+            self._spliced.clear()
 
     def _smart_search(self, fasta_obj, gene_id):
         """
@@ -82,21 +379,81 @@ class GenomeManager:
         # Nếu vẫn không thấy thì chịu thua
         raise KeyError(f"ID '{gene_id}' not found (even with smart search).")
 
-    def get_data(self, genome_id: str, type: str, gene_id: str = None, chrom: str = None, start: int = 0, end: int = 0):
-        if genome_id not in self.datasets:
+    def get_data(self, genome_id: str, type: str, gene_id: str = None, chrom: str = None, start: int = 0, end: int = 0,
+                 strand: str = None, transcript: dict = None):
+        """
+        strand='-': 'genomic' và 'flank' được trả về theo chiều của gen (bổ sung ngược),
+        flank khi đó là 2kb phía SAU end trên mạch +. strand=None giữ nguyên mạch +.
+        transcript (queries.get_transcript): 'cds'/'protein' được ghép từ genomic theo tọa độ CDS,
+        không cần file CDS/protein FASTA; thiếu transcript thì dùng Smart Search như cũ.
+        """
+        if genome_id not in self.registry:
+            return None
+
+        try:
+            with self._use(genome_id) as dataset:
+                if type in ('cds', 'protein') and transcript and transcript.get('cds') and dataset.get('genomic'):
+                    try:
+                        cds, protein = self._splice(genome_id, dataset, transcript)
+                        return cds if type == 'cds' else protein
+                    except Exception:
+                        pass  # Tọa độ lệch với FASTA -> thử Smart Search bên dưới
+                return self._extract(genome_id, dataset, type, gene_id, chrom, start, end, strand)
+        except Exception as e:
+            # Lỗi mở file (FASTA/kho/index hỏng...) -> None như trước, endpoint tự trả 404 thay vì 500
+            print(f"⚠️ [{genome_id}] Không mở được bộ gen: {e}")
             return None
-        dataset = self.datasets[genome_id]
 
+    def _splice(self, genome_id, dataset, transcript):
+        """
+        Ghép CDS từ các đoạn genomic (qua cache block) rồi dịch mã. Kết quả được cache theo transcript;
+        khóa gồm tọa độ CDS (import lại GFF) + dấu FASTA lúc mở (thay FASTA) -> không trả bản ghép cũ.
+        """
+        key = (genome_id, transcript['transcript_id'], transcript['chromosome'], transcript['strand'],
+               tuple(map(tuple, transcript['cds'])), transcript.get('cds_phase') or 0,
+               self._stamps.get(genome_id))
+        with self._spliced_lock:
+            cached = self._spliced.get(key)
+            if cached is not None:
+                self._spliced.move_to_end(key)
+                return cached
+
+        chrom = transcript['chromosome']
+        parts = [self._region(genome_id, dataset, chrom, s - 1, e) for s, e in transcript['cds']]
+        cds = oriented("".join(parts), transcript['strand'])[transcript.get('cds_phase') or 0:]
+        result = (cds, translate(cds).rstrip('*'))
+
+        with self._spliced_lock:
+            self._spliced[key] = result
+            while len(self._spliced) > GENOME_SPLICE_CACHE:
+                self._spliced.popitem(last=False)
+        return result
+
+    def _region(self, genome_id, dataset, chrom, start, end):
+        """Đọc vùng genomic [start, end) 0-based qua cache block dùng chung."""
+        record = dataset['genomic'][chrom]
+        if getattr(dataset['genomic'], 'in_memory', False):
+            return record[start:end]  # Kho mmap: đã là bộ nhớ dùng chung, không cache thêm
+        return self.region_cache.fetch(
+            genome_id, chrom, start, end, len(record),
+            lambda s, e: str(record[s:e])
+        )
+
+    def _extract(self, genome_id, dataset, type: str, gene_id: str = None, chrom: str = None, start: int = 0, end: int = 0,
+                 strand: str = None):
         try:
             # --- Genomic & Flank ---
             if type == 'genomic':
-                return str(dataset['genomic'][chrom][start - 1:end])
+                return oriented(self._region(genome_id, dataset, chrom, start - 1, end), strand)
 
             elif type == 'flank':
                 flank_len = 2000
+                if strand == '-':
+                    # Upstream của gen mạch - nằm sau end trên mạch +
+                    return oriented(self._region(genome_id, dataset, chrom, end, end + flank_len), strand)
                 p_end = start - 1
                 p_start = max(0, p_end - flank_len)
-                return str(dataset['genomic'][chrom][p_start:p_end])
+                return self._region(genome_id, dataset, chrom, p_start, p_end)
 
             # --- CDS & Protein (Dùng Smart Search) ---
             elif type == 'cds':
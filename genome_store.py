@@ -0,0 +1,192 @@
+"""
+Kho genome dùng chung cho nhiều worker uvicorn.
+
+Tiến trình cha dựng 1 lần (hoặc chạy lệnh `build` trước khi deploy):
+    <store>/<genome_id>/genomic.seq    - toàn bộ trình tự đã bỏ xuống dòng, nối liền các NST
+    <store>/<genome_id>/chroms.json    - {tên NST: [offset, độ dài]}
+    <store>/<genome_id>/manifest.json  - nguồn (kích thước, mtime FASTA) để phát hiện bản cũ
+
+Kho chỉ chứa trình tự: tọa độ gen luôn tra từ Database, import lại GFF không phải dựng lại kho.
+
+Worker chỉ mmap các file này ở chế độ read-only: các trang nằm chung trong page cache của OS,
+nên thêm worker gần như không tốn thêm RSS và khởi động gần như tức thì.
+
+    python genome_store.py build --store data/store
+    python genome_store.py serve --store data/store --workers 4
+"""
+import os
+import sys
+import json
+import mmap
+import shutil
+import argparse
+from collections import namedtuple
+
+sys.path.append(os.getcwd())
+
+from fasta_reader import IndexedFasta, BgzfFasta, SequenceRecord, is_bgzf
+
+PackedRecord = namedtuple("PackedRecord", ["offset", "length"])
+
+STORE_FORMAT = 1
+COPY_CHUNK = 8 * 1024 * 1024  # Số base đọc mỗi lần khi dựng kho
+
+
+def _source_stamp(path):
+    st = os.stat(path)
+    return {"path": os.path.abspath(path), "size": st.st_size, "mtime": int(st.st_mtime)}
+
+
+def build_genome(store_dir: str, genome_id: str, fasta_path: str):
+    """
+    Dựng kho cho 1 bộ gen.
+    Ghi vào thư mục tạm rồi đổi tên -> worker không bao giờ thấy kho dở dang.
+    """
+    final_dir = os.path.join(store_dir, genome_id)
+    tmp_dir = final_dir + ".building"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    reader = BgzfFasta(fasta_path) if is_bgzf(fasta_path) else IndexedFasta(fasta_path)
+    chroms = {}
+    offset = 0
+    try:
+        with open(os.path.join(tmp_dir, "genomic.seq"), "wb") as out:
+            for name, rec in reader.index.items():
+                for s in range(0, rec.length, COPY_CHUNK):
+                    out.write(reader.fetch(name, s, s + COPY_CHUNK).encode("ascii"))
+                chroms[name] = [offset, rec.length]
+                offset += rec.length
+    finally:
+        reader.close()
+
+    with open(os.path.join(tmp_dir, "chroms.json"), "w") as fh:
+        json.dump(chroms, fh)
+
+    with open(os.path.join(tmp_dir, "manifest.json"), "w") as fh:
+        json.dump({
+            "format": STORE_FORMAT,
+            "genome_id": genome_id,
+            "source": _source_stamp(fasta_path),
+            "chromosomes": list(chroms.keys()),
+            "bases": offset,
+        }, fh)
+
+    shutil.rmtree(final_dir, ignore_errors=True)
+    os.replace(tmp_dir, final_dir)
+    return final_dir
+
+
+def build_store(store_dir: str, genome_ids=None, force: bool = False):
+    """Dựng kho cho mọi bộ gen trong DB (hoặc danh sách genome_ids). Bỏ qua kho còn mới."""
+    from database import SessionLocal
+    from models import Genome
+
+    os.makedirs(store_dir, exist_ok=True)
+    db = SessionLocal()
+    try:
+        genomes = db.query(Genome).all()
+        for g in genomes:
+            if genome_ids and g.id not in genome_ids:
+                continue
+            if not g.fasta_path or not os.path.exists(g.fasta_path):
+                print(f"⚠️ [{g.id}] Không thấy FASTA: {g.fasta_path}")
+                continue
+            if not force and PackedGenome.is_fresh(store_dir, g.id, g.fasta_path):
+                print(f"🗂️ [{g.id}] Kho còn mới, bỏ qua.")
+                continue
+
+            print(f"📦 [{g.id}] Đang dựng kho...")
+            build_genome(store_dir, g.id, g.fasta_path)
+            print(f"✅ [{g.id}] Xong.")
+    finally:
+        db.close()
+
+
+class PackedGenome:
+    """
+    Đọc kho đã dựng qua mmap read-only. API giống IndexedFasta (genome[chrom][a:b]).
+    """
+
+    # Dữ liệu đã nằm trong page cache dùng chung -> GenomeManager không cần cache thêm
+    in_memory = True
+
+    def __init__(self, genome_dir: str):
+        self.genome_dir = genome_dir
+        with open(os.path.join(genome_dir, "manifest.json")) as fh:
+            self.manifest = json.load(fh)
+        with open(os.path.join(genome_dir, "chroms.json")) as fh:
+            self.index = {name: PackedRecord(*v) for name, v in json.load(fh).items()}
+        self.chrom_names = self.manifest["chromosomes"]
+
+        self._fh = open(os.path.join(genome_dir, "genomic.seq"), "rb")
+        size = os.fstat(self._fh.fileno()).st_size
+        self._mm = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+    @staticmethod
+    def is_fresh(store_dir: str, genome_id: str, fasta_path: str) -> bool:
+        """Kho khớp FASTA hiện tại (kích thước + mtime)."""
+        manifest_path = os.path.join(store_dir, genome_id, "manifest.json")
+        if not os.path.exists(manifest_path) or not os.path.exists(fasta_path):
+            return False
+        with open(manifest_path) as fh:
+            manifest = json.load(fh)
+        return manifest.get("format") == STORE_FORMAT and manifest.get("source") == _source_stamp(fasta_path)
+
+    # --- API giống IndexedFasta ---
+    def keys(self):
+        return self.index.keys()
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __getitem__(self, name):
+        if name not in self.index:
+            raise KeyError(name)
+        return SequenceRecord(self, name)
+
+    def fetch(self, name: str, start: int, end: int) -> str:
+        rec = self.index[name]
+        start, end = max(0, start), min(rec.length, end)
+        if start >= end:
+            return ""
+        return self._mm[rec.offset + start:rec.offset + end].decode("ascii")
+
+    def close(self):
+        if isinstance(self._mm, mmap.mmap):
+            self._mm.close()
+        self._fh.close()
+
+
+def serve(store_dir: str, workers: int, host: str, port: int):
+    """
+    Pre-fork: dựng kho 1 lần ở tiến trình cha rồi mới sinh các worker uvicorn.
+    Worker đọc GENOME_STORE_DIR và chỉ attach vào kho.
+    """
+    import uvicorn
+
+    build_store(store_dir)
+    os.environ["GENOME_STORE_DIR"] = os.path.abspath(store_dir)
+    uvicorn.run("main:app", host=host, port=port, workers=workers)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Kho genome dùng chung (mmap) cho nhiều worker")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_build = sub.add_parser("build", help="Dựng/cập nhật kho từ các bộ gen trong Database")
+    p_build.add_argument("--store", required=True, help="Thư mục kho (VD: data/store)")
+    p_build.add_argument("--genome", action="append", help="Chỉ dựng bộ gen này (lặp lại được)")
+    p_build.add_argument("--force", action="store_true", help="Dựng lại kể cả khi kho còn mới")
+
+    p_serve = sub.add_parser("serve", help="Dựng kho rồi chạy uvicorn nhiều worker")
+    p_serve.add_argument("--store", required=True)
+    p_serve.add_argument("--workers", type=int, default=4)
+    p_serve.add_argument("--host", default="0.0.0.0")
+    p_serve.add_argument("--port", type=int, default=8000)
+
+    args = parser.parse_args()
+    if args.command == "build":
+        build_store(args.store, genome_ids=args.genome, force=args.force)
+    else:
+        serve(args.store, args.workers, args.host, args.port)
@@ -1,5 +1,6 @@
 import sys
 import os
+import io
 import argparse
 import urllib.parse
 
@@ -7,18 +8,131 @@ import urllib.parse
 sys.path.append(os.getcwd())
 
 # Import từ app
-from database import SessionLocal, engine
-from models import Base, Gene, Genome
+from database import SessionLocal, engine, is_postgres
+from fasta_reader import ensure_indexes
+from models import Base, Gene, Genome, Transcript, pack_intervals
+from variant_index import build_variant_index
 
+GENE_COPY_COLUMNS = ("gene_id", "genome_id", "chromosome", "start", "end", "strand", "description")
 
-def run_import(genome_id, gff_path, fasta_path, cds_path=None, protein_path=None):
+
+def _copy_escape(value):
+    """Escape 1 giá trị theo định dạng TEXT của lệnh COPY (tab/xuống dòng/backslash)."""
+    if value is None:
+        return "\\N"
+    return (str(value).replace("\\", "\\\\").replace("\t", "\\t")
+            .replace("\n", "\\n").replace("\r", "\\r"))
+
+
+def copy_gene_rows(session, rows):
+    """
+    [PostgreSQL] Nạp 1 lô gen bằng COPY ... FROM STDIN (nhanh hơn INSERT nhiều lần).
+    Chạy trên connection của session -> nằm chung transaction với lệnh DELETE phía trên.
+    """
+    buf = io.StringIO()
+    for row in rows:
+        buf.write("\t".join(_copy_escape(row[c]) for c in GENE_COPY_COLUMNS))
+        buf.write("\n")
+    buf.seek(0)
+
+    columns = ", ".join(f'"{c}"' for c in GENE_COPY_COLUMNS)
+    sql = f"COPY genes ({columns}) FROM STDIN"
+    cursor = session.connection().connection.dbapi_connection.cursor()
+    try:
+        if hasattr(cursor, "copy_expert"):  # psycopg2
+            cursor.copy_expert(sql, buf)
+        else:  # psycopg 3
+            with cursor.copy(sql) as copy:
+                copy.write(buf.getvalue())
+    finally:
+        cursor.close()
+
+
+TRANSCRIPT_TYPES = {'mRNA', 'transcript'}
+
+
+def _parse_attrs(attr_str):
+    attrs = {}
+    for item in attr_str.strip().split(';'):
+        if '=' in item:
+            k, v = item.split('=', 1)
+            attrs[k] = urllib.parse.unquote(v)
+    return attrs
+
+
+def build_transcript_rows(genome_id, transcripts):
+    """
+    Gom exon/CDS theo transcript -> các dòng bảng transcripts (tọa độ dạng mảng int32).
+    Đánh dấu is_primary cho transcript có CDS dài nhất của mỗi gen.
+    """
+    rows = []
+    best = {}  # gene_id -> index dòng có CDS dài nhất
+    for tx_id, tx in transcripts.items():
+        exons = sorted(tx['exons'])
+        cds = sorted(tx['cds'])
+        if not exons and not cds:
+            continue
+
+        # Phase của đoạn CDS đầu tiên theo chiều đọc của gen
+        phase = 0
+        if cds:
+            first = max(tx['cds_phase']) if tx['strand'] == '-' else min(tx['cds_phase'])
+            phase = first[1]
+
+        cds_length = sum(e - s + 1 for s, e in cds)
+        rows.append({
+            "transcript_id": tx_id,
+            "gene_id": tx['gene_id'] or tx_id,
+            "genome_id": genome_id,
+            "chromosome": tx['chromosome'],
+            "strand": tx['strand'],
+            "exons": pack_intervals(exons or cds),
+            "cds": pack_intervals(cds),
+            "cds_phase": phase,
+            "cds_length": cds_length,
+            "is_primary": False,
+        })
+        gene_key = rows[-1]["gene_id"]
+        if gene_key not in best or cds_length > rows[best[gene_key]]["cds_length"]:
+            best[gene_key] = len(rows) - 1
+
+    for i in best.values():
+        rows[i]["is_primary"] = True
+    return rows
+
+
+def prebuild_fasta_indexes(*paths):
+    """Dựng index cho các file FASTA của bộ gen. Trả về False nếu có file không hợp lệ."""
+    for path in filter(None, paths):
+        try:
+            built = ensure_indexes(path)
+        except (FileNotFoundError, ValueError) as e:
+            print(f"❌ Lỗi FASTA: {e}")
+            return False
+        if built:
+            print(f"🗂️ Đã dựng index: {', '.join(built)}")
+        else:
+            print(f"🗂️ Index còn mới: {path}")
+    return True
+
+
+def run_import(genome_id, gff_path, fasta_path, cds_path=None, protein_path=None, vcf_path=None):
     """
     Hàm import dữ liệu gen và metadata genome.
     """
     print(f"🚀 Bắt đầu import cho bộ gen: {genome_id}")
 
+    # 0. Kiểm tra + dựng trước index FASTA (.fai, .gzi nếu bgzip)
+    #    -> server không phải quét genome nhiều GB ở request đầu tiên
+    if not prebuild_fasta_indexes(fasta_path, cds_path, protein_path):
+        return
+
     # 1. Khởi tạo Database
     Base.metadata.create_all(bind=engine)
+    # create_all không thêm index mới vào bảng đã tồn tại -> tạo bổ sung
+    for table in Base.metadata.sorted_tables:
+        for idx in table.indexes:
+            idx.create(bind=engine, checkfirst=True)
     session = SessionLocal()
 
     try:
@@ -48,57 +162,110 @@ def run_import(genome_id, gff_path, fasta_path, cds_path=None, protein_path=None
         print(f"📂 Đang đọc file GFF: {gff_path}...")
 
         # Xóa dữ liệu cũ của genome này (để tránh duplicate nếu import lại)
+        # Xóa + nạp lại nằm trong CÙNG 1 transaction: nhờ WAL, server vẫn đọc được
+        # bản cũ trong suốt quá trình import và chỉ thấy bản mới sau commit cuối.
         deleted_rows = session.query(Gene).filter(Gene.genome_id == genome_id).delete()
+        session.query(Transcript).filter(Transcript.genome_id == genome_id).delete()
         if deleted_rows > 0:
             print(f"🧹 Đã dọn dẹp {deleted_rows} gen cũ của {genome_id} trước khi import mới.")
-            session.commit()
+
+        use_copy = is_postgres(engine)
+        if use_copy:
+            print("⚡ PostgreSQL: dùng COPY để nạp dữ liệu.")
+        batch_size = 50000 if use_copy else 5000
+
+        def flush_batch(rows):
+            if use_copy:
+                copy_gene_rows(session, rows)
+            else:
+                session.bulk_insert_mappings(Gene, rows)
+                session.flush()
 
         batch = []
         count = 0
+        # transcript_id -> cấu trúc exon/CDS (mRNA, exon, CDS được gom trong cùng 1 lượt đọc)
+        transcripts = {}
+
+        def tx_entry(tx_id, parts):
+            return transcripts.setdefault(tx_id, {
+                "gene_id": None, "chromosome": parts[0], "strand": parts[6],
+                "exons": [], "cds": [], "cds_phase": [],
+            })
 
         with open(gff_path, 'r') as f:
             for line in f:
                 if line.startswith('#'): continue
                 parts = line.strip().split('\t')
+                if len(parts) < 9: continue
+                feature = parts[2]
+
+                # Cấu trúc transcript: mRNA -> gen, exon/CDS -> transcript
+                if feature in TRANSCRIPT_TYPES:
+                    attrs = _parse_attrs(parts[8])
+                    if 'ID' in attrs:
+                        tx_entry(attrs['ID'], parts)["gene_id"] = attrs.get('Parent', '').split(',')[0] or None
+                    continue
+                if feature in ('exon', 'CDS'):
+                    attrs = _parse_attrs(parts[8])
+                    interval = (int(parts[3]), int(parts[4]))
+                    for parent in filter(None, attrs.get('Parent', '').split(',')):
+                        tx = tx_entry(parent, parts)
+                        if feature == 'exon':
+                            tx["exons"].append(interval)
+                        else:
+                            tx["cds"].append(interval)
+                            tx["cds_phase"].append((interval[0], int(parts[7]) if parts[7].isdigit() else 0))
+                    continue
 
                 # Chỉ xử lý dòng gene
-                if len(parts) < 9 or parts[2] != 'gene': continue
+                if feature != 'gene': continue
 
-                attr_str = parts[8]
-                attrs = {}
-                for item in attr_str.strip().split(';'):
-                    if '=' in item:
-                        k, v = item.split('=', 1)
-                        attrs[k] = urllib.parse.unquote(v)
+                attrs = _parse_attrs(parts[8])
 
                 # Ưu tiên lấy ID, nếu không có lấy Name
                 g_id = attrs.get('ID', attrs.get('Name', f'unknown_{count}'))
 
-                gene = Gene(
-                    gene_id=g_id,
-                    genome_id=genome_id,
-                    chromosome=parts[0],
-                    start=int(parts[3]),
-                    end=int(parts[4]),
-                    strand=parts[6],
-                    description=attrs.get('Note', attrs.get('description', ''))
-                )
-                batch.append(gene)
+                batch.append({
+                    "gene_id": g_id,
+                    "genome_id": genome_id,
+                    "chromosome": parts[0],
+                    "start": int(parts[3]),
+                    "end": int(parts[4]),
+                    "strand": parts[6],
+                    "description": attrs.get('Note', attrs.get('description', ''))
+                })
                 count += 1
 
-                # Bulk Insert mỗi 5000 dòng
-                if len(batch) >= 5000:
-                    session.bulk_save_objects(batch)
-                    session.commit()
+                # Bulk Insert theo lô (5000 dòng INSERT / 50000 dòng COPY)
+                if len(batch) >= batch_size:
+                    flush_batch(batch)
                     batch = []
                     print(f"   -> Đã import {count} gen...")
 
         # Commit phần còn lại
         if batch:
-            session.bulk_save_objects(batch)
-            session.commit()
+            flush_batch(batch)
+
+        # 4. Nạp cấu trúc transcript (exon/CDS dạng mảng)
+        tx_rows = build_transcript_rows(genome_id, transcripts)
+        for i in range(0, len(tx_rows), 5000):
+            session.bulk_insert_mappings(Transcript, tx_rows[i:i + 5000])
+        session.commit()
+
+        print(f"✅ HOÀN TẤT! Tổng cộng {count} gen, {len(tx_rows)} transcript đã được lưu vào Database.")
+
+        if use_copy:
+            # Thống kê planner cũ sau COPY hàng loạt (autovacuum chưa kịp chạy) -> ước lượng sai,
+            # bỏ qua index GiST/trigram. ANALYZE ngay để /genome/search dùng đúng index.
+            with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+                conn.exec_driver_sql("ANALYZE genes")
+                conn.exec_driver_sql("ANALYZE transcripts")
 
-        print(f"✅ HOÀN TẤT! Tổng cộng {count} gen đã được lưu vào Database.")
+        # 5. Index biến thể (tùy chọn): lọc guide nằm trên SNP/indel mà không parse VCF mỗi request
+        if vcf_path:
+            print(f"🧬 Đang index biến thể: {vcf_path}...")
+            out_dir = build_variant_index(vcf_path, fasta_path)
+            print(f"✅ Index biến thể: {out_dir}")
 
     except FileNotFoundError as e:
         print(f"❌ Lỗi: Không tìm thấy file - {e}")
@@ -120,6 +287,7 @@ if __name__ == "__main__":
     # Các tham số tùy chọn (Mới thêm)
     parser.add_argument("--cds", help="Đường dẫn file CDS FASTA (.cds.fna)", default=None)
     parser.add_argument("--protein", help="Đường dẫn file Protein FASTA (.faa)", default=None)
+    parser.add_argument("--vcf", help="Đường dẫn file VCF biến thể (.vcf/.vcf.gz)", default=None)
 
     args = parser.parse_args()
 
@@ -128,5 +296,6 @@ if __name__ == "__main__":
         gff_path=args.gff,
         fasta_path=args.fasta,
         cds_path=args.cds,
-        protein_path=args.protein
+        protein_path=args.protein,
+        vcf_path=args.vcf
     )
\ No newline at end of file
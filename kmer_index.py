@@ -0,0 +1,190 @@
+"""
+Bảng k-mer theo từng bộ gen: biết ngay 1 guide có duy nhất trong bộ gen hay không,
+không cần chạy Bowtie2 (quan trọng với mía: rất nhiều bản sao homeolog).
+
+Dựng offline 1 lần cho mỗi bộ gen (quét cả 2 mạch, mọi vị trí có PAM NGG):
+    <store>/kmers/<genome_id>/seed12.npy     - uint32[4^12]: số vị trí có seed 12-mer (sát PAM) + NGG
+    <store>/kmers/<genome_id>/site23.npy     - uint64 đã sắp xếp: mã 2-bit của protospacer 20nt + NGG
+    <store>/kmers/<genome_id>/manifest.json  - nguồn FASTA để phát hiện bảng cũ
+
+Tra cứu: seed -> O(1) (đọc 1 phần tử), 23-mer -> binary search trên mảng mmap.
+
+    python kmer_index.py build --store data/store [--genome R570]
+"""
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+
+sys.path.append(os.getcwd())
+
+from fasta_reader import IndexedFasta, BgzfFasta, is_bgzf
+from genome_store import _source_stamp
+from primer_specificity import rolling_kmer_codes, kmer_code
+from sequtils import reverse_complement
+
+KMER_FORMAT = 1
+SEED_LEN = 12
+SITE_LEN = 23
+KMER_SCAN_CHUNK = int(os.getenv("KMER_SCAN_CHUNK", str(16 * 1024 * 1024)))
+# Sắp xếp ngoài bộ nhớ: chia mã 23-mer thành 4^3 thùng theo 3 base đầu, mỗi thùng sort riêng
+_BUCKET_BASES = 3
+_BUCKET_SHIFT = 2 * (SITE_LEN - _BUCKET_BASES)
+_GG = 0b1010  # 2 base cuối "GG"
+_SEED_MASK = (1 << (2 * SEED_LEN)) - 1
+
+
+def kmer_dir(store_dir: str, genome_id: str) -> str:
+    return os.path.join(store_dir, "kmers", genome_id)
+
+
+def pam_site_codes(seq):
+    """Mã 23-mer (20nt + NGG) của mọi vị trí có PAM NGG trên mạch của seq (không chứa N)."""
+    codes = rolling_kmer_codes(seq, SITE_LEN)
+    return codes[(codes >= 0) & ((codes & 0xF) == _GG)]
+
+
+def build_genome_kmers(store_dir: str, genome_id: str, fasta_path: str):
+    """Quét bộ gen, đếm seed và ghi mảng 23-mer đã sắp xếp. Ghi vào thư mục tạm rồi đổi tên."""
+    final_dir = kmer_dir(store_dir, genome_id)
+    tmp_dir = final_dir + ".building"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    seed_counts = np.zeros(4 ** SEED_LEN, dtype=np.uint32)
+    n_buckets = 4 ** _BUCKET_BASES
+    bucket_dir = tempfile.mkdtemp(dir=tmp_dir)
+    buckets = [open(os.path.join(bucket_dir, f"{b}.u64"), "wb") for b in range(n_buckets)]
+    total = 0
+
+    reader = BgzfFasta(fasta_path) if is_bgzf(fasta_path) else IndexedFasta(fasta_path)
+    try:
+        for name, rec in reader.index.items():
+            for start in range(0, rec.length, KMER_SCAN_CHUNK):
+                # Chồng lấn SITE_LEN-1 base để không sót vị trí vắt qua 2 đoạn
+                chunk = reader.fetch(name, start, min(rec.length, start + KMER_SCAN_CHUNK + SITE_LEN - 1))
+                for seq in (chunk, reverse_complement(chunk)):
+                    codes = pam_site_codes(seq).astype(np.uint64)
+                    if not len(codes):
+                        continue
+                    seeds = (codes >> np.uint64(6)) & np.uint64(_SEED_MASK)
+                    seed_counts += np.bincount(seeds.astype(np.int64), minlength=len(seed_counts)).astype(np.uint32)
+                    bucket_of = codes >> np.uint64(_BUCKET_SHIFT)
+                    order = np.argsort(bucket_of, kind="stable")
+                    bounds = np.searchsorted(bucket_of[order], np.arange(n_buckets + 1, dtype=np.uint64))
+                    for b in range(n_buckets):
+                        if bounds[b] < bounds[b + 1]:
+                            codes[order[bounds[b]:bounds[b + 1]]].tofile(buckets[b])
+                    total += len(codes)
+    finally:
+        reader.close()
+        for fh in buckets:
+            fh.close()
+
+    np.save(os.path.join(tmp_dir, "seed12.npy"), seed_counts)
+
+    # Thùng theo thứ tự tiền tố -> sort từng thùng rồi nối là ra mảng sắp xếp toàn cục
+    sites = np.lib.format.open_memmap(os.path.join(tmp_dir, "site23.npy"), mode="w+", dtype=np.uint64,
+                                      shape=(total,))
+    pos = 0
+    for b in range(n_buckets):
+        part = np.fromfile(os.path.join(bucket_dir, f"{b}.u64"), dtype=np.uint64)
+        part.sort()
+        sites[pos:pos + len(part)] = part
+        pos += len(part)
+    sites.flush()
+    del sites
+    shutil.rmtree(bucket_dir)
+
+    with open(os.path.join(tmp_dir, "manifest.json"), "w") as fh:
+        json.dump({
+            "format": KMER_FORMAT,
+            "genome_id": genome_id,
+            "source": _source_stamp(fasta_path),
+            "seed_len": SEED_LEN,
+            "sites": total,
+        }, fh)
+
+    shutil.rmtree(final_dir, ignore_errors=True)
+    os.replace(tmp_dir, final_dir)
+    return final_dir
+
+
+def build_kmer_store(store_dir: str, genome_ids=None, force: bool = False):
+    """Dựng bảng k-mer cho mọi bộ gen trong DB (hoặc danh sách genome_ids). Bỏ qua bảng còn mới."""
+    from database import SessionLocal
+    from models import Genome
+
+    db = SessionLocal()
+    try:
+        for g in db.query(Genome).all():
+            if genome_ids and g.id not in genome_ids:
+                continue
+            if not g.fasta_path or not os.path.exists(g.fasta_path):
+                print(f"⚠️ [{g.id}] Không thấy FASTA: {g.fasta_path}")
+                continue
+            if not force and KmerTables.is_fresh(store_dir, g.id, g.fasta_path):
+                print(f"🗂️ [{g.id}] Bảng k-mer còn mới, bỏ qua.")
+                continue
+
+            print(f"🧮 [{g.id}] Đang đếm k-mer...")
+            build_genome_kmers(store_dir, g.id, g.fasta_path)
+            print(f"✅ [{g.id}] Xong.")
+    finally:
+        db.close()
+
+
+class KmerTables:
+    """Tra cứu bảng k-mer đã dựng (mmap read-only, dùng chung giữa các worker)."""
+
+    def __init__(self, genome_dir: str):
+        self.genome_dir = genome_dir
+        with open(os.path.join(genome_dir, "manifest.json")) as fh:
+            self.manifest = json.load(fh)
+        self.seed_counts = np.load(os.path.join(genome_dir, "seed12.npy"), mmap_mode="r")
+        self.sites = np.load(os.path.join(genome_dir, "site23.npy"), mmap_mode="r")
+
+    @staticmethod
+    def is_fresh(store_dir: str, genome_id: str, fasta_path: str) -> bool:
+        manifest_path = os.path.join(kmer_dir(store_dir, genome_id), "manifest.json")
+        if not os.path.exists(manifest_path) or not os.path.exists(fasta_path):
+            return False
+        with open(manifest_path) as fh:
+            manifest = json.load(fh)
+        return manifest.get("format") == KMER_FORMAT and manifest.get("source") == _source_stamp(fasta_path)
+
+    def seed_hits(self, guide_seq: str) -> int:
+        """Số vị trí NGG trong bộ gen có cùng seed 12nt sát PAM (O(1))."""
+        code = kmer_code(guide_seq[-SEED_LEN:])
+        return int(self.seed_counts[code]) if code is not None else 0
+
+    def occurrences(self, guide_seq: str) -> int:
+        """Số vị trí khớp hoàn toàn 20nt + NGG (mọi N) trên cả 2 mạch (binary search)."""
+        code = kmer_code(guide_seq[-20:])
+        if code is None or len(guide_seq) < 20:
+            return 0
+        # Mã 23-mer = (mã 20nt << 6) | (N << 4) | GG -> mọi PAM của guide nằm trong 1 khoảng liên tục
+        lo = np.searchsorted(self.sites, np.uint64(code << 6), side="left")
+        hi = np.searchsorted(self.sites, np.uint64((code + 1) << 6), side="left")
+        return int(hi - lo)
+
+    def close(self):
+        # Bỏ tham chiếu để mmap được giải phóng
+        self.seed_counts = self.sites = None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bảng k-mer (seed 12nt + NGG, 23-mer) theo bộ gen")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_build = sub.add_parser("build", help="Dựng/cập nhật bảng k-mer từ các bộ gen trong Database")
+    p_build.add_argument("--store", required=True, help="Thư mục kho (VD: data/store)")
+    p_build.add_argument("--genome", action="append", help="Chỉ dựng bộ gen này (lặp lại được)")
+    p_build.add_argument("--force", action="store_true", help="Dựng lại kể cả khi bảng còn mới")
+
+    args = parser.parse_args()
+    build_kmer_store(args.store, genome_ids=args.genome, force=args.force)
@@ -0,0 +1,375 @@
+"""
+Thiết kế thư viện CRISPR knockout cho hàng trăm gen trong 1 job.
+
+Thay vì gọi /tools/crispor tuần tự cho từng gen:
+    - Danh sách gen được tra 1 lần (BatchGeneResolver, sắp theo chromosome/start) hoặc đọc từ BED,
+      trình tự được đọc theo thứ tự tọa độ (đọc FASTA tuần tự, tận dụng cache block).
+    - Tầng lọc rẻ + điểm Doench của từng gen chạy trên process pool.
+    - Guide còn lại của cả lô gen (LIBRARY_BATCH_GENES) được gom vào ÍT lần gọi Bowtie2.
+    - Top N guide mỗi gen được ghi ngay ra TSV (flush sau mỗi lô) hoặc Parquet (1 row group mỗi lô).
+    - Trạng thái job ghi ra <job_id>.json cạnh file kết quả -> worker nào của server cũng trả lời được.
+      File kèm pid/host của process chạy job và nhịp heartbeat: server chết giữa chừng -> load_status
+      báo "interrupted" thay vì "running" mãi mãi.
+"""
+import os
+import re
+import csv
+import json
+import time
+import uuid
+import socket
+import threading
+import multiprocessing
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import crispor_engine
+from crispor_engine import CrisporEngine, prefilter_candidates, finalize_guides, cds_target_regions
+from kmer_index import KmerTables
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet là tùy chọn (pip install pyarrow)
+    pa = pq = None
+
+LIBRARY_OUTPUT_DIR = os.getenv("LIBRARY_OUTPUT_DIR", "data/library_jobs")
+LIBRARY_BATCH_GENES = int(os.getenv("LIBRARY_BATCH_GENES", "50"))  # Số gen mỗi lô off-target
+LIBRARY_WORKERS = int(os.getenv("LIBRARY_WORKERS", str(min(4, os.cpu_count() or 1))))
+LIBRARY_HEARTBEAT_SECONDS = int(os.getenv("LIBRARY_HEARTBEAT_SECONDS", "30"))  # Chu kỳ ghi lại trạng thái
+GENE_PADDING = 100  # Lấy rộng 2 bên gen để thiết kế Primer (như /tools/crispor)
+
+# Đích: tọa độ 1-based, đóng. transcript: dict queries.transcript_spec (None nếu không có)
+# padding: số base lấy thêm 2 bên (gen: GENE_PADDING, vùng BED: 0)
+LibraryTarget = namedtuple("LibraryTarget", ["name", "chrom", "start", "end", "strand", "transcript", "padding"])
+
+OUTPUT_COLUMNS = [
+    "target", "chrom", "target_start", "target_end", "rank", "sequence", "pam", "strand", "location",
+    "gc_content", "efficiency_doench", "specificity_cfd", "off_targets_count",
+    "primer_left", "primer_right", "product_size", "genome_copies",
+]
+
+
+def parse_bed(text: str):
+    """BED (0-based, nửa mở) -> list LibraryTarget 1-based. Cột 4 (name), 6 (strand) là tùy chọn."""
+    targets = []
+    for line in text.splitlines():
+        if not line.strip() or line.startswith(("#", "track", "browser")):
+            continue
+        cols = line.rstrip("\n").split("\t")
+        if len(cols) < 3:
+            raise ValueError(f"Dòng BED không hợp lệ: {line[:80]}")
+        chrom, start, end = cols[0], int(cols[1]), int(cols[2])
+        name = cols[3] if len(cols) > 3 and cols[3] else f"{chrom}:{start + 1}-{end}"
+        strand = cols[5] if len(cols) > 5 and cols[5] in ("+", "-") else None
+        targets.append(LibraryTarget(name, chrom, start + 1, end, strand, None, 0))
+    return sorted(targets, key=lambda t: (t.chrom, t.start))
+
+
+def resolve_gene_targets(db, genome_id: str, gene_ids):
+    """Tra hàng loạt gen (kèm transcript chính), đã sắp theo tọa độ. Trả về (targets, missing)."""
+    from queries import BatchGeneResolver
+
+    targets = []
+    with BatchGeneResolver(db, genome_id, gene_ids) as resolver:
+        for row in resolver.iter_found():
+            targets.append(LibraryTarget(row["gene_id"], row["chromosome"], row["start"], row["end"],
+                                         row["strand"], BatchGeneResolver.transcript_of(row), GENE_PADDING))
+        missing = list(resolver.iter_missing())
+    return targets, missing
+
+
+def target_sequence(genome_manager, genome_id: str, target: LibraryTarget, mode: str = "gene",
+                    exons: int = None, cds_percent: float = None):
+    """
+    Trình tự quét của 1 đích: (sequence, regions).
+    Lấy thêm target.padding 2 bên; mode='cds' giới hạn vùng quét vào CDS (chỉ đích là gen có transcript).
+    """
+    window_start = max(1, target.start - target.padding)
+    seq = genome_manager.get_data(genome_id, 'genomic', chrom=target.chrom, start=window_start,
+                                  end=target.end + target.padding)
+    if not seq:
+        return None, None
+
+    regions = None
+    if mode == "cds":
+        if not target.transcript or not target.transcript['cds']:
+            return None, None
+        regions = cds_target_regions(target.transcript['cds'], target.strand, window_start,
+                                     first_exons=exons, cds_percent=cds_percent)
+    return str(seq), regions
+
+
+# --- Tầng lọc trên process pool ---
+_worker_kmers = {}
+
+
+def _prefilter_target(args):
+    """Chạy trong process con: tìm PAM + lọc rẻ + Doench cho 1 đích."""
+    sequence, regions, top_k, options, kmer_path = args
+    kmer_tables = None
+    if kmer_path:
+        # Mỗi process mở bảng k-mer (mmap) 1 lần, không pickle mảng lớn qua pipe
+        kmer_tables = _worker_kmers.get(kmer_path)
+        if kmer_tables is None:
+            kmer_tables = _worker_kmers[kmer_path] = KmerTables(kmer_path)
+
+    engine = CrisporEngine(genome_index_path=None)
+    candidates = engine.find_candidates(sequence, regions=regions)
+    for cand in candidates:
+        cand['template'] = 0
+    return prefilter_candidates(engine, candidates, top_k, kmer_tables=kmer_tables, **options)
+
+
+class _TsvWriter:
+    def __init__(self, path):
+        self.fh = open(path, "w", newline="")
+        self.writer = csv.writer(self.fh, delimiter="\t")
+        self.writer.writerow(OUTPUT_COLUMNS)
+
+    def write(self, rows):
+        self.writer.writerows([[row[c] for c in OUTPUT_COLUMNS] for row in rows])
+        self.fh.flush()  # File tải về được ngay trong khi job còn chạy
+
+    def close(self):
+        self.fh.close()
+
+
+def _parquet_schema():
+    types = {
+        "target_start": pa.int64(), "target_end": pa.int64(), "rank": pa.int32(),
+        "gc_content": pa.float64(), "efficiency_doench": pa.float64(), "specificity_cfd": pa.float64(),
+        "off_targets_count": pa.int32(), "product_size": pa.int32(), "genome_copies": pa.int32(),
+    }
+    return pa.schema([(c, types.get(c, pa.string())) for c in OUTPUT_COLUMNS])
+
+
+class _ParquetWriter:
+    def __init__(self, path):
+        if pq is None:
+            raise RuntimeError("Cần cài pyarrow để xuất Parquet")
+        self.schema = _parquet_schema()
+        self.writer = pq.ParquetWriter(path, self.schema)
+
+    def write(self, rows):
+        if rows:
+            self.writer.write_table(pa.Table.from_pylist(rows, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+def result_rows(target: LibraryTarget, results):
+    """Kết quả run/finalize của 1 đích -> các dòng phẳng của file thư viện."""
+    rows = []
+    for rank, g in enumerate(results, 1):
+        rows.append({
+            "target": target.name,
+            "chrom": target.chrom,
+            "target_start": target.start,
+            "target_end": target.end,
+            "rank": rank,
+            "sequence": g["sequence"],
+            "pam": g["pam"],
+            "strand": g["strand"],
+            "location": g["location"],
+            "gc_content": g["gc_content"],
+            "efficiency_doench": g["scores"]["efficiency_doench"],
+            "specificity_cfd": g["scores"]["specificity_cfd"],
+            "off_targets_count": g["off_targets_count"],
+            "primer_left": g["primers"].get("left"),
+            "primer_right": g["primers"].get("right"),
+            "product_size": g["primers"].get("product_size", 0),
+            "genome_copies": g.get("genome_copies"),
+        })
+    return rows
+
+
+def status_path(job_id: str, output_dir: str = LIBRARY_OUTPUT_DIR) -> str:
+    return os.path.join(output_dir, f"{job_id}.json")
+
+
+def output_path(job_id: str, output_format: str, output_dir: str = LIBRARY_OUTPUT_DIR) -> str:
+    return os.path.join(output_dir, f"{job_id}.{output_format}")
+
+
+def _owner_alive(status) -> bool:
+    """Process chạy job còn sống không: cùng máy -> hỏi pid; khác máy -> dựa vào heartbeat."""
+    heartbeat = status.get("heartbeat")
+    if heartbeat is None or time.time() - heartbeat > 4 * LIBRARY_HEARTBEAT_SECONDS:
+        return False
+    if status.get("host") == socket.gethostname() and status.get("pid"):
+        try:
+            os.kill(status["pid"], 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass  # pid tồn tại nhưng của user khác
+    return True
+
+
+def load_status(job_id: str, output_dir: str = LIBRARY_OUTPUT_DIR):
+    """
+    Trạng thái job đọc từ đĩa (job có thể do worker khác chạy). None nếu không có job.
+    Job chưa xong mà process chạy nó đã chết / ngừng heartbeat -> "interrupted".
+    """
+    if not re.fullmatch(r"[0-9a-f]{12}", job_id):
+        return None  # Chặn job_id dạng đường dẫn
+    try:
+        with open(status_path(job_id, output_dir)) as fh:
+            status = json.load(fh)
+    except (OSError, ValueError):
+        return None
+    if status.get("status") in ("queued", "running") and not _owner_alive(status):
+        status["status"] = "interrupted"
+        status["error"] = "Process chạy job đã dừng (server khởi động lại hoặc bị lỗi) - cần tạo job mới"
+    return status
+
+
+class LibraryJob:
+    """
+    1 job thiết kế thư viện. run() chạy đồng bộ (API gọi trong thread nền),
+    trạng thái đọc được bất kỳ lúc nào qua status() hoặc load_status(job_id) (file <job_id>.json).
+    """
+
+    def __init__(self, genome_id: str, index_path: str, targets, output_format: str = "tsv",
+                 top_n: int = 5, mode: str = "gene", exons: int = None, cds_percent: float = None,
+                 options: dict = None, kmer_path: str = None, output_dir: str = LIBRARY_OUTPUT_DIR,
+                 missing=None, workers: int = LIBRARY_WORKERS, offtarget_cache=None, shards=None):
+        if output_format not in ("tsv", "parquet"):
+            raise ValueError("output_format phải là 'tsv' hoặc 'parquet'")
+        if output_format == "parquet" and pq is None:
+            raise RuntimeError("Cần cài pyarrow để xuất Parquet")
+
+        self.job_id = uuid.uuid4().hex[:12]
+        self.genome_id = genome_id
+        self.index_path = index_path
+        self.targets = list(targets)
+        self.output_format = output_format
+        self.top_n = top_n
+        self.mode = mode
+        self.exons = exons
+        self.cds_percent = cds_percent
+        self.options = options or {}
+        self.kmer_path = kmer_path
+        self.workers = workers
+        self.offtarget_cache = offtarget_cache
+        self.shards = shards
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
+        self.path = output_path(self.job_id, output_format, output_dir)
+
+        self.status_text = "queued"
+        self.done = 0
+        self.guides_written = 0
+        self.skipped = list(missing or [])
+        self.offtarget_failed = []  # Gen có guide không tìm được off-target (specificity để trống)
+        self.error = None
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()  # Thread heartbeat và thread chạy job cùng ghi file trạng thái
+        self._save_status()
+
+    def status(self):
+        with self._lock:
+            return {
+                "job_id": self.job_id,
+                "genome": self.genome_id,
+                "status": self.status_text,
+                "format": self.output_format,
+                "targets": len(self.targets),
+                "done": self.done,
+                "guides_written": self.guides_written,
+                "skipped": self.skipped,
+                "offtarget_failed": self.offtarget_failed,
+                "error": self.error,
+                "pid": os.getpid(),
+                "host": socket.gethostname(),
+                "heartbeat": time.time(),
+            }
+
+    def _set(self, **fields):
+        with self._lock:
+            for key, value in fields.items():
+                setattr(self, key, value)
+        self._save_status()
+
+    def _save_status(self):
+        """Ghi trạng thái ra file tạm rồi đổi tên -> worker khác không đọc phải JSON dở dang."""
+        path = status_path(self.job_id, self.output_dir)
+        with self._save_lock:
+            with open(path + ".tmp", "w") as fh:
+                json.dump(self.status(), fh)
+            os.replace(path + ".tmp", path)
+
+    def _heartbeat(self, stop):
+        """Ghi lại trạng thái định kỳ: 1 lô (Bowtie2 cho cả lô gen) có thể chạy lâu hơn ngưỡng heartbeat."""
+        while not stop.wait(LIBRARY_HEARTBEAT_SECONDS):
+            self._save_status()
+
+    def run(self, genome_manager):
+        self._set(status_text="running")
+        stop = threading.Event()
+        threading.Thread(target=self._heartbeat, args=(stop,), daemon=True).start()
+        writer = _TsvWriter(self.path) if self.output_format == "tsv" else _ParquetWriter(self.path)
+        engine = CrisporEngine(genome_index_path=self.index_path, offtarget_cache=self.offtarget_cache,
+                               shards=self.shards)
+        try:
+            # spawn: run() chạy trong thread nền của server nhiều thread, fork có thể treo vì lock
+            with ProcessPoolExecutor(max_workers=self.workers,
+                                     mp_context=multiprocessing.get_context("spawn")) as pool:
+                for i in range(0, len(self.targets), LIBRARY_BATCH_GENES):
+                    self._run_batch(genome_manager, engine, pool, writer, self.targets[i:i + LIBRARY_BATCH_GENES])
+            self._set(status_text="done")
+        except Exception as e:
+            self._set(status_text="failed", error=str(e))
+            print(f"❌ [library {self.job_id}] {e}")
+        finally:
+            stop.set()
+            writer.close()
+
+    def _run_batch(self, genome_manager, engine, pool, writer, batch):
+        # 1. Đọc trình tự theo thứ tự tọa độ
+        loaded = []
+        for target in batch:
+            seq, regions = target_sequence(genome_manager, self.genome_id, target, self.mode,
+                                           self.exons, self.cds_percent)
+            if seq is None:
+                with self._lock:
+                    self.skipped.append(target.name)
+                    self.done += 1
+                continue
+            loaded.append((target, seq, regions))
+
+        # 2. Lọc rẻ song song trên process pool
+        args = [(seq, regions, self.top_n, self.options, self.kmer_path) for _, seq, regions in loaded]
+        prefiltered = list(pool.map(_prefilter_target, args))
+
+        # 3. 1 lượt Bowtie2 (theo lô) cho mọi guide còn lại của cả lô gen
+        #    Bowtie2 lỗi -> guide nằm trong failed, specificity để trống thay vì 100 (0 off-target)
+        guides = [item[2]['guide_seq'] for gene_pool, _ in prefiltered for item in gene_pool]
+        failed = set()
+        off_targets = engine.search_off_targets_batch(guides, failed=failed)
+
+        # 4. CFD + Primer3 + ghi kết quả từng gen
+        rows = []
+        failed_targets = []
+        for (target, seq, _), (gene_pool, _) in zip(loaded, prefiltered):
+            results = finalize_guides(engine, gene_pool, off_targets, [seq], self.top_n, failed=failed)
+            if any(g['sequence'] in failed for g in results):
+                failed_targets.append(target.name)
+            rows.extend(result_rows(target, results))
+        writer.write(rows)
+        if failed_targets:
+            print(f"⚠️ [library {self.job_id}] {len(failed_targets)} gen không tìm được off-target")
+        with self._lock:
+            self.offtarget_failed.extend(failed_targets)
+            self.done += len(loaded)
+            self.guides_written += len(rows)
+        self._save_status()
+
+
+def filter_options(min_gc=crispor_engine.CRISPOR_MIN_GC, max_gc=crispor_engine.CRISPOR_MAX_GC,
+                   min_efficiency=crispor_engine.CRISPOR_MIN_EFFICIENCY,
+                   max_copies=crispor_engine.CRISPOR_MAX_COPIES):
+    """Ngưỡng tầng lọc truyền sang process con."""
+    return {"min_gc": min_gc, "max_gc": max_gc, "min_efficiency": min_efficiency, "max_copies": max_copies}
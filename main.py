@@ -1,17 +1,28 @@
 from typing import List, Optional
 from fastapi import FastAPI, Depends, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, FileResponse
 from pydantic import BaseModel
 from sqlalchemy.orm import Session
-from sqlalchemy import or_
 from contextlib import asynccontextmanager
 import os
+import json
+import base64
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 # Import các module nội bộ
 import models
 import database
 import genome
 import crispor_engine
+import queries
+import library_design
+import gene_annotation
+import pam_scanner
+import offtarget_shards
+from kmer_index import KmerTables, kmer_dir
 
 # --- CẤU HÌNH TOÀN CỤC ---
 # Khởi tạo Manager để quản lý nhiều bộ gen cùng lúc
@@ -31,6 +42,12 @@ def engine_has_table(table_name):
 async def lifespan(app: FastAPI):
     print("🔄 [STARTUP] Đang khởi động hệ thống...")
 
+    # 0. Worker của deployment nhiều tiến trình: attach vào kho genome dùng chung
+    store_dir = os.getenv("GENOME_STORE_DIR")
+    if store_dir and os.path.isdir(store_dir):
+        print(f"📦 Dùng kho genome dùng chung: {store_dir}")
+        genome_manager.attach_store(store_dir)
+
     # 1. Kết nối DB để lấy danh sách các Genome đã đăng ký
     db = database.SessionLocal()
     try:
@@ -39,11 +56,14 @@ async def lifespan(app: FastAPI):
             genomes = db.query(models.Genome).all()
             print(f"📂 Tìm thấy {len(genomes)} bộ gen trong Database.")
 
-            # 2. Load từng file FASTA vào RAM (Index)
+            # 2. Chỉ đăng ký (rẻ): FASTA/faidx được mở khi có request đầu tiên
             for g in genomes:
-                print(f"   -> Loading: {g.id}")
-                # Load đủ 3 loại file: Genomic, CDS, Protein
-                genome_manager.load_genome(g.id, g.fasta_path, g.cds_path, g.protein_path)
+                genome_manager.register_genome(g.id, g.fasta_path, g.cds_path, g.protein_path)
+
+            # Làm nóng trước các bộ gen hay dùng (VD: GENOME_PRELOAD=R570,AP85_441)
+            for genome_id in filter(None, os.getenv("GENOME_PRELOAD", "").split(",")):
+                print(f"   -> Preloading: {genome_id}")
+                genome_manager.warm(genome_id.strip())
         else:
             print("⚠️ Bảng 'genomes' chưa tồn tại. Vui lòng chạy script import_data.py trước.")
 
@@ -52,9 +72,14 @@ async def lifespan(app: FastAPI):
     finally:
         db.close()
 
+    # Process pool Primer3 (spawn) tạo sẵn, không tạo lười từ thread xử lý request
+    crispor_engine.start_primer_pool()
+
     yield  # --- Server chạy tại đây ---
 
     print("🛑 [SHUTDOWN] Server đang tắt. Giải phóng tài nguyên...")
+    crispor_engine.shutdown_primer_pool()
+    genome_manager.close_all()
 
 
 # --- KHỞI TẠO APP ---
@@ -80,52 +105,88 @@ def read_root():
     return {
         "status": "Online",
         "system": "Sugarcane Multi-Genome System",
+        "registered_genomes": list(genome_manager.registry.keys()),
         "loaded_genomes": list(genome_manager.datasets.keys())
     }
 
 
-@app.get("/genome/search")
+@app.get("/health/genomes")
+def genomes_readiness():
+    """
+    Readiness: bộ gen nào đã đăng ký, bộ gen nào đang "nóng" (đã mở FASTA/faidx).
+    """
+    return {"status": "ready", **genome_manager.status()}
+
+
+# --- RESPONSE MODELS ---
+class GeneSummary(BaseModel):
+    # Mọi cột đều Optional: chỉ các cột được chọn qua `fields` mới xuất hiện trong JSON
+    id: Optional[int] = None
+    gene_id: Optional[str] = None
+    genome_id: Optional[str] = None
+    chromosome: Optional[str] = None
+    start: Optional[int] = None
+    end: Optional[int] = None
+    strand: Optional[str] = None
+    description: Optional[str] = None
+
+
+class GeneSearchResponse(BaseModel):
+    genome: str
+    count: int
+    next_cursor: Optional[str] = None  # None = hết dữ liệu
+    data: List[GeneSummary]
+
+
+def encode_cursor(row):
+    raw = json.dumps([row["chromosome"], row["start"], row["id"]], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        chrom, start, row_id = json.loads(base64.urlsafe_b64decode(padded))
+        return str(chrom), int(start), int(row_id)
+    except Exception:
+        raise HTTPException(400, detail="Cursor không hợp lệ")
+
+
+@app.get("/genome/search", response_model=GeneSearchResponse, response_model_exclude_unset=True)
 def search_genes(
         genome: str = Query(..., description="ID bộ gen (VD: R570, AP85)"),
         q: str = Query(None, description="Từ khóa: ID gen hoặc mô tả"),
         chrom: str = Query(None, description="Tên nhiễm sắc thể"),
         start: int = None,
         end: int = None,
-        limit: int = 10,
+        limit: int = Query(10, ge=1, le=1000),
+        cursor: str = Query(None, description="next_cursor của trang trước"),
+        fields: str = Query(None, description="Các cột cần lấy, cách nhau bởi dấu phẩy (VD: gene_id,start,end)"),
         db: Session = Depends(database.get_db)
 ):
     """
-    Tìm kiếm gen trong một bộ gen cụ thể.
+    Tìm kiếm gen trong một bộ gen cụ thể (phân trang keyset qua `cursor`).
     """
-    # 1. Lọc theo Genome (Bắt buộc)
-    query = db.query(models.Gene).filter(models.Gene.genome_id == genome)
-
-    # 2. Lọc theo Nhiễm sắc thể
-    if chrom:
-        query = query.filter(models.Gene.chromosome == chrom)
-
-    # 3. Lọc theo Vùng
-    if start and end:
-        query = query.filter(
-            models.Gene.start <= end,
-            models.Gene.end >= start
-        )
+    selected = queries.GENE_FIELDS
+    if fields:
+        selected = tuple(f.strip() for f in fields.split(",") if f.strip())
+        unknown = set(selected) - set(queries.GENE_FIELDS)
+        if unknown:
+            raise HTTPException(400, detail=f"Cột không hợp lệ: {', '.join(sorted(unknown))}")
 
-    # 4. Lọc theo Từ khóa
-    if q:
-        search_fmt = f"%{q}%"
-        query = query.filter(or_(
-            models.Gene.gene_id.like(search_fmt),
-            models.Gene.description.like(search_fmt)
-        ))
+    after = decode_cursor(cursor) if cursor else None
+    rows = queries.search_genes(db, genome, q=q, chrom=chrom, start=start, end=end,
+                                limit=limit, after=after, fields=selected)
 
-    results = query.limit(limit).all()
+    # Trang đầy -> có thể còn trang sau
+    next_cursor = encode_cursor(rows[-1]) if len(rows) == limit else None
 
-    return {
-        "genome": genome,
-        "count": len(results),
-        "data": results
-    }
+    return GeneSearchResponse(
+        genome=genome,
+        count=len(rows),
+        next_cursor=next_cursor,
+        data=[GeneSummary.model_construct(**{f: row[f] for f in selected}) for row in rows]
+    )
 
 
 @app.get("/genome/sequence")
@@ -138,14 +199,17 @@ def get_sequence(
     """
     Lấy trình tự DNA/Protein lẻ tẻ.
     """
-    gene = db.query(models.Gene).filter(
-        models.Gene.genome_id == genome,
-        models.Gene.gene_id == gene_id
-    ).first()
+    # Tọa độ luôn lấy từ DB (nguồn chuẩn, đổi khi import lại GFF); kho dùng chung chỉ cấp trình tự
+    row = queries.get_gene(db, genome, gene_id)
+    if not row: raise HTTPException(404, detail="Not found")
+    gene = {"gene_id": row.gene_id, "chromosome": row.chromosome, "start": row.start, "end": row.end,
+            "strand": row.strand}
 
-    if not gene: raise HTTPException(404, detail="Not found")
+    # CDS/Protein: ghép từ genomic theo cấu trúc transcript (nếu GFF có exon/CDS)
+    transcript = queries.get_transcript(db, genome, gene_id) if type in ('cds', 'protein') else None
 
-    seq = genome_manager.get_data(genome, type, gene.gene_id, gene.chromosome, gene.start, gene.end)
+    seq = genome_manager.get_data(genome, type, gene["gene_id"], gene["chromosome"], gene["start"], gene["end"],
+                                  strand=gene["strand"], transcript=transcript)
     return {"genome": genome, "gene": gene_id, "type": type, "sequence": seq}
 
 
@@ -158,10 +222,7 @@ def get_gene_detail(
     """
     Lấy TRỌN BỘ thông tin (Full Detail) cho trang chi tiết.
     """
-    gene = db.query(models.Gene).filter(
-        models.Gene.genome_id == genome,
-        models.Gene.gene_id == gene_id
-    ).first()
+    gene = queries.get_gene(db, genome, gene_id)
 
     if not gene: raise HTTPException(404, detail="Gene not found")
 
@@ -172,10 +233,13 @@ def get_gene_detail(
         anno = None
 
     # Lấy sequences
-    seq_genomic = genome_manager.get_data(genome, 'genomic', gene.gene_id, gene.chromosome, gene.start, gene.end)
-    seq_cds = genome_manager.get_data(genome, 'cds', gene.gene_id)
-    seq_protein = genome_manager.get_data(genome, 'protein', gene.gene_id)
-    seq_flank = genome_manager.get_data(genome, 'flank', gene.gene_id, gene.chromosome, gene.start, gene.end)
+    seq_genomic = genome_manager.get_data(genome, 'genomic', gene.gene_id, gene.chromosome, gene.start, gene.end,
+                                          strand=gene.strand)
+    transcript = queries.get_transcript(db, genome, gene.gene_id)
+    seq_cds = genome_manager.get_data(genome, 'cds', gene.gene_id, transcript=transcript)
+    seq_protein = genome_manager.get_data(genome, 'protein', gene.gene_id, transcript=transcript)
+    seq_flank = genome_manager.get_data(genome, 'flank', gene.gene_id, gene.chromosome, gene.start, gene.end,
+                                        strand=gene.strand)
 
     return {
         "basic_info": {
@@ -203,94 +267,162 @@ def get_gene_detail(
 
 
 # --- BATCH SEQUENCE API ---
+BATCH_SEQUENCE_TYPES = ("genomic", "cds", "protein", "flank")
+
+
 class BatchSequenceRequest(BaseModel):
     genome: str
     gene_ids: List[str]
+    # Các loại trình tự lấy trong CÙNG 1 lượt duyệt (mặc định chỉ genomic như cũ)
+    types: List[str] = ["genomic"]
+
+
+def _iter_batch_json(payload: BatchSequenceRequest):
+    """
+    Sinh JSON theo từng mảnh: kết quả được ghi ra ngay khi đọc xong mỗi gen,
+    nên bộ nhớ không tăng theo số gen (100k gen vẫn chạy được).
+    """
+    db = database.SessionLocal()
+    try:
+        yield '{"genome": %s, "total_requested": %d, "data": [' % (
+            json.dumps(payload.genome), len(payload.gene_ids))
+
+        total_found = 0
+        first = True
+        with queries.BatchGeneResolver(db, payload.genome, payload.gene_ids) as resolver:
+            # Gen đã sắp theo chromosome/start -> đọc FASTA tuần tự
+            for gene in resolver.iter_found():
+                total_found += 1
+                try:
+                    item = {
+                        "gene_id": gene["gene_id"],
+                        "found": True,
+                        "location": f"{gene['chromosome']}:{gene['start']}-{gene['end']}",
+                    }
+                    for seq_type in payload.types:
+                        seq = genome_manager.get_data(payload.genome, seq_type, gene["gene_id"],
+                                                      gene["chromosome"], gene["start"], gene["end"],
+                                                      strand=gene["strand"],
+                                                      transcript=resolver.transcript_of(gene))
+                        if seq_type == "genomic":
+                            item["length"] = len(seq) if seq else 0
+                            item["sequence"] = seq
+                        else:
+                            item[seq_type] = seq
+                except Exception as e:
+                    item = {"gene_id": gene["gene_id"], "found": False, "error": str(e)}
+
+                yield ("" if first else ",") + json.dumps(item)
+                first = False
+
+            # Check missing
+            for mid in resolver.iter_missing():
+                yield ("" if first else ",") + json.dumps({"gene_id": mid, "found": False, "error": "Not in DB"})
+                first = False
+
+        yield '], "total_found": %d}' % total_found
+    finally:
+        db.close()
 
 
 @app.post("/genome/sequence/batch")
-def get_sequence_batch_post(
-        payload: BatchSequenceRequest,
-        db: Session = Depends(database.get_db)
-):
-    genes = db.query(models.Gene).filter(
-        models.Gene.genome_id == payload.genome,
-        models.Gene.gene_id.in_(payload.gene_ids)
-    ).all()
+def get_sequence_batch_post(payload: BatchSequenceRequest):
+    unknown = set(payload.types) - set(BATCH_SEQUENCE_TYPES)
+    if unknown:
+        raise HTTPException(400, detail=f"Loại trình tự không hợp lệ: {', '.join(sorted(unknown))}")
 
-    results = []
-    found_ids = set()
+    return StreamingResponse(_iter_batch_json(payload), media_type="application/json")
 
-    for gene in genes:
-        found_ids.add(gene.gene_id)
-        try:
-            seq = genome_manager.get_data(payload.genome, 'genomic', gene.gene_id, gene.chromosome, gene.start,
-                                          gene.end)
-            results.append({
-                "gene_id": gene.gene_id,
-                "found": True,
-                "location": f"{gene.chromosome}:{gene.start}-{gene.end}",
-                "length": len(seq) if seq else 0,
-                "sequence": seq
-            })
-        except Exception as e:
-            results.append({"gene_id": gene.gene_id, "found": False, "error": str(e)})
 
-    # Check missing
-    for mid in set(payload.gene_ids) - found_ids:
-        results.append({"gene_id": mid, "found": False, "error": "Not in DB"})
+# --- CRISPOR TOOL (QUAN TRỌNG) ---
+def bowtie_index_path(genome_info):
+    """Đường dẫn index Bowtie2 (kiểu WSL) của bộ gen."""
+    wsl_path = crispor_engine.bowtie_index_path(genome_info.fasta_path)
+    print(f"DEBUG: WSL Index Path -> {wsl_path}")
+    return wsl_path
 
-    return {
-        "genome": payload.genome,
-        "total_requested": len(payload.gene_ids),
-        "total_found": len(genes),
-        "data": results
-    }
+
+def crispor_gene_target(db, genome: str, gene, target: str = "gene", exons: int = None, cds_percent: float = None):
+    """
+    Trình tự gen ±100bp (để thiết kế Primer) + vùng quét (None = cả đoạn, cds = các exon mã hóa)
+    + vị trí của đoạn trên NST (chrom, offset 0-based) để tra index biến thể.
+    """
+    # Lấy rộng ra 100bp để thiết kế Primer
+    try:
+        target_seq = genome_manager.get_data(genome, 'genomic', chrom=gene.chromosome, start=gene.start - 100,
+                                             end=gene.end + 100)
+    except Exception as e:
+        raise HTTPException(500, detail=f"Lỗi đọc Fasta: {e}")
+
+    window_start = max(1, gene.start - 100)
+    regions = None
+    # Chế độ knockout: chỉ quét guide trong CDS (theo cấu trúc transcript đã import)
+    if target == "cds":
+        transcript = queries.get_transcript(db, genome, gene.gene_id)
+        if not transcript or not transcript['cds']:
+            raise HTTPException(422, detail=f"Gen {gene.gene_id} không có cấu trúc CDS trong Database")
+        regions = crispor_engine.cds_target_regions(
+            transcript['cds'], gene.strand, window_start, first_exons=exons, cds_percent=cds_percent
+        )
+    return target_seq, regions, (gene.chromosome, window_start - 1)
+
+
+def variant_window(dataset, locus):
+    """VariantWindow cho đoạn trình tự tại locus (chrom, offset) nếu bộ gen có index biến thể."""
+    index = dataset.get('variants')
+    if index is None or locus is None:
+        return None
+    return index.window(*locus)
 
 
-# --- CRISPOR TOOL (QUAN TRỌNG) ---
 @app.post("/tools/crispor")
 def run_crispor_tool(
         genome: str = Query(..., description="Chọn bộ gen"),
         gene_id: str = None,
         sequence: str = None,
+        target: str = Query("gene", description="gene: cả gen ±100bp | cds: chỉ các exon mã hóa"),
+        exons: int = Query(None, ge=1, description="[cds] Chỉ N exon mã hóa đầu tiên"),
+        cds_percent: float = Query(None, gt=0, le=100, description="[cds] Chỉ N% đầu của CDS"),
+        top_k: int = Query(crispor_engine.CRISPOR_TOP_K, ge=1, le=200, description="Số guide trả về (chạy Primer3)"),
+        min_gc: float = Query(crispor_engine.CRISPOR_MIN_GC, ge=0, le=100),
+        max_gc: float = Query(crispor_engine.CRISPOR_MAX_GC, ge=0, le=100),
+        min_efficiency: float = Query(crispor_engine.CRISPOR_MIN_EFFICIENCY, ge=0, le=100,
+                                      description="Ngưỡng điểm Doench tối thiểu"),
+        check_primers: bool = Query(False, description="Quét bộ gen để dự đoán amplicon off-target của cặp mồi"),
+        max_copies: int = Query(crispor_engine.CRISPOR_MAX_COPIES, ge=1,
+                                description="Loại guide có nhiều bản sao hơn (cần bảng k-mer)"),
+        annotate: bool = Query(True, description="Chú thích gen / loại vùng cho từng off-target"),
+        variants: str = Query("flag", description="flag: đánh dấu | drop: loại guide nằm trên SNP/indel "
+                                                  "(cần index VCF, chỉ với gene_id)"),
+        enzymes: str = Query("spcas9", description="Các enzyme, cách nhau dấu phẩy: spcas9, sacas9, cpf1 (cas12a)"),
         db: Session = Depends(database.get_db)
 ):
     """
     CRISPOR Engine: Tìm gRNA + Off-target Bowtie2 + Primer3
     """
+    if target not in ("gene", "cds"):
+        raise HTTPException(400, detail="target phải là 'gene' hoặc 'cds'")
+    if variants not in ("flag", "drop"):
+        raise HTTPException(400, detail="variants phải là 'flag' hoặc 'drop'")
+    try:
+        enzyme_set = pam_scanner.parse_enzymes(enzymes)
+    except ValueError as e:
+        raise HTTPException(400, detail=str(e))
+
     # 1. Tìm đường dẫn Index (WSL Path)
     genome_info = db.query(models.Genome).filter(models.Genome.id == genome).first()
     if not genome_info:
         raise HTTPException(404, detail=f"Genome '{genome}' chưa được hỗ trợ.")
-
-    # Xử lý đường dẫn Windows -> WSL cho Bowtie2
-    abs_fasta_path = os.path.abspath(genome_info.fasta_path)
-    abs_index_path = abs_fasta_path.replace(".fasta", "_index")  # Quy ước tên index
-
-    wsl_path = abs_index_path.replace("\\", "/")
-    if wsl_path.lower().startswith("d:"):
-        wsl_path = "/mnt/d" + wsl_path[2:]
-    elif wsl_path.lower().startswith("c:"):
-        wsl_path = "/mnt/c" + wsl_path[2:]
-
-    print(f"DEBUG: WSL Index Path -> {wsl_path}")
+    wsl_path = bowtie_index_path(genome_info)
 
     # 2. Lấy sequence
     target_seq = ""
+    regions = None
+    locus = None  # Trình tự tự nhập không có tọa độ -> không tra được biến thể
     if gene_id:
-        gene = db.query(models.Gene).filter(models.Gene.genome_id == genome, models.Gene.gene_id == gene_id).first()
+        gene = queries.get_gene(db, genome, gene_id)
         if not gene: raise HTTPException(404, "Gene not found")
-
-        # Lấy rộng ra 100bp để thiết kế Primer
-        try:
-            # Lưu ý: get_data trả về string, ta cần tính lại tọa độ để lấy padding
-            # Hoặc gọi trực tiếp manager nếu cần tùy biến
-            # Ở đây ta gọi manager để lấy padding
-            target_seq = genome_manager.get_data(genome, 'genomic', chrom=gene.chromosome, start=gene.start - 100,
-                                                 end=gene.end + 100)
-        except Exception as e:
-            raise HTTPException(500, detail=f"Lỗi đọc Fasta: {e}")
+        target_seq, regions, locus = crispor_gene_target(db, genome, gene, target, exons, cds_percent)
 
     elif sequence:
         target_seq = sequence
@@ -298,16 +430,338 @@ def run_crispor_tool(
         raise HTTPException(400, "Thiếu input gene_id hoặc sequence")
 
     # 3. Chạy Engine
+    stats = {}
     try:
-        results = crispor_engine.run_crispor_analysis(str(target_seq), wsl_path)
+        with genome_manager.borrow(genome) as dataset:
+            results = crispor_engine.run_crispor_analysis(
+                str(target_seq), wsl_path, regions=regions, top_k=top_k,
+                min_gc=min_gc, max_gc=max_gc, min_efficiency=min_efficiency,
+                genome_reader=dataset.get('genomic') if check_primers else None,
+                kmer_tables=dataset.get('kmers'), max_copies=max_copies,
+                offtarget_cache=crispor_engine.bind_offtarget_cache(genome, genome_info.fasta_path),
+                shards=offtarget_shards.load_shards(genome_info.fasta_path),
+                variants=variant_window(dataset, locus), drop_variants=variants == "drop",
+                enzymes=enzyme_set, stats=stats
+            )
     except Exception as e:
         print(f"Lỗi Engine: {e}")
         results = []
 
+    if annotate:
+        gene_annotation.annotate_guides(db, genome, results)
+
     return {
         "genome": genome,
         "index_used": wsl_path,
         "input_length": len(target_seq) if target_seq else 0,
-        "guides_found": len(results),
-        "top_guides": results[:20]
-    }
\ No newline at end of file
+        "scanned_length": sum(e - s for s, e in regions) if regions is not None else len(target_seq or ""),
+        "guides_found": stats.get("passed_filters", len(results)),
+        "pipeline": stats,
+        "top_guides": results
+    }
+
+
+# --- CRISPOR ĐA ĐÍCH (HỌ GEN / ALEN HOMEOLOG) ---
+class CrisporRegion(BaseModel):
+    chrom: str
+    start: int  # 1-based, đóng
+    end: int
+    name: Optional[str] = None
+
+
+class CrisporMultiRequest(BaseModel):
+    genome: str
+    gene_ids: List[str] = []
+    regions: List[CrisporRegion] = []
+    target: str = "gene"
+    exons: Optional[int] = None
+    cds_percent: Optional[float] = None
+    # Chỉ lấy guide cắt được TẤT CẢ các đích (knockout mọi alen)
+    require_all: bool = False
+    top_k: int = crispor_engine.CRISPOR_TOP_K
+    min_gc: float = crispor_engine.CRISPOR_MIN_GC
+    max_gc: float = crispor_engine.CRISPOR_MAX_GC
+    min_efficiency: float = crispor_engine.CRISPOR_MIN_EFFICIENCY
+    max_copies: int = crispor_engine.CRISPOR_MAX_COPIES
+    check_primers: bool = False
+    # Chú thích gen / loại vùng cho từng off-target
+    annotate: bool = True
+    # flag: đánh dấu | drop: vị trí nằm trên SNP/indel không tính là cắt được đích (cần index VCF)
+    variants: str = "flag"
+    # spcas9, sacas9, cpf1 (cas12a) - mọi PAM được quét trong 1 lượt
+    enzymes: List[str] = ["spcas9"]
+
+
+@app.post("/tools/crispor/multi")
+def run_crispor_multi(payload: CrisporMultiRequest, db: Session = Depends(database.get_db)):
+    """
+    CRISPOR cho nhiều đích 1 lúc: guide giống nhau giữa các alen chỉ được chấm điểm,
+    tìm off-target và thiết kế mồi 1 lần; mỗi guide báo các đích nó cắt được.
+    """
+    if payload.target not in ("gene", "cds"):
+        raise HTTPException(400, detail="target phải là 'gene' hoặc 'cds'")
+    if not payload.gene_ids and not payload.regions:
+        raise HTTPException(400, detail="Thiếu gene_ids hoặc regions")
+    if not 1 <= payload.top_k <= 200:
+        raise HTTPException(400, detail="top_k phải trong khoảng 1..200")
+    if payload.variants not in ("flag", "drop"):
+        raise HTTPException(400, detail="variants phải là 'flag' hoặc 'drop'")
+    try:
+        enzyme_set = pam_scanner.parse_enzymes(payload.enzymes)
+    except ValueError as e:
+        raise HTTPException(400, detail=str(e))
+
+    genome_info = db.query(models.Genome).filter(models.Genome.id == payload.genome).first()
+    if not genome_info:
+        raise HTTPException(404, detail=f"Genome '{payload.genome}' chưa được hỗ trợ.")
+    wsl_path = bowtie_index_path(genome_info)
+
+    targets = []
+    loci = []
+    missing = []
+    for gene_id in dict.fromkeys(payload.gene_ids):
+        gene = queries.get_gene(db, payload.genome, gene_id)
+        if not gene:
+            missing.append(gene_id)
+            continue
+        seq, regions, locus = crispor_gene_target(db, payload.genome, gene, payload.target, payload.exons,
+                                                  payload.cds_percent)
+        if seq:
+            targets.append((gene.gene_id, str(seq), regions))
+            loci.append(locus)
+    for r in payload.regions:
+        seq = genome_manager.get_data(payload.genome, 'genomic', chrom=r.chrom, start=r.start, end=r.end)
+        if not seq:
+            missing.append(r.name or f"{r.chrom}:{r.start}-{r.end}")
+            continue
+        targets.append((r.name or f"{r.chrom}:{r.start}-{r.end}", str(seq), None))
+        loci.append((r.chrom, r.start - 1))
+
+    if not targets:
+        raise HTTPException(404, detail={"message": "Không tìm thấy đích nào", "missing": missing})
+    names = [t[0] for t in targets]
+    duplicates = sorted({n for n in names if names.count(n) > 1})
+    if duplicates:
+        # Guide báo các đích theo tên -> tên trùng làm require_all / covers_all sai
+        raise HTTPException(400, detail={"message": "Tên đích bị trùng - cần tên duy nhất", "duplicates": duplicates})
+
+    stats = {}
+    with genome_manager.borrow(payload.genome) as dataset:
+        if dataset.get('variants') is not None:
+            targets = [t + (variant_window(dataset, locus),) for t, locus in zip(targets, loci)]
+        results = crispor_engine.run_multi_target_analysis(
+            targets, wsl_path, require_all=payload.require_all, top_k=payload.top_k,
+            min_gc=payload.min_gc, max_gc=payload.max_gc, min_efficiency=payload.min_efficiency,
+            genome_reader=dataset.get('genomic') if payload.check_primers else None,
+            kmer_tables=dataset.get('kmers'), max_copies=payload.max_copies,
+            offtarget_cache=crispor_engine.bind_offtarget_cache(payload.genome, genome_info.fasta_path),
+            shards=offtarget_shards.load_shards(genome_info.fasta_path),
+            drop_variants=payload.variants == "drop", enzymes=enzyme_set, stats=stats
+        )
+
+    if payload.annotate:
+        gene_annotation.annotate_guides(db, payload.genome, results)
+
+    return {
+        "genome": payload.genome,
+        "index_used": wsl_path,
+        "targets": [t[0] for t in targets],
+        "missing": missing,
+        "pipeline": stats,
+        "top_guides": results
+    }
+
+
+# --- BẢO TỒN GUIDE GIỮA CÁC BỘ GEN (R570 / AP85-441 / SSpon ...) ---
+def offtarget_engine(genome_info):
+    """
+    CrisporEngine (index, cache off-target, shard) của 1 bộ gen. Gắn lại ở mỗi request như các endpoint khác
+    (rẻ: stat file index + 1 câu SQLite) -> index Bowtie2 dựng lại / chia shard sau khi server chạy vẫn được dùng.
+    """
+    return crispor_engine.CrisporEngine(
+        bowtie_index_path(genome_info),
+        offtarget_cache=crispor_engine.bind_offtarget_cache(genome_info.id, genome_info.fasta_path),
+        shards=offtarget_shards.load_shards(genome_info.fasta_path)
+    )
+
+
+class ConservationRequest(BaseModel):
+    guides: List[str]  # Protospacer 20nt (có thể kèm PAM NGG -> tự cắt bỏ)
+    # Rỗng = mọi bộ gen đã đăng ký
+    genomes: List[str] = []
+    max_hits: int = crispor_engine.CONSERVATION_MAX_HITS
+    annotate: bool = True
+
+
+@app.post("/tools/crispor/conservation")
+def run_crispor_conservation(payload: ConservationRequest, db: Session = Depends(database.get_db)):
+    """
+    Kiểm tra 1 tập guide trên mọi bộ gen cùng lúc (mỗi bộ gen 1 thread, Bowtie2 chạy song song):
+    số vị trí khớp hoàn toàn + tóm tắt off-target theo từng bộ gen, trong 1 response.
+    """
+    guides = []
+    for g in payload.guides:
+        g = g.strip().upper()
+        if len(g) == 23 and g.endswith("GG"):
+            g = g[:20]
+        if not re.fullmatch(r"[ACGT]{20}", g):
+            raise HTTPException(400, detail=f"Guide không hợp lệ (cần 20nt ACGT): {g}")
+        guides.append(g)
+    guides = list(dict.fromkeys(guides))
+    if not guides:
+        raise HTTPException(400, detail="Thiếu guides")
+    if not 1 <= payload.max_hits <= 100:
+        raise HTTPException(400, detail="max_hits phải trong khoảng 1..100")
+
+    genome_ids = payload.genomes or list(genome_manager.registry.keys())
+    infos = {g.id: g for g in db.query(models.Genome).filter(models.Genome.id.in_(genome_ids)).all()}
+    missing = [gid for gid in genome_ids if gid not in infos]
+    genome_ids = [gid for gid in genome_ids if gid in infos]
+    if not genome_ids:
+        raise HTTPException(404, detail={"message": "Không có bộ gen nào", "missing": missing})
+
+    def scan(gid):
+        try:
+            engine = offtarget_engine(infos[gid])
+            with genome_manager.borrow(gid) as dataset:
+                return crispor_engine.summarize_conservation(engine, guides, kmer_tables=dataset.get('kmers'),
+                                                             max_hits=payload.max_hits)
+        except Exception as e:
+            print(f"❌ [{gid}] Quét bảo tồn lỗi: {e}")
+            return {g: {"status": "error", "error": str(e)} for g in guides}
+
+    with ThreadPoolExecutor(max_workers=len(genome_ids)) as pool:
+        per_genome = dict(zip(genome_ids, pool.map(scan, genome_ids)))
+
+    # Trạng thái từng bộ gen: quét lỗi không được hiểu thành "không bảo tồn"
+    genome_status = {}
+    for gid, summaries in per_genome.items():
+        errors = [s for s in summaries.values() if s['status'] != "ok"]
+        if not errors:
+            genome_status[gid] = {"status": "ok"}
+        else:
+            genome_status[gid] = {"status": "error" if len(errors) == len(summaries) else "partial",
+                                  "error": errors[0]['error'], "failed_guides": len(errors)}
+
+    # Chú thích gen sau cùng, trên thread của request (Session không dùng chung giữa các thread)
+    if payload.annotate:
+        for gid, summaries in per_genome.items():
+            hits = [hit for summary in summaries.values() for hit in summary.get('hits', ())]
+            if hits:
+                gene_annotation.get_gene_index(db, gid).annotate(hits)
+
+    return {
+        "genomes": genome_ids,
+        "missing": missing,
+        "genome_status": genome_status,
+        "guides": [
+            {
+                "sequence": g,
+                "conserved_in": [gid for gid in genome_ids
+                                 if per_genome[gid][g]['status'] == "ok" and per_genome[gid][g]['exact_matches'] > 0],
+                # Bộ gen quét lỗi: chưa biết guide có bảo tồn hay không
+                "unknown_in": [gid for gid in genome_ids if per_genome[gid][g]['status'] != "ok"],
+                "genomes": {gid: per_genome[gid][g] for gid in genome_ids},
+            }
+            for g in guides
+        ],
+    }
+
+
+# --- THIẾT KẾ THƯ VIỆN (NHIỀU GEN, CHẠY NỀN) ---
+# Job chạy trong thread nền của worker nhận POST; trạng thái + kết quả nằm ở LIBRARY_OUTPUT_DIR
+# nên GET status/download trả lời được từ bất kỳ worker nào.
+
+
+class LibraryRequest(BaseModel):
+    genome: str
+    gene_ids: List[str] = []
+    bed: Optional[str] = None  # Nội dung file BED (0-based), dùng thay cho gene_ids
+    target: str = "cds"
+    exons: Optional[int] = None
+    cds_percent: Optional[float] = None
+    top_n: int = 5
+    format: str = "tsv"
+    min_gc: float = crispor_engine.CRISPOR_MIN_GC
+    max_gc: float = crispor_engine.CRISPOR_MAX_GC
+    min_efficiency: float = crispor_engine.CRISPOR_MIN_EFFICIENCY
+    max_copies: int = crispor_engine.CRISPOR_MAX_COPIES
+
+
+@app.post("/tools/crispor/library")
+def start_library_job(payload: LibraryRequest, db: Session = Depends(database.get_db)):
+    """
+    Tạo job thiết kế thư viện cho danh sách gen / vùng BED. Trả về ngay job_id;
+    top N guide mỗi gen được ghi dần ra file TSV/Parquet trong lúc job chạy.
+    """
+    if payload.target not in ("gene", "cds"):
+        raise HTTPException(400, detail="target phải là 'gene' hoặc 'cds'")
+    if not 1 <= payload.top_n <= 100:
+        raise HTTPException(400, detail="top_n phải trong khoảng 1..100")
+
+    genome_info = db.query(models.Genome).filter(models.Genome.id == payload.genome).first()
+    if not genome_info:
+        raise HTTPException(404, detail=f"Genome '{payload.genome}' chưa được hỗ trợ.")
+
+    missing = []
+    if payload.bed:
+        try:
+            targets = library_design.parse_bed(payload.bed)
+        except ValueError as e:
+            raise HTTPException(400, detail=str(e))
+        mode = "gene"  # Vùng BED: quét nguyên vùng
+    elif payload.gene_ids:
+        targets, missing = library_design.resolve_gene_targets(db, payload.genome, payload.gene_ids)
+        mode = payload.target
+    else:
+        raise HTTPException(400, detail="Thiếu gene_ids hoặc bed")
+    if not targets:
+        raise HTTPException(404, detail={"message": "Không tìm thấy đích nào", "missing": missing})
+
+    store = genome_manager.store_dir
+    kmer_path = None
+    if store and KmerTables.is_fresh(store, payload.genome, genome_info.fasta_path):
+        kmer_path = kmer_dir(store, payload.genome)
+
+    try:
+        job = library_design.LibraryJob(
+            payload.genome, bowtie_index_path(genome_info), targets, output_format=payload.format,
+            top_n=payload.top_n, mode=mode, exons=payload.exons, cds_percent=payload.cds_percent,
+            options=library_design.filter_options(payload.min_gc, payload.max_gc, payload.min_efficiency,
+                                                  payload.max_copies),
+            kmer_path=kmer_path, missing=missing,
+            offtarget_cache=crispor_engine.bind_offtarget_cache(payload.genome, genome_info.fasta_path),
+            shards=offtarget_shards.load_shards(genome_info.fasta_path)
+        )
+    except (ValueError, RuntimeError) as e:
+        raise HTTPException(400, detail=str(e))
+
+    threading.Thread(target=job.run, args=(genome_manager,), daemon=True).start()
+    return {
+        **job.status(),
+        "status_url": f"/tools/crispor/library/{job.job_id}",
+        "download_url": f"/tools/crispor/library/{job.job_id}/download",
+    }
+
+
+@app.get("/tools/crispor/library/{job_id}")
+def library_job_status(job_id: str):
+    status = library_design.load_status(job_id)
+    if not status:
+        raise HTTPException(404, detail="Không tìm thấy job")
+    return status
+
+
+@app.get("/tools/crispor/library/{job_id}/download")
+def download_library(job_id: str):
+    """TSV tải được cả khi job đang chạy (các gen đã xong); Parquet chỉ hợp lệ khi job xong."""
+    job = library_design.load_status(job_id)
+    if not job:
+        raise HTTPException(404, detail="Không tìm thấy job")
+    status, output_format = job["status"], job["format"]
+    path = library_design.output_path(job_id, output_format)
+    if not os.path.exists(path) or (output_format == "parquet" and status not in ("done", "failed")):
+        raise HTTPException(409, detail=f"File chưa sẵn sàng (trạng thái: {status})")
+    media_type = "text/tab-separated-values" if output_format == "tsv" else "application/octet-stream"
+    return FileResponse(path, media_type=media_type,
+                        filename=f"crispr_library_{job['genome']}_{job_id}.{output_format}")
@@ -1,4 +1,7 @@
-from sqlalchemy import Column, Integer, String, Text, ForeignKey, Index
+from array import array
+
+from sqlalchemy import (Column, Integer, String, Text, Boolean, LargeBinary, ForeignKey, Index, DDL, event, func,
+                        literal_column)
 from sqlalchemy.orm import relationship
 from database import Base
 
@@ -37,4 +40,87 @@ class Gene(Base):
     # Index tìm kiếm nhanh theo bộ gen và vị trí
     __table_args__ = (
         Index('idx_genome_loc', 'genome_id', 'chromosome', 'start', 'end'),
-    )
\ No newline at end of file
+        # Tra cứu gen theo ID trong 1 bộ gen (truy vấn nóng nhất)
+        Index('idx_genome_gene', 'genome_id', 'gene_id'),
+        # Phân trang keyset của /genome/search: ORDER BY chromosome, start, id
+        Index('idx_genome_keyset', 'genome_id', 'chromosome', 'start', 'id'),
+    )
+
+
+
+def pack_intervals(intervals) -> bytes:
+    """[(start, end), ...] -> mảng int32 phẳng [s0, e0, s1, e1, ...] (gọn hơn nhiều so với 1 dòng/exon)."""
+    return array('i', [v for interval in intervals for v in interval]).tobytes()
+
+
+def unpack_intervals(blob: bytes):
+    if not blob:
+        return []
+    flat = array('i')
+    flat.frombytes(blob)
+    return list(zip(flat[0::2], flat[1::2]))
+
+
+class Transcript(Base):
+    """
+    Cấu trúc transcript (mRNA) lấy từ GFF: tọa độ exon/CDS lưu dạng mảng, 1 dòng / transcript.
+    Tọa độ 1-based, đóng [start, end], sắp tăng dần trên mạch +.
+    """
+    __tablename__ = "transcripts"
+
+    id = Column(Integer, primary_key=True)
+    transcript_id = Column(String)
+    gene_id = Column(String)  # = Gene.gene_id trong cùng bộ gen
+    genome_id = Column(String, ForeignKey("genomes.id"), index=True)
+    chromosome = Column(String)
+    strand = Column(String)
+    exons = Column(LargeBinary)  # pack_intervals(...)
+    cds = Column(LargeBinary)  # pack_intervals(...) - rỗng nếu transcript không mã hóa
+    cds_phase = Column(Integer, default=0)  # Phase của đoạn CDS đầu tiên (theo chiều gen)
+    cds_length = Column(Integer, default=0)
+    is_primary = Column(Boolean, default=False)  # Transcript có CDS dài nhất của gen
+
+    __table_args__ = (
+        Index('idx_tx_gene', 'genome_id', 'gene_id', 'is_primary'),
+        Index('idx_tx_id', 'genome_id', 'transcript_id'),
+    )
+
+    @property
+    def exon_intervals(self):
+        return unpack_intervals(self.exons)
+
+    @property
+    def cds_intervals(self):
+        return unpack_intervals(self.cds)
+
+
+# --- INDEX RIÊNG CHO POSTGRESQL (SQLite bỏ qua, vẫn chạy bình thường khi dev) ---
+# pg_trgm: cho phép LIKE '%q%' dùng index GIN thay vì quét toàn bảng
+# btree_gist: cho phép ghép cột thường (genome_id, chromosome) vào index GiST
+for _ext in ("pg_trgm", "btree_gist"):
+    event.listen(
+        Base.metadata, "before_create",
+        DDL(f"CREATE EXTENSION IF NOT EXISTS {_ext}").execute_if(dialect="postgresql")
+    )
+
+
+def gene_range(start_col, end_col):
+    """Khoảng tọa độ đóng [start, end] - phải khớp đúng biểu thức của idx_gene_range."""
+    return func.int4range(start_col, end_col, literal_column("'[]'"))
+
+
+Index(
+    'idx_gene_id_trgm', Gene.gene_id,
+    postgresql_using='gin', postgresql_ops={'gene_id': 'gin_trgm_ops'}
+).ddl_if(dialect='postgresql')
+
+Index(
+    'idx_gene_desc_trgm', Gene.description,
+    postgresql_using='gin', postgresql_ops={'description': 'gin_trgm_ops'}
+).ddl_if(dialect='postgresql')
+
+# Truy vấn overlap: gene_range && [start, end] trong 1 bộ gen + nhiễm sắc thể
+Index(
+    'idx_gene_range', Gene.genome_id, Gene.chromosome, gene_range(Gene.start, Gene.end),
+    postgresql_using='gist'
+).ddl_if(dialect='postgresql')
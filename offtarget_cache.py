@@ -0,0 +1,263 @@
+"""
+Cache off-target bền vững (SQLite cục bộ) cho kết quả Bowtie2.
+
+Cùng 1 guide 20nt xuất hiện lại ở các cửa sổ chồng lấn, các isoform, các lần gọi lại cho cùng gen...
+-> chỉ căn chỉnh 1 lần cho mỗi (bộ gen, chữ ký index, tham số tìm kiếm, guide).
+
+    - Giá trị lưu dạng nhị phân gọn: mỗi hit = (id NST, vị trí, mạch, số mismatch, chuỗi MD).
+    - Tra theo lô cho cả 1 đợt guide trước khi gọi aligner -> chỉ guide chưa có mới đi Bowtie2.
+    - Giới hạn dung lượng (OFFTARGET_CACHE_MB): vượt ngưỡng thì xóa các mục lâu không dùng nhất.
+    - Chữ ký index = kích thước + mtime các file .bt2/.bt2l: dựng lại index -> chữ ký đổi ->
+      mọi mục cũ của bộ gen đó tự bị xóa. Process khác thấy chữ ký mới ở lần bind sau -> bỏ bảng id NST cũ.
+    - Lỗi SQLite khi tra / ghi chỉ bị log: cache hỏng không làm hỏng lượt tìm off-target.
+"""
+import os
+import glob
+import time
+import struct
+import sqlite3
+import threading
+
+OFFTARGET_CACHE_PATH = os.getenv("OFFTARGET_CACHE_PATH", "data/offtarget_cache.sqlite")
+OFFTARGET_CACHE_MB = int(os.getenv("OFFTARGET_CACHE_MB", "512"))
+_PROBE_CHUNK = 500  # Số guide mỗi câu SELECT ... IN (...)
+
+# chrom_id uint32: assembly mức scaffold có thể > 65.535 trình tự
+_HIT = struct.Struct("<IIbBB")  # chrom_id, position, strand (+1/-1), mismatches, độ dài MD
+# Đổi cách mã hóa payload -> tăng số này: chữ ký lưu trong bảng indexes đổi -> mục cũ bị xóa khi bind
+CACHE_FORMAT = 2
+
+
+def index_signature(local_prefix: str) -> str:
+    """Chữ ký rẻ của index Bowtie2 (không đọc nội dung file nhiều GB)."""
+    files = sorted(glob.glob(local_prefix + "*.bt2") + glob.glob(local_prefix + "*.bt2l"))
+    if not files:
+        return "missing"
+    parts = []
+    for path in files:
+        st = os.stat(path)
+        parts.append(f"{os.path.basename(path)}:{st.st_size}:{int(st.st_mtime)}")
+    return "|".join(parts)
+
+
+class OffTargetCache:
+    """1 file SQLite dùng chung cho mọi bộ gen; an toàn giữa các thread (khóa) và process (WAL)."""
+
+    def __init__(self, path: str = OFFTARGET_CACHE_PATH, max_mb: int = OFFTARGET_CACHE_MB):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.max_bytes = max_mb * 1024 * 1024
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS hits (
+                genome TEXT, params TEXT, guide TEXT,
+                payload BLOB, size INTEGER, last_used INTEGER,
+                PRIMARY KEY (genome, params, guide)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS idx_hits_lru ON hits(last_used);
+            CREATE TABLE IF NOT EXISTS indexes (genome TEXT PRIMARY KEY, signature TEXT);
+            CREATE TABLE IF NOT EXISTS chroms (genome TEXT, name TEXT, id INTEGER, PRIMARY KEY (genome, name));
+            -- id lớn nhất khi cấp id NST mới: tra index, không quét bảng (assembly có hàng chục nghìn scaffold)
+            CREATE INDEX IF NOT EXISTS idx_chroms_id ON chroms(genome, id);
+        """)
+        self._conn.commit()
+        self._size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM hits").fetchone()[0]
+        self._chroms = {}  # genome -> ({name: id}, {id: name})
+        self._signatures = {}  # genome -> chữ ký process này thấy ở lần bind trước
+
+    def bind(self, genome_id: str, local_prefix: str, params: str):
+        """View cho 1 bộ gen + 1 bộ tham số; kiểm tra chữ ký index (xóa cache cũ nếu index đã dựng lại)."""
+        signature = f"v{CACHE_FORMAT}:{index_signature(local_prefix)}"
+        with self._lock:
+            row = self._conn.execute("SELECT signature FROM indexes WHERE genome = ?", (genome_id,)).fetchone()
+            if row is None or row[0] != signature:
+                if row is not None:
+                    print(f"♻️ [{genome_id}] Index Bowtie2 / định dạng cache đã thay đổi -> xóa cache off-target cũ")
+                self._conn.execute("DELETE FROM hits WHERE genome = ?", (genome_id,))
+                self._conn.execute("DELETE FROM chroms WHERE genome = ?", (genome_id,))
+                self._conn.execute("INSERT OR REPLACE INTO indexes VALUES (?, ?)", (genome_id, signature))
+                self._conn.commit()
+                self._chroms.pop(genome_id, None)
+                self._size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM hits").fetchone()[0]
+            elif self._signatures.get(genome_id) != signature:
+                # Process khác đã dựng lại cache (xóa bảng chroms, cấp id lại từ 0) -> bảng id trong RAM đã cũ
+                self._chroms.pop(genome_id, None)
+            self._signatures[genome_id] = signature
+        return BoundOffTargetCache(self, genome_id, params)
+
+    # --- Mã hóa ---
+    def _chrom_maps(self, genome_id):
+        maps = self._chroms.get(genome_id)
+        if maps is None:
+            rows = self._conn.execute("SELECT name, id FROM chroms WHERE genome = ?", (genome_id,)).fetchall()
+            maps = self._chroms[genome_id] = ({n: i for n, i in rows}, {i: n for n, i in rows})
+        return maps
+
+    def _chrom_ids(self, genome_id, names):
+        """id của các NST, xác nhận lại với SQLite trước khi mã hóa (id trong RAM có thể đã bị process khác cấp lại)."""
+        to_id, to_name = self._chrom_maps(genome_id)
+        ids = {}
+        for name in names:
+            # Cấp id ngay trong SQLite (1 câu lệnh, nguyên tử) -> các process không cấp trùng id
+            self._conn.execute(
+                "INSERT OR IGNORE INTO chroms SELECT ?, ?, COALESCE("
+                "(SELECT id FROM chroms INDEXED BY idx_chroms_id WHERE genome = ? ORDER BY id DESC LIMIT 1) + 1, 0)",
+                (genome_id, name, genome_id)
+            )
+            (chrom_id,) = self._conn.execute(
+                "SELECT id FROM chroms WHERE genome = ? AND name = ?", (genome_id, name)
+            ).fetchone()
+            if to_id.get(name) != chrom_id:
+                to_name.pop(to_id.get(name), None)
+                to_id[name], to_name[chrom_id] = chrom_id, name
+            ids[name] = chrom_id
+        return ids
+
+    def _encode(self, genome_id, hits, chrom_ids):
+        out = [struct.pack("<I", len(hits))]
+        for h in hits:
+            md = h.get("md", "").encode("ascii")
+            out.append(_HIT.pack(chrom_ids[h["chrom"]], int(h["position"]),
+                                 -1 if h.get("strand") == "-" else 1, h["mismatches"], len(md)))
+            out.append(md)
+        return b"".join(out)
+
+    def _decode(self, genome_id, guide, payload, reload=True):
+        _, to_name = self._chrom_maps(genome_id)
+        (count,) = struct.unpack_from("<I", payload, 0)
+        offset = 4
+        hits = []
+        for _ in range(count):
+            chrom_id, position, strand, mismatches, md_len = _HIT.unpack_from(payload, offset)
+            offset += _HIT.size
+            if chrom_id not in to_name and reload:
+                # NST do process khác thêm vào -> nạp lại bảng id
+                self._chroms.pop(genome_id, None)
+                return self._decode(genome_id, guide, payload, reload=False)
+            md = payload[offset:offset + md_len].decode("ascii")
+            offset += md_len
+            hits.append({
+                "seq": guide,
+                "chrom": to_name.get(chrom_id, str(chrom_id)),
+                "position": str(position),  # Giữ kiểu như _parse_sam_output
+                "strand": "-" if strand < 0 else "+",
+                "mismatches": mismatches,
+                "md": md,
+            })
+        return hits
+
+    # --- Tra / ghi theo lô ---
+    def get_many(self, genome_id, params, guides):
+        """Tra theo lô. Lỗi SQLite / payload hỏng chỉ bị log và trả {}: mọi guide thành miss, đi Bowtie2 như thường."""
+        found = {}
+        now = int(time.time())
+        with self._lock:
+            try:
+                for i in range(0, len(guides), _PROBE_CHUNK):
+                    chunk = guides[i:i + _PROBE_CHUNK]
+                    marks = ",".join("?" * len(chunk))
+                    rows = self._conn.execute(
+                        f"SELECT guide, payload FROM hits WHERE genome = ? AND params = ? AND guide IN ({marks})",
+                        (genome_id, params, *chunk)
+                    ).fetchall()
+                    for guide, payload in rows:
+                        found[guide] = self._decode(genome_id, guide, payload)
+                if found:
+                    self._conn.executemany(
+                        "UPDATE hits SET last_used = ? WHERE genome = ? AND params = ? AND guide = ?",
+                        [(now, genome_id, params, g) for g in found]
+                    )
+                    self._conn.commit()
+            except (struct.error, UnicodeDecodeError, sqlite3.Error) as e:
+                print(f"⚠️ [{genome_id}] Không đọc được cache off-target: {e}")
+                try:
+                    self._conn.rollback()
+                except sqlite3.Error:
+                    pass
+                return {}
+        return found
+
+    def put_many(self, genome_id, params, results):
+        """Ghi kết quả mới. Lỗi mã hóa / SQLite chỉ bị log: cache hỏng không được làm hỏng lượt tìm off-target."""
+        if not results:
+            return
+        now = int(time.time())
+        with self._lock:
+            try:
+                chrom_ids = self._chrom_ids(genome_id, {h["chrom"] for hits in results.values() for h in hits})
+                rows = []
+                for guide, hits in results.items():
+                    payload = self._encode(genome_id, hits, chrom_ids)
+                    rows.append((genome_id, params, guide, payload, len(payload) + len(guide), now))
+                self._conn.executemany("INSERT OR REPLACE INTO hits VALUES (?, ?, ?, ?, ?, ?)", rows)
+                self._conn.commit()
+                self._size += sum(r[4] for r in rows)
+                if self._size > self.max_bytes:
+                    self._evict()
+            except (struct.error, ValueError, sqlite3.Error) as e:
+                print(f"⚠️ [{genome_id}] Không ghi được cache off-target: {e}")
+                try:
+                    self._conn.rollback()
+                except sqlite3.Error:
+                    pass
+                self._chroms.pop(genome_id, None)  # id NST cấp dở trong transaction đã rollback
+
+    def _evict(self):
+        """Xóa mục lâu không dùng nhất tới khi còn 90% ngưỡng (đếm lại tổng vì nhiều process cùng ghi)."""
+        self._size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM hits").fetchone()[0]
+        target = int(self.max_bytes * 0.9)
+        while self._size > target:
+            rows = self._conn.execute(
+                "SELECT genome, params, guide, size FROM hits ORDER BY last_used LIMIT 5000"
+            ).fetchall()
+            if not rows:
+                break
+            drop = []
+            for genome, params, guide, size in rows:
+                drop.append((genome, params, guide))
+                self._size -= size
+                if self._size <= target:
+                    break
+            self._conn.executemany("DELETE FROM hits WHERE genome = ? AND params = ? AND guide = ?", drop)
+            self._conn.commit()
+
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM hits").fetchone()[0]
+            return {"path": self.path, "entries": entries, "size_mb": round(self._size / 1024 / 1024, 2),
+                    "max_mb": self.max_bytes // 1024 // 1024}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class BoundOffTargetCache:
+    """Cache đã gắn (bộ gen, tham số tìm kiếm) - thứ CrisporEngine dùng."""
+
+    def __init__(self, cache: OffTargetCache, genome_id: str, params: str):
+        self.cache = cache
+        self.genome_id = genome_id
+        self.params = params
+
+    def get_many(self, guides):
+        return self.cache.get_many(self.genome_id, self.params, list(guides))
+
+    def put_many(self, results):
+        self.cache.put_many(self.genome_id, self.params, results)
+
+
+_shared = {}
+_shared_lock = threading.Lock()
+
+
+def get_cache(path: str = OFFTARGET_CACHE_PATH):
+    """Cache dùng chung trong 1 process (mỗi process mở connection riêng)."""
+    key = (os.getpid(), path)
+    with _shared_lock:
+        if key not in _shared:
+            _shared[key] = OffTargetCache(path)
+        return _shared[key]
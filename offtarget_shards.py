@@ -0,0 +1,166 @@
+"""
+Index Bowtie2 chia theo nhóm nhiễm sắc thể: tìm off-target song song trên nhiều nhân.
+
+1 index nguyên khối -> 1 process Bowtie2 duyệt cả bộ gen cho mỗi lô guide.
+Chia NST thành N nhóm cân bằng theo số base, mỗi nhóm 1 index con -> N process chạy đồng thời,
+kết quả gộp theo guide rồi giữ top-N theo CFD (CrisporEngine._align_sharded).
+
+    <index_prefix>_shards/shard<i>.fa           - FASTA của nhóm i
+    <index_prefix>_shards/shard<i>.*.bt2        - index con (bowtie2-build)
+    <index_prefix>_shards/manifest.json         - nhóm NST + nguồn FASTA (phát hiện index cũ)
+
+    python offtarget_shards.py build [--genome R570] [--shards 8]
+"""
+import os
+import sys
+import json
+import shutil
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.getcwd())
+
+from crispor_engine import bowtie_local_prefix, to_wsl_path
+from fasta_reader import IndexedFasta, BgzfFasta, is_bgzf
+from genome_store import _source_stamp
+
+OFFTARGET_SHARDS = int(os.getenv("OFFTARGET_SHARDS", str(os.cpu_count() or 1)))
+SHARD_BUILD_THREADS = int(os.getenv("SHARD_BUILD_THREADS", "2"))  # --threads của mỗi bowtie2-build
+_WRITE_CHUNK = 4 * 1024 * 1024
+_LINE_WIDTH = 60
+
+
+def shard_dir(fasta_path: str) -> str:
+    return bowtie_local_prefix(fasta_path) + "_shards"
+
+
+def plan_shards(lengths, n_shards: int):
+    """
+    Chia NST vào n nhóm có tổng độ dài gần bằng nhau (tham lam: NST dài nhất vào nhóm nhẹ nhất).
+    lengths: {tên NST: độ dài}. Trả về list [tên NST] (bỏ nhóm rỗng).
+    """
+    groups = [[0, []] for _ in range(max(1, n_shards))]
+    for name, length in sorted(lengths.items(), key=lambda kv: -kv[1]):
+        lightest = min(groups, key=lambda g: g[0])
+        lightest[0] += length
+        lightest[1].append(name)
+    return [names for _, names in groups if names]
+
+
+def _write_shard_fasta(reader, chroms, path):
+    with open(path, "w") as fh:
+        for name in chroms:
+            fh.write(f">{name}\n")
+            length = reader.index[name].length
+            for pos in range(0, length, _WRITE_CHUNK):
+                seq = reader.fetch(name, pos, min(length, pos + _WRITE_CHUNK))
+                fh.write("\n".join(seq[i:i + _LINE_WIDTH] for i in range(0, len(seq), _LINE_WIDTH)))
+                fh.write("\n")
+
+
+def _bowtie2_build(fasta, prefix):
+    cmd = ["wsl", "bowtie2-build", "--threads", str(SHARD_BUILD_THREADS), "-q",
+           to_wsl_path(fasta), to_wsl_path(prefix)]
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"bowtie2-build lỗi ({prefix}): {result.stderr.strip()[:500]}")
+
+
+def build_shards(fasta_path: str, n_shards: int = OFFTARGET_SHARDS):
+    """Tách FASTA theo nhóm NST và dựng index con song song. Ghi vào thư mục tạm rồi đổi tên."""
+    final_dir = shard_dir(fasta_path)
+    tmp_dir = final_dir + ".building"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    reader = BgzfFasta(fasta_path) if is_bgzf(fasta_path) else IndexedFasta(fasta_path)
+    try:
+        groups = plan_shards({name: reader.index[name].length for name in reader.keys()}, n_shards)
+        shards = []
+        for i, chroms in enumerate(groups):
+            name = f"shard{i}"
+            _write_shard_fasta(reader, chroms, os.path.join(tmp_dir, name + ".fa"))
+            shards.append({"name": name, "chromosomes": chroms,
+                           "bases": sum(reader.index[c].length for c in chroms)})
+    finally:
+        reader.close()
+
+    # Mỗi bowtie2-build là 1 process riêng -> thread chỉ chờ
+    workers = max(1, (os.cpu_count() or 1) // SHARD_BUILD_THREADS)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(lambda s: _bowtie2_build(os.path.join(tmp_dir, s["name"] + ".fa"),
+                                               os.path.join(tmp_dir, s["name"])), shards))
+
+    source = _source_stamp(fasta_path)
+    with open(os.path.join(tmp_dir, "manifest.json"), "w") as fh:
+        json.dump({"source": source, "built": f"{len(shards)}:{source['size']}:{source['mtime']}",
+                   "shards": shards}, fh)
+
+    shutil.rmtree(final_dir, ignore_errors=True)
+    os.replace(tmp_dir, final_dir)
+    return final_dir
+
+
+def load_manifest(fasta_path: str):
+    """Manifest của các index con nếu đã dựng và còn khớp FASTA hiện tại, ngược lại None."""
+    if not fasta_path:
+        return None
+    path = os.path.join(shard_dir(fasta_path), "manifest.json")
+    try:
+        with open(path) as fh:
+            manifest = json.load(fh)
+        source = _source_stamp(fasta_path)
+    except (OSError, ValueError):
+        return None
+    old = manifest.get("source", {})
+    if old.get("size") != source["size"] or old.get("mtime") != source["mtime"]:
+        return None
+    return manifest
+
+
+def load_shards(fasta_path: str):
+    """Danh sách prefix (kiểu WSL) của các index con để truyền cho CrisporEngine(shards=...); None nếu chưa dựng."""
+    manifest = load_manifest(fasta_path)
+    if not manifest or len(manifest["shards"]) < 2:
+        return None
+    base = shard_dir(fasta_path)
+    return [to_wsl_path(os.path.join(base, s["name"])) for s in manifest["shards"]]
+
+
+def build_all(genome_ids=None, n_shards: int = OFFTARGET_SHARDS, force: bool = False):
+    """Dựng index con cho mọi bộ gen trong DB (hoặc danh sách genome_ids). Bỏ qua bộ còn mới."""
+    from database import SessionLocal
+    from models import Genome
+
+    db = SessionLocal()
+    try:
+        for g in db.query(Genome).all():
+            if genome_ids and g.id not in genome_ids:
+                continue
+            if not g.fasta_path or not os.path.exists(g.fasta_path):
+                print(f"⚠️ [{g.id}] Không thấy FASTA: {g.fasta_path}")
+                continue
+            manifest = load_manifest(g.fasta_path)
+            if not force and manifest and len(manifest["shards"]) == n_shards:
+                print(f"🗂️ [{g.id}] Index con còn mới, bỏ qua.")
+                continue
+
+            print(f"🧬 [{g.id}] Đang dựng {n_shards} index con...")
+            build_shards(g.fasta_path, n_shards)
+            print(f"✅ [{g.id}] Xong.")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index Bowtie2 chia theo nhóm NST (tìm off-target song song)")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_build = sub.add_parser("build", help="Dựng index con cho các bộ gen trong Database")
+    p_build.add_argument("--genome", action="append", help="Chỉ dựng bộ gen này (lặp lại được)")
+    p_build.add_argument("--shards", type=int, default=OFFTARGET_SHARDS, help="Số nhóm NST")
+    p_build.add_argument("--force", action="store_true", help="Dựng lại kể cả khi index con còn mới")
+
+    args = parser.parse_args()
+    build_all(genome_ids=args.genome, n_shards=args.shards, force=args.force)
@@ -0,0 +1,184 @@
+"""
+Registry enzyme CRISPR + quét PAM nhiều enzyme trong 1 lượt.
+
+PAM viết bằng mã IUPAC (NGG, NNGRRT, TTTV...). Mọi PAM được gộp vào 1 bảng tra:
+mã 2-bit của cửa sổ K base (K = PAM dài nhất) -> bitmask các enzyme khớp tại vị trí đó.
+Mỗi mạch chỉ mã hóa + tra bảng 1 lần (NumPy) dù yêu cầu bao nhiêu enzyme
+-> so sánh nhiều enzyme không phải quét lại trình tự cho từng enzyme.
+"""
+from collections import namedtuple
+
+import numpy as np
+
+from sequtils import reverse_complement
+
+# pam_side: "3" = PAM nằm sau spacer (Cas9), "5" = PAM nằm trước spacer (Cas12a)
+# cut_offset: vị trí cắt tính từ base đầu spacer, trên mạch chứa PAM
+# context: (số base thêm bên trái, bên phải) quanh spacer + PAM -> đoạn đưa vào mô hình điểm
+# scorers: mô hình điểm hiệu quả theo thứ tự ưu tiên (crispor_engine.EFFICIENCY_MODELS), dùng mô hình đầu tiên chạy được
+Enzyme = namedtuple("Enzyme", ["name", "pam", "spacer_len", "pam_side", "cut_offset", "context", "scorers"])
+
+ENZYMES = {
+    # Doench: 4bp + 20bp spacer + NGG + 3bp = 30bp
+    "spcas9": Enzyme("spcas9", "NGG", 20, "3", 17, (4, 3), ("doench",)),
+    # Najm 2018: 25bp trước PAM + 11bp từ đầu PAM
+    "sacas9": Enzyme("sacas9", "NNGRRT", 21, "3", 18, (4, 5), ("najm",)),
+    # DeepCpf1: 4bp + TTTV + 23bp spacer + 3bp = 34bp; cắt so le, mạch không đích sau base 18
+    "cpf1": Enzyme("cpf1", "TTTV", 23, "5", 18, (4, 3), ("seqDeepCpf1",)),
+}
+ENZYME_ALIASES = {"cas9": "spcas9", "sacas9": "sacas9", "cas12a": "cpf1", "cpf1": "cpf1"}
+DEFAULT_ENZYMES = ("spcas9",)
+
+_IUPAC = {
+    "A": "A", "C": "C", "G": "G", "T": "T",
+    "R": "AG", "Y": "CT", "S": "CG", "W": "AT", "K": "GT", "M": "AC",
+    "B": "CGT", "D": "AGT", "H": "ACT", "V": "ACG", "N": "ACGT",
+}
+_BASES = "ACGT"
+MAX_PAM_LEN = 8  # Bảng tra 4^K phần tử; PAM dài hơn -> dùng pam_regex
+# Base -> mã 2-bit; base khác ACGT -> 4 (không khớp PAM nào)
+_CODE = np.full(256, 4, dtype=np.uint8)
+for _i, _b in enumerate(_BASES):
+    _CODE[ord(_b)] = _CODE[ord(_b.lower())] = _i
+
+
+def get_enzyme(name: str) -> Enzyme:
+    key = ENZYME_ALIASES.get(name.strip().lower(), name.strip().lower())
+    if key not in ENZYMES:
+        raise ValueError(f"Enzyme không hỗ trợ: {name} (có: {', '.join(ENZYMES)})")
+    return ENZYMES[key]
+
+
+def parse_enzymes(names):
+    """'spcas9,cpf1' hoặc list tên -> tuple Enzyme (bỏ trùng, giữ thứ tự). Rỗng -> SpCas9."""
+    if isinstance(names, str):
+        names = names.split(",")
+    enzymes = [get_enzyme(n) for n in (names or ()) if n and n.strip()]
+    return tuple(dict.fromkeys(enzymes)) or tuple(ENZYMES[n] for n in DEFAULT_ENZYMES)
+
+
+def _check_iupac(pam):
+    bad = set(pam) - set(_IUPAC)
+    if bad:
+        raise ValueError(f"Mã IUPAC không hợp lệ trong PAM {pam}: {''.join(sorted(bad))}")
+
+
+def pam_regex(pam: str) -> str:
+    """PAM IUPAC -> regex lớp ký tự (NNGRRT -> [ACGT][ACGT]G[AG][AG]T), cho PAM dài hơn MAX_PAM_LEN."""
+    pam = pam.upper()
+    _check_iupac(pam)
+    return "".join(_IUPAC[s] if len(_IUPAC[s]) == 1 else f"[{_IUPAC[s]}]" for s in pam)
+
+
+class PamMatcher:
+    """
+    Bộ so khớp nhiều PAM đã biên dịch thành 1 bảng tra (4^K phần tử, K <= 8).
+    matches(seq) -> {tên PAM: mảng vị trí bắt đầu PAM} trên mạch của seq.
+    """
+
+    def __init__(self, pams):
+        self.pams = tuple(dict.fromkeys(p.upper() for p in pams))
+        if len(self.pams) > 16:
+            raise ValueError("Tối đa 16 PAM trong 1 lượt quét")
+        self.k = max(len(p) for p in self.pams)
+        if self.k > MAX_PAM_LEN:
+            raise ValueError(f"PAM dài tối đa {MAX_PAM_LEN} base")
+        for pam in self.pams:
+            _check_iupac(pam)
+
+        # Bảng: mã cửa sổ K base -> bitmask PAM khớp (PAM ngắn hơn K: các base cuối tùy ý)
+        table = np.zeros(4 ** self.k, dtype=np.uint16)
+        codes = np.arange(4 ** self.k)
+        for bit, pam in enumerate(self.pams):
+            ok = np.ones(len(codes), dtype=bool)
+            for j, symbol in enumerate(pam):
+                base = (codes >> (2 * (self.k - 1 - j))) & 3
+                ok &= np.isin(base, [_BASES.index(b) for b in _IUPAC[symbol]])
+            table[ok] |= 1 << bit
+        self.table = table
+        # Số base hợp lệ liên tiếp từ vị trí i -> PAM nào đủ chỗ
+        self.len_mask = np.zeros(self.k + 1, dtype=np.uint16)
+        for n in range(self.k + 1):
+            for bit, pam in enumerate(self.pams):
+                if len(pam) <= n:
+                    self.len_mask[n] |= 1 << bit
+
+    def hit_masks(self, seq):
+        """Bitmask PAM khớp tại mỗi vị trí của seq (1 lượt mã hóa + 1 lần tra bảng)."""
+        raw = seq.encode("ascii") if isinstance(seq, str) else bytes(seq)
+        n = len(raw)
+        if n == 0:
+            return np.zeros(0, dtype=np.uint16)
+        base = _CODE[np.frombuffer(raw, dtype=np.uint8)]
+        padded = np.concatenate([base, np.full(self.k - 1, 4, dtype=np.uint8)])
+        valid = padded < 4
+        code = np.zeros(n, dtype=np.int64)
+        run = np.zeros(n, dtype=np.int64)  # Số base ACGT liên tiếp (tối đa K)
+        alive = np.ones(n, dtype=bool)
+        for j in range(self.k):
+            window = padded[j:j + n]
+            code = (code << 2) | (window & 3)
+            alive &= valid[j:j + n]
+            run += alive
+        return self.table[code] & self.len_mask[run]
+
+    def matches(self, seq):
+        masks = self.hit_masks(seq)
+        return {pam: np.flatnonzero(masks & (1 << bit)) for bit, pam in enumerate(self.pams)}
+
+
+_matchers = {}
+
+
+def get_matcher(pams) -> PamMatcher:
+    key = tuple(sorted(set(p.upper() for p in pams)))
+    matcher = _matchers.get(key)
+    if matcher is None:
+        matcher = _matchers[key] = PamMatcher(key)
+    return matcher
+
+
+def scan_sites(window: str, enzymes=None):
+    """
+    Mọi vị trí cắt của các enzyme (tuple Enzyme, xem parse_enzymes) trên CẢ HAI mạch của window (đã upper).
+    Mỗi mạch quét 1 lần cho mọi enzyme. Trả về list dict theo thứ tự (enzyme, mạch, vị trí):
+    enzyme, strand, guide_seq, pam, start/end (spacer + PAM) và cut_site trên mạch +, context.
+    """
+    enzymes = enzymes or parse_enzymes(None)
+    matcher = get_matcher([e.pam for e in enzymes])
+    seq_len = len(window)
+    strands = (('+', window), ('-', reverse_complement(window)))
+    hits = {strand: matcher.matches(scan_seq) for strand, scan_seq in strands}
+
+    sites = []
+    for enzyme in enzymes:
+        p_len, s_len = len(enzyme.pam), enzyme.spacer_len
+        left, right = enzyme.context
+        for strand, scan_seq in strands:
+            for pam_start in hits[strand][enzyme.pam].tolist():
+                if enzyme.pam_side == "3":
+                    spacer_start = pam_start - s_len
+                    site_start, site_end = spacer_start, pam_start + p_len
+                else:
+                    spacer_start = pam_start + p_len
+                    site_start, site_end = pam_start, spacer_start + s_len
+                context_start, context_end = site_start - left, site_end + right
+                if context_start < 0 or context_end > seq_len:
+                    continue
+
+                cut = spacer_start + enzyme.cut_offset
+                if strand == '+':
+                    start, end, cut_site = site_start, site_end, cut
+                else:
+                    start, end, cut_site = seq_len - site_end, seq_len - site_start, seq_len - cut
+                sites.append({
+                    "enzyme": enzyme.name,
+                    "guide_seq": scan_seq[spacer_start:spacer_start + s_len],
+                    "pam": scan_seq[pam_start:pam_start + p_len],
+                    "strand": strand,
+                    "start": start,
+                    "end": end,
+                    "cut_site": cut_site,
+                    "context": scan_seq[context_start:context_end],
+                })
+    return sites
@@ -0,0 +1,163 @@
+"""
+Kiểm tra độ đặc hiệu của cặp mồi trên toàn bộ gen (dự đoán amplicon off-target).
+
+Ở mía đa bội, cặp mồi hay khuếch đại thêm các bản sao homeolog -> hỏng thiết kế.
+Thay vì BLAST/Bowtie2 từng mồi, mọi mồi của 1 job được gom lại và quét bộ gen ĐÚNG 1 LƯỢT:
+    - Mỗi mồi được đại diện bởi k-mer đầu 3' (PRIMER_SEED_LEN base cuối, vùng quyết định
+      việc polymerase kéo dài được hay không).
+    - Bộ gen được mã hóa 2-bit theo từng đoạn, k-mer lăn được tính vector hóa bằng NumPy,
+      đối chiếu với tập k-mer truy vấn bằng np.isin.
+    - Vị trí khớp trên mạch + = mồi bám xuôi (kéo dài về phải); khớp bổ sung ngược = bám ngược.
+    - 1 vị trí xuôi + 1 vị trí ngược cùng NST, cách nhau <= PRIMER_MAX_AMPLICON -> 1 amplicon.
+"""
+import os
+from collections import defaultdict
+
+import numpy as np
+
+from sequtils import reverse_complement
+
+PRIMER_SEED_LEN = int(os.getenv("PRIMER_SEED_LEN", "12"))
+PRIMER_MAX_AMPLICON = int(os.getenv("PRIMER_MAX_AMPLICON", "2000"))
+PRIMER_SCAN_CHUNK = int(os.getenv("PRIMER_SCAN_CHUNK", str(8 * 1024 * 1024)))  # Số base mỗi đoạn quét
+
+# Byte ASCII -> mã 2-bit (A=0 C=1 G=2 T=3), base khác (N, IUPAC) -> 4
+_CODE = np.full(256, 4, dtype=np.uint8)
+for _i, _b in enumerate("ACGT"):
+    _CODE[ord(_b)] = _i
+    _CODE[ord(_b.lower())] = _i
+
+
+def kmer_code(kmer: str) -> int:
+    """Mã hóa 1 k-mer ACGT thành số nguyên (None nếu có base không xác định)."""
+    code = 0
+    for base in kmer.upper():
+        value = int(_CODE[ord(base)])
+        if value > 3:
+            return None
+        code = (code << 2) | value
+    return code
+
+
+def rolling_kmer_codes(seq, k: int):
+    """
+    Mã k-mer tại mọi vị trí của seq (str/bytes), vector hóa: mảng int64 dài len-k+1,
+    vị trí có base không xác định trong cửa sổ = -1.
+    """
+    raw = seq.encode("ascii") if isinstance(seq, str) else bytes(seq)
+    n = len(raw) - k + 1
+    if n <= 0:
+        return np.empty(0, dtype=np.int64)
+    base = _CODE[np.frombuffer(raw, dtype=np.uint8)]
+
+    codes = np.zeros(n, dtype=np.int64)
+    for j in range(k):
+        codes <<= 2
+        codes |= base[j:j + n] & 3
+
+    bad = np.concatenate(([0], np.cumsum(base > 3)))
+    codes[(bad[k:] - bad[:n]) > 0] = -1
+    return codes
+
+
+def scan_primer_sites(reader, primers, seed_len: int = PRIMER_SEED_LEN, chunk: int = PRIMER_SCAN_CHUNK):
+    """
+    Quét bộ gen 1 lượt cho cả tập mồi.
+    reader: IndexedFasta / BgzfFasta / PackedGenome (có .index[name].length và .fetch).
+    Trả về {primer: {chrom: (fwd, rev)}} - mảng vị trí 0-based đã sắp xếp:
+      fwd: đầu 5' của amplicon khi mồi bám xuôi; rev: đầu 3' (exclusive) khi mồi bám ngược.
+    """
+    # code -> [(mồi, độ lệch tới mút amplicon, 0 = xuôi / 1 = ngược)]
+    queries = defaultdict(list)
+    for primer in set(primers):
+        if len(primer) < seed_len:
+            continue
+        seed = primer[-seed_len:]
+        fwd = kmer_code(seed)
+        rev = kmer_code(reverse_complement(seed))
+        if fwd is None or rev is None:
+            continue
+        # Bám xuôi: k-mer 3' ở [x, x+k) -> mồi bắt đầu tại x+k-len(primer)
+        queries[fwd].append((primer, seed_len - len(primer), 0))
+        # Bám ngược: bổ sung ngược của k-mer 3' ở [y, y+k) -> mồi kết thúc tại y+len(primer)
+        queries[rev].append((primer, len(primer), 1))
+
+    hits = {q[0]: defaultdict(lambda: ([], [])) for qs in queries.values() for q in qs}
+    if queries:
+        query_codes = np.fromiter(queries.keys(), dtype=np.int64)
+        for chrom in list(reader.keys()):
+            length = reader.index[chrom].length
+            for start in range(0, length, chunk):
+                # Chồng lấn k-1 base để không sót k-mer nằm vắt qua 2 đoạn
+                seq = reader.fetch(chrom, start, min(length, start + chunk + seed_len - 1))
+                codes = rolling_kmer_codes(seq, seed_len)
+                for pos in np.flatnonzero(np.isin(codes, query_codes)):
+                    for primer, shift, side in queries[int(codes[pos])]:
+                        hits[primer][chrom][side].append(start + int(pos) + shift)
+
+    return {
+        primer: {chrom: (np.sort(np.array(f, dtype=np.int64)), np.sort(np.array(r, dtype=np.int64)))
+                 for chrom, (f, r) in by_chrom.items()}
+        for primer, by_chrom in hits.items()
+    }
+
+
+def count_amplicons(sites, max_size: int = PRIMER_MAX_AMPLICON):
+    """sites: {chrom: (fwd, rev)}. Số cặp (xuôi, ngược) cùng NST tạo sản phẩm dài 1..max_size."""
+    total = 0
+    for fwd, rev in sites.values():
+        if not len(fwd) or not len(rev):
+            continue
+        lo = np.searchsorted(rev, fwd, side='right')
+        hi = np.searchsorted(rev, fwd + max_size, side='right')
+        total += int((hi - lo).sum())
+    return total
+
+
+def check_primer_pairs(reader, pairs, seed_len: int = PRIMER_SEED_LEN, max_size: int = PRIMER_MAX_AMPLICON):
+    """
+    pairs: list (left, right). 1 lượt quét bộ gen cho mọi mồi, rồi dự đoán amplicon cho từng cặp
+    (mỗi mồi đều có thể đóng vai xuôi lẫn ngược, như trong PCR thật).
+    Trả về list dict {amplicons, off_target_amplicons} theo thứ tự pairs (None nếu cặp không hợp lệ).
+    """
+    primers = {p for pair in pairs for p in pair if p and p != 'N/A'}
+    per_primer = scan_primer_sites(reader, primers, seed_len) if primers else {}
+
+    results = []
+    for left, right in pairs:
+        if left not in per_primer or right not in per_primer:
+            results.append(None)
+            continue
+        merged = {}
+        for chrom in set(per_primer[left]) | set(per_primer[right]):
+            parts = [per_primer[p][chrom] for p in {left, right} if chrom in per_primer[p]]
+            merged[chrom] = (np.sort(np.concatenate([x[0] for x in parts])),
+                             np.sort(np.concatenate([x[1] for x in parts])))
+        amplicons = count_amplicons(merged, max_size)
+        results.append({
+            "amplicons": amplicons,
+            # Amplicon đích luôn được đếm 1 lần
+            "off_target_amplicons": max(0, amplicons - 1),
+        })
+    return results
+
+
+def rerank_by_primer_specificity(results, reader, max_size: int = PRIMER_MAX_AMPLICON):
+    """
+    Gắn số amplicon dự đoán vào results[i]['primers'] và xếp lại: cặp mồi đặc hiệu (0 off-target)
+    lên trước, giữ nguyên thứ tự cũ (specificity/efficiency) trong cùng mức.
+    """
+    return rerank_many([results], reader, max_size)[0]
+
+
+def rerank_many(batches, reader, max_size: int = PRIMER_MAX_AMPLICON):
+    """Như rerank_by_primer_specificity cho nhiều danh sách kết quả (nhiều đích) - chung 1 lượt quét bộ gen."""
+    pairs = [(r['primers'].get('left'), r['primers'].get('right')) for results in batches for r in results]
+    checks = iter(check_primer_pairs(reader, pairs, max_size=max_size))
+    for results in batches:
+        for r in results:
+            check = next(checks)
+            if check is not None:
+                r['primers'].update(check)
+        results.sort(key=lambda r: r['primers'].get('off_target_amplicons', float('inf')))
+    return batches
@@ -0,0 +1,220 @@
+import uuid
+
+from sqlalchemy import select, lambda_stmt, or_, and_, tuple_, func, Table, Column, String, MetaData
+from sqlalchemy.orm import Session
+
+import database
+from models import Gene, Transcript, gene_range, unpack_intervals
+
+# Các truy vấn "nóng" (tra gen theo ID, search) được viết bằng lambda_stmt:
+# SQLAlchemy cache câu SQL đã compile theo vị trí lambda trong code,
+# các biến closure (genome_id, gene_id, ...) trở thành bind parameter.
+# -> Không phải build + compile lại SQL ở mỗi request.
+
+
+def get_gene(db: Session, genome_id: str, gene_id: str):
+    """Tra cứu 1 gen theo (genome_id, gene_id) - dùng index idx_genome_gene."""
+    stmt = lambda_stmt(
+        lambda: select(Gene).where(Gene.genome_id == genome_id, Gene.gene_id == gene_id).limit(1)
+    )
+    return db.execute(stmt).scalars().first()
+
+
+def get_transcript(db: Session, genome_id: str, gene_id: str):
+    """
+    Transcript chính (CDS dài nhất) của gen; nếu ID truyền vào là ID transcript thì lấy đúng transcript đó.
+    Cả 2 nhánh đều là tra index (idx_tx_gene / idx_tx_id).
+    """
+    stmt = lambda_stmt(
+        lambda: select(Transcript)
+        .where(Transcript.genome_id == genome_id, Transcript.gene_id == gene_id, Transcript.is_primary.is_(True))
+        .limit(1)
+    )
+    tx = db.execute(stmt).scalars().first()
+    if tx is None:
+        stmt = lambda_stmt(
+            lambda: select(Transcript)
+            .where(Transcript.genome_id == genome_id, Transcript.transcript_id == gene_id)
+            .limit(1)
+        )
+        tx = db.execute(stmt).scalars().first()
+    return transcript_spec(tx) if tx else None
+
+
+def transcript_spec(tx):
+    """ORM Transcript -> dict gọn truyền cho GenomeManager.get_data(transcript=...)."""
+    return {
+        "transcript_id": tx.transcript_id,
+        "chromosome": tx.chromosome,
+        "strand": tx.strand,
+        "cds": tx.cds_intervals,
+        "cds_phase": tx.cds_phase or 0,
+    }
+
+
+# Các cột client được phép chọn qua tham số `fields` của /genome/search
+GENE_FIELDS = ("id", "gene_id", "genome_id", "chromosome", "start", "end", "strand", "description")
+# Khóa phân trang keyset: luôn được SELECT để dựng cursor trang sau
+KEYSET_FIELDS = ("chromosome", "start", "id")
+
+
+def search_genes(db: Session, genome_id: str, q: str = None, chrom: str = None,
+                 start: int = None, end: int = None, limit: int = 10,
+                 after: tuple = None, fields=GENE_FIELDS):
+    """
+    Tìm kiếm gen theo vùng / từ khóa, phân trang keyset trên (chromosome, start, id).
+
+    after: khóa (chromosome, start, id) của dòng cuối trang trước -> WHERE (..) > after,
+           nên trang sâu tốn chi phí như trang đầu (không OFFSET).
+    fields: chỉ SELECT các cột này (+ khóa keyset), không dựng ORM object.
+    Trả về list dict (RowMapping).
+    """
+    names = tuple(dict.fromkeys(tuple(fields) + KEYSET_FIELDS))
+    columns = [getattr(Gene, f) for f in names]
+    # Projection động: cache theo tuple tên cột (track_on), các bộ lọc bên dưới vẫn là bind parameter
+    stmt = lambda_stmt(lambda: select(*columns), track_on=[",".join(names)])
+    stmt += lambda s: s.where(Gene.genome_id == genome_id)
+
+    # Lọc theo Nhiễm sắc thể
+    if chrom:
+        stmt += lambda s: s.where(Gene.chromosome == chrom)
+
+    # Lọc theo Vùng (overlap)
+    if start and end:
+        if database.is_postgres(db.get_bind()):
+            # Toán tử && trên int4range -> dùng index GiST idx_gene_range
+            stmt += lambda s: s.where(gene_range(Gene.start, Gene.end).op('&&')(gene_range(start, end)))
+        else:
+            stmt += lambda s: s.where(Gene.start <= end, Gene.end >= start)
+
+    # Lọc theo Từ khóa
+    if q:
+        search_fmt = f"%{q}%"
+        stmt += lambda s: s.where(or_(
+            Gene.gene_id.like(search_fmt),
+            Gene.description.like(search_fmt)
+        ))
+
+    # Phân trang keyset
+    if after:
+        after_chrom, after_start, after_id = after
+        stmt += lambda s: s.where(
+            tuple_(Gene.chromosome, Gene.start, Gene.id) > tuple_(after_chrom, after_start, after_id)
+        )
+
+    stmt += lambda s: s.order_by(Gene.chromosome, Gene.start, Gene.id).limit(limit)
+    return db.execute(stmt).mappings().all()
+
+
+class BatchGeneResolver:
+    """
+    Tra cứu hàng loạt gen theo danh sách ID rất lớn (tới 100k+).
+
+    Thay vì `gene_id IN (...)` (vượt giới hạn biến của SQLite, SQL khổng lồ), các ID được
+    nạp theo lô vào 1 bảng TEMPORARY rồi JOIN với bảng genes. Kết quả được stream theo
+    thứ tự (chromosome, start) để đọc FASTA tuần tự.
+
+        with BatchGeneResolver(db, genome_id, gene_ids) as resolver:
+            for row in resolver.iter_found(): ...
+            for gene_id in resolver.iter_missing(): ...
+    """
+
+    def __init__(self, db: Session, genome_id: str, gene_ids, chunk_size: int = 5000):
+        self.db = db
+        self.genome_id = genome_id
+        self.gene_ids = gene_ids
+        self.chunk_size = chunk_size
+        # Tên ngẫu nhiên: connection trong pool có thể còn bảng tạm của lần gọi trước
+        self.table = Table(
+            f"tmp_batch_ids_{uuid.uuid4().hex[:12]}", MetaData(),
+            Column("gene_id", String, primary_key=True),
+            prefixes=["TEMPORARY"],
+        )
+
+    def __enter__(self):
+        conn = self.db.connection()
+        self.table.create(conn)
+
+        # Bỏ trùng, giữ thứ tự; insert theo lô bằng executemany
+        unique_ids = list(dict.fromkeys(self.gene_ids))
+        for i in range(0, len(unique_ids), self.chunk_size):
+            chunk = unique_ids[i:i + self.chunk_size]
+            conn.execute(self.table.insert(), [{"gene_id": g} for g in chunk])
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.table.drop(self.db.connection(), checkfirst=True)
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+        return False
+
+    def iter_found(self):
+        """Stream các gen tìm thấy (RowMapping), sắp theo chromosome/start, bộ nhớ giới hạn bởi chunk_size."""
+        tmp = self.table
+        stmt = (
+            select(Gene.id, Gene.gene_id, Gene.chromosome, Gene.start, Gene.end, Gene.strand,
+                   Transcript.transcript_id, Transcript.cds, Transcript.cds_phase)
+            .join(tmp, tmp.c.gene_id == Gene.gene_id)
+            # Transcript chính đi kèm luôn -> CDS/protein không cần truy vấn thêm
+            .outerjoin(Transcript, and_(Transcript.genome_id == Gene.genome_id,
+                                        Transcript.gene_id == Gene.gene_id,
+                                        Transcript.is_primary.is_(True)))
+            .where(Gene.genome_id == self.genome_id)
+            .order_by(Gene.chromosome, Gene.start, Gene.id)
+            .execution_options(yield_per=self.chunk_size)
+        )
+        for row in self.db.execute(stmt).mappings():
+            yield row
+
+    @staticmethod
+    def transcript_of(row):
+        """Transcript chính của 1 dòng iter_found() (None nếu gen không có cấu trúc exon/CDS)."""
+        if not row["transcript_id"]:
+            return None
+        return {
+            "transcript_id": row["transcript_id"],
+            "chromosome": row["chromosome"],
+            "strand": row["strand"],
+            "cds": unpack_intervals(row["cds"]),
+            "cds_phase": row["cds_phase"] or 0,
+        }
+
+    def iter_missing(self):
+        """Các ID không có trong DB (LEFT JOIN ... IS NULL)."""
+        tmp = self.table
+        stmt = (
+            select(tmp.c.gene_id)
+            .outerjoin(Gene, and_(Gene.gene_id == tmp.c.gene_id, Gene.genome_id == self.genome_id))
+            .where(Gene.id.is_(None))
+            .execution_options(yield_per=self.chunk_size)
+        )
+        for row in self.db.execute(stmt):
+            yield row[0]
+
+
+def gene_catalog_stamp(db: Session, genome_id: str):
+    """(số gen, id lớn nhất) - rẻ, đổi khi import lại bộ gen -> biết index khoảng trong bộ nhớ đã cũ."""
+    stmt = lambda_stmt(
+        lambda: select(func.count(Gene.id), func.max(Gene.id)).where(Gene.genome_id == genome_id)
+    )
+    return tuple(db.execute(stmt).one())
+
+
+def iter_gene_models(db: Session, genome_id: str, chunk_size: int = 50000):
+    """
+    Mọi gen của 1 bộ gen kèm exon/CDS của transcript chính, stream theo (chromosome, start)
+    (idx_genome_keyset) - nguồn dựng index khoảng của gene_annotation.py.
+    """
+    stmt = (
+        select(Gene.gene_id, Gene.chromosome, Gene.start, Gene.end, Transcript.exons, Transcript.cds)
+        .outerjoin(Transcript, and_(Transcript.genome_id == Gene.genome_id,
+                                    Transcript.gene_id == Gene.gene_id,
+                                    Transcript.is_primary.is_(True)))
+        .where(Gene.genome_id == genome_id)
+        .order_by(Gene.chromosome, Gene.start, Gene.id)
+        .execution_options(yield_per=chunk_size)
+    )
+    for row in db.execute(stmt):
+        yield row
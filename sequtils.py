@@ -0,0 +1,74 @@
+import numpy as np
+
+# --- BỔ SUNG (COMPLEMENT) ---
+# Bảng tra 1 lần, dùng str.translate / bytes.translate (chạy trong C, không lặp Python).
+# Hỗ trợ cả mã IUPAC và chữ thường (vùng soft-mask của genome).
+_IUPAC_FROM = "ACGTURYKMSWBVDHNacgturykmswbvdhn"
+_IUPAC_TO = "TGCAAYRMKSWVBHDNtgcaayrmkswvbhdn"
+_COMPLEMENT_STR = str.maketrans(_IUPAC_FROM, _IUPAC_TO)
+_COMPLEMENT_BYTES = bytes.maketrans(_IUPAC_FROM.encode(), _IUPAC_TO.encode())
+
+
+def reverse_complement(seq):
+    """Trình tự bổ sung ngược. Nhận str hoặc bytes, trả về cùng kiểu."""
+    if isinstance(seq, (bytes, bytearray)):
+        return bytes(seq).translate(_COMPLEMENT_BYTES)[::-1]
+    return seq.translate(_COMPLEMENT_STR)[::-1]
+
+
+def complement(seq):
+    if isinstance(seq, (bytes, bytearray)):
+        return bytes(seq).translate(_COMPLEMENT_BYTES)
+    return seq.translate(_COMPLEMENT_STR)
+
+
+def oriented(seq, strand):
+    """Đưa trình tự genomic (luôn đọc theo mạch +) về chiều của gen."""
+    if seq and strand == '-':
+        return reverse_complement(seq)
+    return seq
+
+
+# --- DỊCH MÃ (TRANSLATION) ---
+# Bảng mã di truyền chuẩn, codon theo thứ tự TCAG (chỉ số = b1*16 + b2*4 + b3)
+_BASES = "TCAG"
+_AMINO_ACIDS = "FFLLSSSSYY**CC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG"
+CODON_TABLE = {
+    a + b + c: _AMINO_ACIDS[i * 16 + j * 4 + k]
+    for i, a in enumerate(_BASES) for j, b in enumerate(_BASES) for k, c in enumerate(_BASES)
+}
+
+# Base (byte ASCII) -> chỉ số 0..3 theo TCAG, các ký tự khác (N, IUPAC, gap) -> 4
+_BASE_INDEX = np.full(256, 4, dtype=np.uint8)
+for _i, _b in enumerate(_BASES):
+    _BASE_INDEX[ord(_b)] = _i
+    _BASE_INDEX[ord(_b.lower())] = _i
+_BASE_INDEX[ord("U")] = _BASE_INDEX[ord("u")] = 0
+
+# Chỉ số codon 0..63 -> amino acid, 64 = codon chứa base không xác định -> 'X'
+_AA_LOOKUP = np.frombuffer((_AMINO_ACIDS + "X").encode(), dtype=np.uint8)
+
+
+def translate(seq, to_stop: bool = False) -> str:
+    """
+    Dịch mã DNA -> protein bằng tra bảng vector hóa NumPy (dùng được cho cả genome-scale).
+    Phần dư (<3 base) ở cuối bị bỏ qua. to_stop=True: cắt tại codon stop đầu tiên.
+    """
+    if not seq:
+        return ""
+    raw = seq.encode("ascii") if isinstance(seq, str) else bytes(seq)
+    n = len(raw) - len(raw) % 3
+    if not n:
+        return ""
+
+    idx = _BASE_INDEX[np.frombuffer(raw, dtype=np.uint8, count=n)].reshape(-1, 3)
+    codons = idx[:, 0].astype(np.uint16) * 16 + idx[:, 1] * 4 + idx[:, 2]
+    codons[(idx > 3).any(axis=1)] = 64
+    protein = _AA_LOOKUP[codons].tobytes().decode("ascii")
+
+    if to_stop:
+        stop = protein.find("*")
+        if stop != -1:
+            protein = protein[:stop]
+    return protein
+
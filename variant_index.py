@@ -0,0 +1,199 @@
+"""
+Index biến thể (SNP/indel từ VCF) theo bộ gen: loại / đánh dấu guide có spacer hoặc PAM
+nằm trên biến thể (guide như vậy cắt hỏng ở giống mía khác alen).
+
+Dựng 1 lần lúc import (không parse VCF ở mỗi request), cạnh file FASTA:
+    <fasta>.variants/starts.npy     - int32: vị trí bắt đầu (0-based) đã sắp, nối liền các NST
+    <fasta>.variants/max_end.npy    - int32: max(end) cộng dồn trong từng NST (bắt được indel dài phủ qua)
+    <fasta>.variants/manifest.json  - {NST: [offset, số biến thể]} + nguồn VCF
+
+Tra cứu: mảng mmap + 2 lần searchsorted cho cả lô guide -> quét cả NST vẫn nhanh.
+
+    python variant_index.py build --genome R570 --vcf data/R570/R570.vcf.gz
+"""
+import os
+import sys
+import gzip
+import json
+import shutil
+import argparse
+from array import array
+
+import numpy as np
+
+sys.path.append(os.getcwd())
+
+from genome_store import _source_stamp
+
+VARIANT_FORMAT = 1
+
+
+def variant_dir(fasta_path: str) -> str:
+    return os.path.abspath(fasta_path) + ".variants"
+
+
+def _open_text(path):
+    # gzip đọc được cả file bgzip
+    with open(path, "rb") as fh:
+        magic = fh.read(2)
+    return gzip.open(path, "rt") if magic == b"\x1f\x8b" else open(path)
+
+
+def build_variant_index(vcf_path: str, fasta_path: str, pass_only: bool = True):
+    """Đọc VCF 1 lượt -> mảng đã sắp theo NST. Ghi vào thư mục tạm rồi đổi tên."""
+    per_chrom = {}  # NST -> (array starts, array ends)
+    skipped = 0
+    with _open_text(vcf_path) as fh:
+        for line in fh:
+            if line.startswith("#"):
+                continue
+            # Chỉ tách 7 cột đầu (CHROM POS ID REF ALT QUAL FILTER), bỏ qua cột mẫu
+            fields = line.split("\t", 7)
+            if len(fields) < 7 or fields[4] in (".", "*"):
+                continue
+            if pass_only and fields[6] not in ("PASS", "."):
+                skipped += 1
+                continue
+            start = int(fields[1]) - 1
+            starts, ends = per_chrom.setdefault(fields[0], (array("i"), array("i")))
+            starts.append(start)
+            ends.append(start + max(1, len(fields[3])))
+
+    final_dir = variant_dir(fasta_path)
+    tmp_dir = final_dir + ".building"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    chroms = {}
+    all_starts, all_max_end = [], []
+    offset = 0
+    for name, (starts, ends) in per_chrom.items():
+        s = np.frombuffer(starts, dtype=np.int32)
+        e = np.frombuffer(ends, dtype=np.int32)
+        order = np.argsort(s, kind="stable")
+        all_starts.append(s[order])
+        all_max_end.append(np.maximum.accumulate(e[order]))
+        chroms[name] = [offset, len(s)]
+        offset += len(s)
+
+    np.save(os.path.join(tmp_dir, "starts.npy"),
+            np.concatenate(all_starts) if all_starts else np.array([], dtype=np.int32))
+    np.save(os.path.join(tmp_dir, "max_end.npy"),
+            np.concatenate(all_max_end) if all_max_end else np.array([], dtype=np.int32))
+    with open(os.path.join(tmp_dir, "manifest.json"), "w") as fh:
+        json.dump({
+            "format": VARIANT_FORMAT,
+            "source": _source_stamp(vcf_path),
+            "pass_only": pass_only,
+            "chromosomes": chroms,
+            "variants": offset,
+            "skipped": skipped,
+        }, fh)
+
+    shutil.rmtree(final_dir, ignore_errors=True)
+    os.replace(tmp_dir, final_dir)
+    return final_dir
+
+
+class VariantIndex:
+    """Tra cứu index biến thể đã dựng (mmap read-only)."""
+
+    def __init__(self, index_dir: str):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, "manifest.json")) as fh:
+            self.manifest = json.load(fh)
+        self.chroms = self.manifest["chromosomes"]
+        self.starts = np.load(os.path.join(index_dir, "starts.npy"), mmap_mode="r")
+        self.max_end = np.load(os.path.join(index_dir, "max_end.npy"), mmap_mode="r")
+
+    @staticmethod
+    def is_fresh(fasta_path: str) -> bool:
+        """Index tồn tại và (nếu file VCF gốc còn đó) chưa cũ hơn VCF."""
+        path = os.path.join(variant_dir(fasta_path), "manifest.json")
+        try:
+            with open(path) as fh:
+                manifest = json.load(fh)
+        except (OSError, ValueError):
+            return False
+        if manifest.get("format") != VARIANT_FORMAT:
+            return False
+        source = manifest["source"]
+        if os.path.exists(source["path"]):
+            st = os.stat(source["path"])
+            return st.st_size == source["size"] and int(st.st_mtime) == source["mtime"]
+        return True
+
+    def count(self, chrom: str, starts, ends):
+        """
+        Số biến thể chồng lấn từng khoảng [start, end) 0-based (mảng, vector hóa):
+        biến thể bắt đầu trong khoảng + 1 nếu có biến thể bắt đầu trước mà phủ qua (indel).
+        """
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        seg = self.chroms.get(chrom)
+        if not seg or not seg[1] or not len(starts):
+            return np.zeros(len(starts), dtype=np.int64)
+        offset, n = seg
+        var_starts = self.starts[offset:offset + n]
+        max_end = self.max_end[offset:offset + n]
+
+        lo = np.searchsorted(var_starts, starts, side="left")
+        hi = np.searchsorted(var_starts, ends, side="left")
+        spanning = (lo > 0) & (max_end[np.maximum(lo - 1, 0)] > starts)
+        return (hi - lo) + spanning
+
+    def window(self, chrom: str, offset: int):
+        """Gắn với 1 đoạn trình tự: tọa độ 0-based trên đoạn + offset = tọa độ 0-based trên NST."""
+        return VariantWindow(self, chrom, offset)
+
+    def close(self):
+        self.starts = self.max_end = None
+
+
+class VariantWindow:
+    """Index biến thể nhìn theo tọa độ của 1 đoạn trình tự (thứ CrisporEngine.find_candidates dùng)."""
+
+    def __init__(self, index: VariantIndex, chrom: str, offset: int):
+        self.index = index
+        self.chrom = chrom
+        self.offset = offset
+
+    def count(self, starts, ends):
+        return self.index.count(self.chrom, np.asarray(starts) + self.offset, np.asarray(ends) + self.offset)
+
+
+def build_for_genome(genome_id: str, vcf_path: str, pass_only: bool = True):
+    """Dựng index biến thể cho bộ gen đã import (đặt cạnh FASTA của bộ gen)."""
+    from database import SessionLocal
+    from models import Genome
+
+    db = SessionLocal()
+    try:
+        genome = db.query(Genome).filter(Genome.id == genome_id).first()
+    finally:
+        db.close()
+    if not genome:
+        print(f"❌ Bộ gen '{genome_id}' chưa có trong Database (chạy import_data.py trước).")
+        return None
+
+    print(f"🧬 [{genome_id}] Đang index biến thể từ {vcf_path}...")
+    out = build_variant_index(vcf_path, genome.fasta_path, pass_only=pass_only)
+    with open(os.path.join(out, "manifest.json")) as fh:
+        manifest = json.load(fh)
+    print(f"✅ [{genome_id}] {manifest['variants']} biến thể / {len(manifest['chromosomes'])} NST "
+          f"(bỏ {manifest['skipped']} không PASS)")
+    return out
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index biến thể (VCF) để lọc guide nằm trên SNP/indel")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_build = sub.add_parser("build", help="Dựng index biến thể cho 1 bộ gen trong Database")
+    p_build.add_argument("--genome", required=True, help="ID bộ gen đã import (VD: R570)")
+    p_build.add_argument("--vcf", required=True, help="File VCF (.vcf hoặc .vcf.gz)")
+    p_build.add_argument("--all-filters", dest="pass_only", action="store_false",
+                         help="Lấy cả biến thể không PASS")
+
+    args = parser.parse_args()
+    build_for_genome(args.genome, args.vcf, pass_only=args.pass_only)